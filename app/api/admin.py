@@ -0,0 +1,78 @@
+"""
+Служебные эндпоинты (доступ по X-Admin-Token)
+"""
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, Depends, File, HTTPException, UploadFile, status
+from app.api.dependencies import require_admin
+from app.core.profiling import ProfiledRoute, profile_store
+from app.core.startup import refresh_bank_reachability
+from app.services.bank_health import bank_health
+from app.services.provisioning import parse_rows, provision
+
+router = APIRouter(prefix="/api/admin", tags=["Admin"], dependencies=[Depends(require_admin)], route_class=ProfiledRoute)
+
+
+@router.get("/banks/health", summary="Здоровье банков по фоновым проверкам")
+async def get_banks_health(history: bool = False) -> Dict[str, Any]:
+    """Текущее состояние всех банков; с history=true — и история проверок"""
+    return bank_health.snapshot(with_history=history)
+
+
+@router.get("/banks/{bank_code}/health", summary="История проверок банка")
+async def get_bank_health(bank_code: str) -> Dict[str, Any]:
+    """Состояние банка и история последних проверок"""
+    snapshot = bank_health.snapshot(with_history=True)
+    if bank_code not in snapshot:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No health data for bank '{bank_code}'"
+        )
+    return snapshot[bank_code]
+
+
+@router.post("/banks/reachability", summary="Перепроверить доступность банков")
+async def refresh_banks_reachability() -> Dict[str, Any]:
+    """Запросить каждый банк сейчас (обновляет банки в /readyz)"""
+    return await refresh_bank_reachability()
+
+
+@router.get("/profiles", summary="Последние профили запросов")
+async def list_profiles() -> List[Dict[str, Any]]:
+    """Краткие профили (время по категориям), новые первыми"""
+    return profile_store.list()
+
+
+@router.get("/profiles/{profile_id}", summary="Профиль запроса с отдельными участками")
+async def get_profile(profile_id: int) -> Dict[str, Any]:
+    """Профиль по id из заголовка X-Profile-Id"""
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Profile not found"
+        )
+    return profile.to_dict()
+
+
+@router.post("/provisioning", summary="Массовая загрузка пользователей и подключений")
+async def provision_users(
+    file: UploadFile = File(...),
+    format: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Файл CSV или JSON Lines: email, password, full_name, bank_code, client_id, client_secret.
+
+    Формат — по параметру format или расширению файла. Отвечает отчётом с
+    ошибкой по каждой строке; для десятков тысяч строк удобнее
+    python -m app.services.provisioning.
+    """
+    fmt = format or ("jsonl" if (file.filename or "").endswith((".jsonl", ".ndjson")) else "csv")
+    try:
+        rows = parse_rows(await file.read(), fmt)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+    report = await provision(rows)
+    return report.to_dict()
@@ -6,11 +6,12 @@ from pydantic import BaseModel, EmailStr
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from app.core.database import get_db
+from app.core.profiling import ProfiledRoute
 from app.core.security import verify_password, get_password_hash, create_access_token
 from app.models.user import User
-from app.api.dependencies import get_current_user
+from app.api.dependencies import get_current_user, read_replica
 
-router = APIRouter(prefix="/api/auth", tags=["Authentication"])
+router = APIRouter(prefix="/api/auth", tags=["Authentication"], route_class=ProfiledRoute)
 
 
 class UserRegister(BaseModel):
@@ -105,7 +106,7 @@ async def login(
     }
 
 
-@router.get("/me", response_model=UserResponse)
+@router.get("/me", response_model=UserResponse, dependencies=[Depends(read_replica)])
 async def get_me(current_user: User = Depends(get_current_user)):
     """Получить информацию о текущем пользователе"""
     return current_user
@@ -1,22 +1,49 @@
 """
 API для работы с банками
 """
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Awaitable, Callable, Type
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from datetime import datetime
-from app.core.database import get_db
+from decimal import Decimal
+import asyncio
+import math
+from app.core.database import USE_REPLICA, get_db
 from app.core.config import settings
+from app.core.profiling import ProfiledRoute
+from app.core.tracing import traced
 from app.models.user import User
 from app.models.bank_connection import BankConnection
-from app.api.dependencies import get_current_user
-from app.services.bank_service import BankService
+from app.api.dependencies import get_current_user, get_current_user_for_stream, read_replica
+from app.services.bank_service import BankService, connection_bank_config
+from app.services.bank_health import bank_health
+from app.services.bank_tokens import bank_token_expiry, ensure_fresh_token
+from app.services.rate_limiter import BankRateLimitExceeded
+from app.models.account_directory import AccountDirectoryEntry
+from app.models.sync_job import SyncJob
+from app.services.account_directory import forget_balances, record_accounts, record_balance, resolve_account
+from app.services.transaction_store import ingest_transactions, has_transactions
+from app.services.normalization import client_items, parse_datetime
+from app.services.reconciliation import reconcile_transfers, annotate_transfers
+from app.services.export import stream_csv, stream_parquet, parquet_available
+from app.services.search_index import search_indexes
+from app.services.sync_jobs import enqueue_sync_job
+from app.services.net_worth import get_net_worth
+from app.services.idempotency import IdempotencyKeyInProgress, IdempotencyKeyMismatch, run_idempotent
+from app.services.events import (
+    event_broker,
+    notify_new_transactions,
+    notify_balance_changed,
+    notify_consent_status,
+)
 
-router = APIRouter(prefix="/api/banks", tags=["Banks"])
+router = APIRouter(prefix="/api/banks", tags=["Banks"], route_class=ProfiledRoute)
 
 
+@traced()
 async def _get_active_connection(
     db: AsyncSession,
     user_id: int,
@@ -29,25 +56,173 @@ async def _get_active_connection(
             BankConnection.is_active == True
         )
     )
-    return result.scalar_one_or_none()
+    connection = result.scalar_one_or_none()
+    if connection is not None:
+        await _ensure_token(db, connection)
+    return connection
+
+
+async def _ensure_token(db: AsyncSession, connection: BankConnection) -> None:
+    """
+    Истёкший токен банк всё равно отклонит — обновить его до запроса.
+
+    Обновлённый токен сохраняется сразу: обработчики только для чтения сами
+    commit не делают, и каждый следующий запрос обновлял бы токен заново.
+    """
+    try:
+        await ensure_fresh_token(connection)
+    except Exception as e:
+        raise _upstream_error("Bank token expired and could not be refreshed", e)
+    if db.is_modified(connection):
+        await db.commit()
 
 
 def _build_bank_service(bank_code: str, connection: BankConnection | None = None) -> BankService:
-    banks = settings.get_banks()
-    if bank_code not in banks:
+    bank_config = connection_bank_config(bank_code, connection)
+    if bank_config is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Bank '{bank_code}' not found"
         )
-    
-    bank_config = banks[bank_code].copy()
-    if connection:
-        if connection.team_client_id:
-            bank_config["client_id"] = connection.team_client_id
-        if connection.team_client_secret:
-            bank_config["client_secret"] = connection.team_client_secret
-    
-    return BankService(bank_config)
+    return BankService(bank_config, bank_code=bank_code)
+
+
+def _upstream_error(
+    action: str,
+    error: Exception,
+    status_code: int = status.HTTP_502_BAD_GATEWAY
+) -> HTTPException:
+    """Преобразовать ошибку обращения к банку в HTTP-ответ"""
+    if isinstance(error, BankRateLimitExceeded):
+        retry_after = max(1, math.ceil(error.retry_after or 1))
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=f"{action}: {str(error)}",
+            headers={"Retry-After": str(retry_after)}
+        )
+    return HTTPException(status_code=status_code, detail=f"{action}: {str(error)}")
+
+
+async def _idempotent(
+    scope: str,
+    user_id: int,
+    idempotency_key: str | None,
+    payload: Dict[str, Any],
+    response: Response,
+    model: Type[BaseModel],
+    execute: Callable[[], Awaitable[BaseModel]]
+) -> BaseModel:
+    """Выполнить обработчик с учётом Idempotency-Key (без ключа — как обычно)"""
+    if idempotency_key is None:
+        return await execute()
+    if not idempotency_key or len(idempotency_key) > settings.IDEMPOTENCY_MAX_KEY_LENGTH:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Idempotency-Key must be 1-{settings.IDEMPOTENCY_MAX_KEY_LENGTH} characters"
+        )
+
+    async def execute_json() -> Dict[str, Any]:
+        return (await execute()).model_dump(mode="json")
+
+    try:
+        body, replayed = await run_idempotent(scope, user_id, idempotency_key, payload, execute_json)
+    except IdempotencyKeyMismatch as e:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    except IdempotencyKeyInProgress as e:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=str(e),
+            headers={"Retry-After": "1"}
+        )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return model.model_validate(body)
+
+
+@traced()
+async def _request_transactions(
+    connection: BankConnection,
+    account_id: str,
+    client_id: str
+) -> Dict[str, Any]:
+    bank_service = _build_bank_service(connection.bank_code, connection)
+
+    try:
+        return await bank_service.get_transactions(
+            access_token=connection.access_token,
+            account_id=account_id,
+            requesting_bank=connection.team_client_id,
+            client_id=client_id,
+            consent_id=connection.consent_id
+        )
+    except Exception as e:
+        raise _upstream_error("Failed to fetch transactions", e)
+
+
+@traced()
+async def _store_transactions(
+    db: AsyncSession,
+    connection: BankConnection,
+    account_id: str,
+    transactions: Dict[str, Any]
+) -> list:
+    """Сохранить транзакции; вернуть новые, о которых стоит уведомить (commit делает вызывающий)"""
+    seen_before = await has_transactions(db, connection.user_id, connection.bank_code, account_id)
+    new_transactions = await ingest_transactions(
+        db, connection.user_id, connection.bank_code, account_id, transactions
+    )
+    if new_transactions:
+        await reconcile_transfers(db, connection.user_id, around=new_transactions)
+    connection.last_sync_at = datetime.utcnow()
+    # При первой загрузке счёта все транзакции "новые" — событие не нужно
+    return new_transactions if seen_before else []
+
+
+async def _fetch_transactions(
+    db: AsyncSession,
+    connection: BankConnection,
+    account_id: str,
+    client_id: str
+) -> Dict[str, Any]:
+    transactions = await _request_transactions(connection, account_id, client_id)
+    new_transactions = await _store_transactions(db, connection, account_id, transactions)
+    await db.commit()
+    await notify_new_transactions(connection.user_id, connection.bank_code, account_id, new_transactions)
+    return await annotate_transfers(db, connection.user_id, connection.bank_code, transactions)
+
+
+@traced()
+async def _resolve_account_connection(
+    db: AsyncSession,
+    user_id: int,
+    account_id: str,
+    bank_code: str | None
+) -> tuple[AccountDirectoryEntry, BankConnection]:
+    entries = await resolve_account(db, user_id, account_id, bank_code)
+    if not entries:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Account '{account_id}' is unknown, fetch accounts first"
+        )
+    if len(entries) > 1:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Account '{account_id}' exists in several banks, pass bank_code"
+        )
+    entry = entries[0]
+
+    connection = await _get_active_connection(db, user_id, entry.bank_code)
+    if not connection:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Bank '{entry.bank_code}' is not connected"
+        )
+    if not entry.client_id:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="client_id for this account is unknown, fetch accounts with client_id first"
+        )
+    return entry, connection
 
 
 class BankInfo(BaseModel):
@@ -55,6 +230,7 @@ class BankInfo(BaseModel):
     code: str
     name: str
     base_url: str
+    health: str = "unknown"  # healthy | degraded | down | unknown (по фоновым проверкам)
 
 
 class BankConnectionResponse(BaseModel):
@@ -109,6 +285,52 @@ class AccountsResponse(BaseModel):
     data: Dict[str, Any]
 
 
+class BatchTransactionsItem(BaseModel):
+    """Счёт в пакетном запросе транзакций"""
+    bank_code: str
+    account_id: str
+    client_id: Optional[str] = None  # Если не указан — берётся из справочника счетов
+
+
+class BatchTransactionsRequest(BaseModel):
+    """Пакетный запрос транзакций по нескольким счетам"""
+    items: List[BatchTransactionsItem]
+
+
+class BatchTransactionsResult(BaseModel):
+    """Результат по одному счёту пакетного запроса"""
+    bank_code: str
+    account_id: str
+    status_code: int
+    data: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+    bank_health: Optional[str] = None  # healthy | degraded | down | unknown
+
+
+class BatchTransactionsResponse(BaseModel):
+    """Ответ пакетного запроса транзакций"""
+    results: List[BatchTransactionsResult]
+
+
+class NetWorthCurrency(BaseModel):
+    """Сумма балансов в одной валюте"""
+    currency: str
+    total: Decimal
+    accounts: int
+    rate: Optional[Decimal] = None  # единиц базовой валюты за единицу currency
+    converted: Optional[Decimal] = None  # None — курса нет
+
+
+class NetWorthResponse(BaseModel):
+    """Сводный баланс по всем банкам"""
+    base_currency: str
+    total: Decimal  # без валют из unconverted_currencies
+    currencies: List[NetWorthCurrency]
+    unconverted_currencies: List[str]
+    updated_at: Optional[str]
+    rates_updated_at: Optional[str]
+
+
 @router.get("/available", response_model=List[BankInfo])
 async def get_available_banks():
     """Получить список доступных банков"""
@@ -117,13 +339,18 @@ async def get_available_banks():
         BankInfo(
             code=code,
             name=config["name"],
-            base_url=config["base_url"]
+            base_url=config["base_url"],
+            health=bank_health.state(code)
         )
         for code, config in banks.items()
     ]
 
 
-@router.get("/connections", response_model=List[BankConnectionResponse])
+@router.get(
+    "/connections",
+    response_model=List[BankConnectionResponse],
+    dependencies=[Depends(read_replica)]
+)
 async def get_my_connections(
     current_user: User = Depends(get_current_user),
     db: AsyncSession = Depends(get_db)
@@ -149,13 +376,46 @@ async def get_my_connections(
     ]
 
 
+@router.get(
+    "/net-worth",
+    response_model=NetWorthResponse,
+    summary="Сводный баланс по всем банкам",
+    dependencies=[Depends(read_replica)]
+)
+async def get_my_net_worth(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Сумма последних известных балансов счетов по валютам и в базовой валюте.
+
+    Не обращается к банкам: балансы обновляются при запросе балансов и фоновой
+    синхронизации, курсы — по расписанию.
+    """
+    return NetWorthResponse(**await get_net_worth(db, current_user.id))
+
+
 @router.post("/connect", response_model=BankConnectionResponse, status_code=status.HTTP_201_CREATED)
 async def connect_bank(
     request: ConnectBankRequest,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    """Начать процесс подключения банка"""
+    """
+    Начать процесс подключения банка.
+
+    С заголовком Idempotency-Key повтор запроса возвращает ответ первого,
+    не запрашивая токен у банка ещё раз.
+    """
+    return await _idempotent(
+        "connect", current_user.id, idempotency_key, request.model_dump(), response,
+        BankConnectionResponse, lambda: _connect_bank(request, current_user, db)
+    )
+
+
+async def _connect_bank(request: ConnectBankRequest, current_user: User, db: AsyncSession) -> BankConnectionResponse:
     banks = settings.get_banks()
     # Проверить, существует ли банк
     if request.bank_code not in banks:
@@ -189,7 +449,7 @@ async def connect_bank(
     user_bank_config["client_id"] = request.client_id
     user_bank_config["client_secret"] = request.client_secret
     
-    bank_service = BankService(user_bank_config)
+    bank_service = BankService(user_bank_config, bank_code=request.bank_code)
     
     try:
         token_data = await bank_service.get_bank_token()
@@ -203,7 +463,7 @@ async def connect_bank(
             team_client_id=request.client_id,
             team_client_secret=request.client_secret,
             access_token=access_token,
-            token_expires_at=datetime.utcnow().replace(hour=23, minute=59, second=59)  # Примерно 24 часа
+            token_expires_at=await bank_token_expiry(request.bank_code, token_data)
         )
         
         db.add(connection)
@@ -222,9 +482,8 @@ async def connect_bank(
         )
         
     except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Failed to connect to bank: {str(e)}"
+        raise _upstream_error(
+            "Failed to connect to bank", e, status.HTTP_500_INTERNAL_SERVER_ERROR
         )
 
 
@@ -252,6 +511,7 @@ async def disconnect_bank(
     
     connection.is_active = False
     connection.revoked_at = datetime.utcnow()
+    await forget_balances(db, current_user.id, bank_code)
     
     await db.commit()
 
@@ -282,28 +542,14 @@ async def get_bank_clients(
             requesting_bank=connection.team_client_id
         )
     except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Failed to fetch clients: {str(e)}"
-        )
-
-    if isinstance(response, list):
-        clients = response
-    elif isinstance(response, dict):
-        clients = response.get("clients")
-        if clients is None:
-            data_block = response.get("data")
-            if isinstance(data_block, list):
-                clients = data_block
-            elif isinstance(data_block, dict):
-                clients = data_block.get("clients")
-        if clients is None:
-            clients = []
-    else:
+        raise _upstream_error("Failed to fetch clients", e)
+
+    if not isinstance(response, (list, dict)):
         raise HTTPException(
             status_code=status.HTTP_502_BAD_GATEWAY,
             detail=f"Unexpected clients payload type: {type(response).__name__}"
         )
+    clients = client_items(response)
     return BankClientsResponse(clients=clients)
 
 
@@ -316,10 +562,29 @@ async def get_bank_clients(
 async def create_bank_consent(
     bank_code: str,
     request: ConsentCreateRequest,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    """Запросить согласие у банка для доступа к данным клиента."""
+    """
+    Запросить согласие у банка для доступа к данным клиента.
+
+    С заголовком Idempotency-Key повтор запроса возвращает ответ первого и
+    не создаёт в банке второе согласие.
+    """
+    return await _idempotent(
+        f"consent:{bank_code}", current_user.id, idempotency_key, request.model_dump(), response,
+        ConsentStatusResponse, lambda: _create_bank_consent(bank_code, request, current_user, db)
+    )
+
+
+async def _create_bank_consent(
+    bank_code: str,
+    request: ConsentCreateRequest,
+    current_user: User,
+    db: AsyncSession
+) -> ConsentStatusResponse:
     connection = await _get_active_connection(db, current_user.id, bank_code)
     if not connection:
         raise HTTPException(
@@ -338,11 +603,9 @@ async def create_bank_consent(
             requesting_bank_name=request.requesting_bank_name or "Мультибанк"
         )
     except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Failed to create consent: {str(e)}"
-        )
+        raise _upstream_error("Failed to create consent", e)
 
+    old_consent_status = connection.consent_status
     connection.consent_status = result.get("status", connection.consent_status)
     new_consent_id = result.get("consent_id") or result.get("request_id")
     if new_consent_id:
@@ -351,6 +614,9 @@ async def create_bank_consent(
     await db.commit()
     await db.refresh(connection)
 
+    if connection.consent_status != old_consent_status:
+        await notify_consent_status(current_user.id, bank_code, old_consent_status, connection.consent_status)
+
     return ConsentStatusResponse(
         consent_id=result.get("consent_id"),
         request_id=result.get("request_id"),
@@ -395,11 +661,9 @@ async def get_bank_accounts(
             consent_id=connection.consent_id
         )
     except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Failed to fetch accounts: {str(e)}"
-        )
+        raise _upstream_error("Failed to fetch accounts", e)
 
+    await record_accounts(db, connection, client_id, accounts)
     connection.last_sync_at = datetime.utcnow()
     await db.commit()
 
@@ -438,23 +702,431 @@ async def get_bank_transactions(
             detail="client_id is required to fetch transactions"
         )
 
-    bank_service = _build_bank_service(bank_code, connection)
+    transactions = await _fetch_transactions(db, connection, account_id, client_id)
+    return AccountsResponse(data=transactions)
+
+
+@router.get(
+    "/accounts/{account_id}/transactions",
+    response_model=AccountsResponse,
+    summary="Получить транзакции по account_id"
+)
+async def get_account_transactions(
+    account_id: str,
+    bank_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Получить транзакции счёта; банк, клиент и согласие берутся из справочника счетов."""
+    entry, connection = await _resolve_account_connection(db, current_user.id, account_id, bank_code)
+    transactions = await _fetch_transactions(db, connection, account_id, entry.client_id)
+    return AccountsResponse(data=transactions)
+
+
+@router.get(
+    "/accounts/{account_id}/balances",
+    response_model=AccountsResponse,
+    summary="Получить балансы по account_id"
+)
+async def get_account_balances(
+    account_id: str,
+    bank_code: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Получить балансы счёта; банк, клиент и согласие берутся из справочника счетов."""
+    entry, connection = await _resolve_account_connection(db, current_user.id, account_id, bank_code)
+    bank_service = _build_bank_service(connection.bank_code, connection)
 
     try:
-        transactions = await bank_service.get_transactions(
+        balances = await bank_service.get_balances(
             access_token=connection.access_token,
             account_id=account_id,
             requesting_bank=connection.team_client_id,
-            client_id=client_id,
+            client_id=entry.client_id,
             consent_id=connection.consent_id
         )
     except Exception as e:
+        raise _upstream_error("Failed to fetch balances", e)
+
+    change = await record_balance(db, entry, balances)
+    connection.last_sync_at = datetime.utcnow()
+    await db.commit()
+
+    if change is not None and change[0] is not None:
+        await notify_balance_changed(
+            current_user.id, entry.bank_code, account_id, change[0], change[1], entry.currency
+        )
+
+    return AccountsResponse(data=balances)
+
+
+@router.get("/events", summary="Поток событий (Server-Sent Events)")
+async def stream_events(
+    request: Request,
+    last_event_id: Optional[int] = None,
+    last_event_id_header: Optional[str] = Header(default=None, alias="Last-Event-ID"),
+    current_user: User = Depends(get_current_user_for_stream)
+):
+    """
+    Новые транзакции, изменения балансов и статусов согласий без опроса.
+
+    Переподключение с заголовком Last-Event-ID дочитывает пропущенные события.
+    """
+    if last_event_id is None and last_event_id_header and last_event_id_header.isdigit():
+        last_event_id = int(last_event_id_header)
+
+    subscription = await event_broker.subscribe(current_user.id, last_event_id)
+
+    async def event_stream():
+        try:
+            # Клиенту — через сколько переподключаться при обрыве
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                event = await subscription.next(timeout=settings.EVENTS_HEARTBEAT_SECONDS)
+                yield event.encode() if event is not None else ": heartbeat\n\n"
+        finally:
+            subscription.close()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@router.post(
+    "/transactions:batch",
+    response_model=BatchTransactionsResponse,
+    summary="Получить транзакции по нескольким счетам одним запросом"
+)
+async def get_transactions_batch(
+    request: BatchTransactionsRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Транзакции по списку счетов из разных банков.
+
+    Подключения и справочник счетов читаются одним запросом на всех, запросы
+    в банки идут параллельно (не больше BATCH_PER_BANK_CONCURRENCY на банк),
+    ошибки возвращаются по каждому счёту отдельно.
+    """
+    if len(request.items) > settings.BATCH_MAX_ITEMS:
         raise HTTPException(
-            status_code=status.HTTP_502_BAD_GATEWAY,
-            detail=f"Failed to fetch transactions: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Too many items, maximum is {settings.BATCH_MAX_ITEMS}"
         )
 
-    connection.last_sync_at = datetime.utcnow()
+    bank_codes = {item.bank_code for item in request.items}
+    result = await db.execute(
+        select(BankConnection).where(
+            BankConnection.user_id == current_user.id,
+            BankConnection.bank_code.in_(bank_codes),
+            BankConnection.is_active == True
+        )
+    )
+    connections = {conn.bank_code: conn for conn in result.scalars().all()}
+    token_errors: Dict[str, HTTPException] = {}
+    for code, connection in connections.items():
+        try:
+            await _ensure_token(db, connection)
+        except HTTPException as e:
+            token_errors[code] = e
+
+    missing_client_ids = [item.account_id for item in request.items if not item.client_id]
+    directory: Dict[tuple, AccountDirectoryEntry] = {}
+    if missing_client_ids:
+        result = await db.execute(
+            select(AccountDirectoryEntry).where(
+                AccountDirectoryEntry.user_id == current_user.id,
+                AccountDirectoryEntry.account_id.in_(missing_client_ids)
+            )
+        )
+        directory = {(entry.bank_code, entry.account_id): entry for entry in result.scalars().all()}
+
+    semaphores = {
+        code: asyncio.Semaphore(settings.BATCH_PER_BANK_CONCURRENCY) for code in bank_codes
+    }
+
+    async def fetch(item: BatchTransactionsItem) -> BatchTransactionsResult:
+        connection = connections.get(item.bank_code)
+        if connection is None:
+            return BatchTransactionsResult(
+                bank_code=item.bank_code,
+                account_id=item.account_id,
+                status_code=status.HTTP_404_NOT_FOUND,
+                error=f"Bank '{item.bank_code}' is not connected"
+            )
+        client_id = item.client_id
+        if not client_id:
+            entry = directory.get((item.bank_code, item.account_id))
+            client_id = entry.client_id if entry else None
+        if not client_id:
+            return BatchTransactionsResult(
+                bank_code=item.bank_code,
+                account_id=item.account_id,
+                status_code=status.HTTP_400_BAD_REQUEST,
+                error="client_id is required to fetch transactions"
+            )
+        token_error = token_errors.get(item.bank_code)
+        if token_error is not None:
+            return BatchTransactionsResult(
+                bank_code=item.bank_code,
+                account_id=item.account_id,
+                status_code=token_error.status_code,
+                error=str(token_error.detail)
+            )
+        # Банк не отвечает на фоновые проверки — не ждём таймаута
+        if bank_health.is_down(item.bank_code):
+            return BatchTransactionsResult(
+                bank_code=item.bank_code,
+                account_id=item.account_id,
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                error=f"Bank '{item.bank_code}' is currently unavailable",
+                bank_health=bank_health.state(item.bank_code)
+            )
+        try:
+            async with semaphores[item.bank_code]:
+                data = await _request_transactions(connection, item.account_id, client_id)
+        except HTTPException as e:
+            return BatchTransactionsResult(
+                bank_code=item.bank_code,
+                account_id=item.account_id,
+                status_code=e.status_code,
+                error=str(e.detail),
+                bank_health=bank_health.state(item.bank_code)
+            )
+        return BatchTransactionsResult(
+            bank_code=item.bank_code,
+            account_id=item.account_id,
+            status_code=status.HTTP_200_OK,
+            data=data,
+            bank_health=bank_health.state(item.bank_code)
+        )
+
+    results = await asyncio.gather(*(fetch(item) for item in request.items))
+
+    # Сессия БД не допускает параллельного использования — сохраняем после всех запросов
+    notifications = []
+    for item in results:
+        if item.data is not None:
+            connection = connections[item.bank_code]
+            new_transactions = await _store_transactions(db, connection, item.account_id, item.data)
+            notifications.append((connection, item.account_id, new_transactions))
     await db.commit()
 
-    return AccountsResponse(data=transactions)
+    for connection, account_id, new_transactions in notifications:
+        await notify_new_transactions(connection.user_id, connection.bank_code, account_id, new_transactions)
+
+    for item in results:
+        if item.data is not None:
+            item.data = await annotate_transfers(db, current_user.id, item.bank_code, item.data)
+
+    return BatchTransactionsResponse(results=results)
+
+
+class SyncRequest(BaseModel):
+    """Запрос фоновой синхронизации"""
+    bank_code: Optional[str] = None  # Если не указан — все подключённые банки
+
+
+class SyncJobResponse(BaseModel):
+    """Состояние задачи синхронизации"""
+    id: int
+    bank_code: Optional[str] = None
+    status: str
+    total_accounts: int
+    done_accounts: int
+    failed_accounts: int
+    new_transactions: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    deduplicated: bool = False
+
+    class Config:
+        from_attributes = True
+
+
+@router.post(
+    "/sync",
+    response_model=SyncJobResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Запустить фоновую синхронизацию"
+)
+async def start_sync(
+    request: SyncRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Поставить в очередь обновление счетов, транзакций и балансов по всем
+    подключённым банкам (или одному). Если такая синхронизация уже ждёт или
+    выполняется, возвращается она (deduplicated=true).
+    """
+    if request.bank_code:
+        connection = await _get_active_connection(db, current_user.id, request.bank_code)
+        if not connection:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Bank '{request.bank_code}' is not connected"
+            )
+
+    job, created = await enqueue_sync_job(db, current_user.id, request.bank_code)
+    response = SyncJobResponse.model_validate(job)
+    response.deduplicated = not created
+    return response
+
+
+@router.get(
+    "/sync/{job_id}",
+    response_model=SyncJobResponse,
+    summary="Ход фоновой синхронизации",
+    dependencies=[Depends(read_replica)]
+)
+async def get_sync_job(
+    job_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Состояние и прогресс задачи синхронизации пользователя."""
+    job = await db.get(SyncJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Sync job not found"
+        )
+    return job
+
+
+class ReconcileResponse(BaseModel):
+    """Результат сверки внутренних переводов"""
+    matched_pairs: int
+
+
+@router.post(
+    "/transactions/reconcile",
+    response_model=ReconcileResponse,
+    summary="Сверить переводы между своими счетами по всей истории"
+)
+async def reconcile_my_transactions(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Найти и пометить пары списание/зачисление между счетами пользователя."""
+    matched = await reconcile_transfers(db, current_user.id)
+    await db.commit()
+    return ReconcileResponse(matched_pairs=matched)
+
+
+@router.get(
+    "/transactions/export",
+    summary="Выгрузить историю транзакций (CSV или Parquet)",
+    dependencies=[Depends(read_replica)]
+)
+async def export_transactions(
+    format: str = "csv",
+    bank_code: Optional[List[str]] = Query(default=None),
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Потоковая выгрузка сохранённых транзакций пользователя по всем банкам.
+
+    Фильтры: bank_code (можно несколько), date_from, date_to.
+    """
+    timestamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    # Выгрузка читает своей сессией — решение о реплике берётся из сессии запроса
+    use_replica = db.info.get(USE_REPLICA, False)
+    if format == "csv":
+        return StreamingResponse(
+            stream_csv(current_user.id, bank_code, date_from, date_to, use_replica=use_replica),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="transactions-{timestamp}.csv"'}
+        )
+    if format == "parquet":
+        if not parquet_available():
+            raise HTTPException(
+                status_code=status.HTTP_501_NOT_IMPLEMENTED,
+                detail="Parquet export is not available on this server"
+            )
+        return StreamingResponse(
+            stream_parquet(current_user.id, bank_code, date_from, date_to, use_replica=use_replica),
+            media_type="application/vnd.apache.parquet",
+            headers={"Content-Disposition": f'attachment; filename="transactions-{timestamp}.parquet"'}
+        )
+    raise HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="format must be 'csv' or 'parquet'"
+    )
+
+
+class TransactionSearchHit(BaseModel):
+    """Найденная транзакция"""
+    bank_code: str
+    account_id: str
+    transaction_id: str
+    amount: str
+    currency: Optional[str] = None
+    credit_debit: Optional[str] = None
+    booking_date: Optional[datetime] = None
+    description: Optional[str] = None
+    score: float
+
+
+class TransactionSearchResponse(BaseModel):
+    """Результаты поиска по транзакциям"""
+    results: List[TransactionSearchHit]
+
+
+@router.get(
+    "/transactions/search",
+    response_model=TransactionSearchResponse,
+    summary="Поиск по сохранённым транзакциям",
+    dependencies=[Depends(read_replica)]
+)
+async def search_transactions(
+    q: str = "",
+    min_amount: Optional[Decimal] = None,
+    max_amount: Optional[Decimal] = None,
+    date_from: Optional[datetime] = None,
+    date_to: Optional[datetime] = None,
+    bank_code: Optional[List[str]] = Query(default=None),
+    limit: int = Query(default=50, ge=1, le=500),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """
+    Поиск по описаниям транзакций (контрагент, назначение платежа) по всем банкам.
+
+    Слова запроса ищутся целиком, по началу слова и с опечатками; найденное
+    сортируется по релевантности, затем по дате. Сумма сравнивается по модулю.
+    """
+    index = await search_indexes.get(db, current_user.id)
+    hits = index.search(
+        q,
+        min_amount=min_amount,
+        max_amount=max_amount,
+        date_from=parse_datetime(date_from),
+        date_to=parse_datetime(date_to),
+        bank_codes=bank_code,
+        limit=limit
+    )
+    return TransactionSearchResponse(results=[
+        TransactionSearchHit(
+            bank_code=document.bank_code,
+            account_id=document.account_id,
+            transaction_id=document.transaction_id,
+            amount=str(document.amount),
+            currency=document.currency,
+            credit_debit=document.credit_debit,
+            booking_date=document.booking_date,
+            description=document.description,
+            score=round(score, 3)
+        )
+        for document, score in hits
+    ])
@@ -1,17 +1,22 @@
 """
 Dependencies для API endpoints
 """
-from fastapi import Depends, HTTPException, status
+import hmac
+from fastapi import Depends, Header, HTTPException, Query, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from app.core.database import get_db
+from app.core.config import settings
+from app.core.database import USE_REPLICA, USER_ID, get_db, is_pinned_to_primary, prefer_replica
 from app.core.security import decode_access_token
+from app.core.tracing import traced
 from app.models.user import User
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="api/auth/login", auto_error=False)
 
 
+@traced()
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
@@ -36,6 +41,11 @@ async def get_current_user(
     except (TypeError, ValueError):
         raise credentials_exception
     
+    db.info[USER_ID] = user_id
+    # Пользователь недавно что-то записал — реплика могла ещё не догнать
+    if db.info.get(USE_REPLICA) and await is_pinned_to_primary(user_id):
+        db.info[USE_REPLICA] = False
+
     result = await db.execute(select(User).where(User.id == user_id))
     user = result.scalar_one_or_none()
     
@@ -44,3 +54,43 @@ async def get_current_user(
     
     return user
 
+
+
+async def get_current_user_for_stream(
+    header_token: str | None = Depends(optional_oauth2_scheme),
+    access_token: str | None = Query(default=None),
+    db: AsyncSession = Depends(get_db)
+) -> User:
+    """Пользователь для SSE: EventSource не умеет заголовки, поэтому токен можно передать в ?access_token="""
+    token = header_token or access_token
+    if not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Not authenticated",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return await get_current_user(token=token, db=db)
+
+
+async def read_replica(db: AsyncSession = Depends(get_db)) -> None:
+    """
+    Чтения запроса можно отдавать реплике БД (см. app.core.database).
+
+    Подключается в dependencies=[...] маршрута, чтобы выполниться до
+    get_current_user: тот же запрос пользователя тогда тоже идёт на реплику.
+    """
+    prefer_replica(db)
+
+
+async def require_admin(x_admin_token: str | None = Header(default=None)) -> None:
+    """Доступ к служебным эндпоинтам по токену из настроек ADMIN_TOKEN"""
+    if not settings.ADMIN_TOKEN:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Not Found"
+        )
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, settings.ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Invalid admin token"
+        )
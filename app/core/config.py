@@ -17,12 +17,42 @@ class Settings(BaseSettings):
     # По умолчанию для Docker (используется db как hostname)
     # Для локальной разработки можно переопределить через .env или переменные окружения
     DATABASE_URL: str = "postgresql+asyncpg://multibank_user:multibank_pass@db:5432/multibank_db"
+    DB_ECHO: bool = False  # Логировать каждый SQL-запрос (дорого, только для отладки)
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30.0  # Сколько ждать свободное соединение из пула, сек
+    DB_POOL_RECYCLE: int = 3600  # Переподключение каждый час
+    DB_POOL_WARM_CONNECTIONS: int = 5  # Сколько соединений открыть заранее при старте
+    DB_SLOW_QUERY_MS: float = 200.0  # Порог для лога медленных запросов
+    DB_N_PLUS_ONE_THRESHOLD: int = 5  # Сколько одинаковых SQL за запрос считать N+1
+    # Реплика для чтения; пустая строка — все запросы идут в основную БД
+    DATABASE_REPLICA_URL: str = ""
+    DB_REPLICA_MAX_LAG_SECONDS: float = 5.0  # при большем отставании чтения идут в основную БД
+    DB_REPLICA_CHECK_INTERVAL: float = 5.0  # как часто измерять отставание, сек
+    # Сколько после записи пользователя его чтения идут в основную БД (не меньше MAX_LAG)
+    DB_REPLICA_STICKY_SECONDS: float = 10.0
     
     # === SECURITY ===
     SECRET_KEY: str = "your-secret-key-change-in-production-use-env-var"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 1440  # 24 hours
-    
+    # Токен служебных эндпоинтов /api/admin (заголовок X-Admin-Token); пустой — эндпоинты отключены
+    ADMIN_TOKEN: str = ""
+
+    # === ОБЩЕЕ СОСТОЯНИЕ (кэши между воркерами) ===
+    # memory — только внутри процесса, sqlite — общий файл на хосте, redis — сетевое хранилище
+    STATE_BACKEND: str = "memory"
+    STATE_SQLITE_PATH: str = "/tmp/multibank-state.sqlite3"
+    STATE_REDIS_URL: str = "redis://localhost:6379/0"
+    BANK_TOKEN_CACHE_TTL: int = 3600  # Максимальное время жизни кэша банковского токена, сек
+    # Ответы запросов с Idempotency-Key (подключение банка, согласие)
+    IDEMPOTENCY_KEY_TTL: float = 86400.0  # сколько хранится ответ, сек
+    # Блокировка ключа продлевается, пока первый запрос выполняется; TTL — через сколько
+    # освобождается блокировка упавшего воркера, сек
+    IDEMPOTENCY_LOCK_TTL: float = 15.0
+    IDEMPOTENCY_WAIT_TIMEOUT: float = 60.0  # сколько повтор ждёт первый запрос, затем 409, сек
+    IDEMPOTENCY_MAX_KEY_LENGTH: int = 255
+
     # === БАНКИ (из песочницы) ===
     # Можно использовать локальные банки из Docker или внешние URL
     # Для локальных банков используйте USE_LOCAL_BANKS=true в .env
@@ -85,6 +115,102 @@ class Settings(BaseSettings):
         }
     }
     
+    # Пулы HTTP-соединений к банкам
+    BANK_HTTP_MAX_CONNECTIONS: int = 100
+    BANK_HTTP_MAX_KEEPALIVE: int = 20
+    # Запись обменов с банками в архивы (каталог) и воспроизведение из них (файл или каталог)
+    BANK_RECORD_DIR: str = ""
+    BANK_REPLAY_PATH: str = ""
+    BANK_REPLAY_LATENCY_SCALE: float = 1.0  # множитель записанных задержек; 0 — без задержек
+    
+    # Квоты банков на client_id команды (на один воркер)
+    BANK_RATE_LIMIT_PER_SECOND: float = 10.0  # 0 — без ограничения
+    BANK_RATE_LIMIT_BURST: int = 20
+    BANK_RATE_LIMIT_MAX_WAIT: float = 10.0  # Сколько интерактивный запрос ждёт квоту, сек
+    BANK_RATE_LIMIT_BACKGROUND_MAX_WAIT: float = 120.0  # То же для фоновой синхронизации
+    
+    # Ключи банков (JWKS) для локальной проверки их токенов
+    BANK_JWKS_CACHE_TTL: float = 3600.0
+    BANK_JWKS_MIN_REFRESH_INTERVAL: float = 30.0  # не чаще при неизвестном kid, сек
+    BANK_TOKEN_ALGORITHMS: List[str] = ["RS256", "RS384", "RS512", "PS256", "ES256"]
+    
+    # Адаптивный лимит одновременных запросов к банку (AIMD), на воркер
+    BANK_CONCURRENCY_ENABLED: bool = True
+    BANK_CONCURRENCY_INITIAL_LIMIT: int = 10
+    BANK_CONCURRENCY_MIN_LIMIT: int = 1
+    BANK_CONCURRENCY_MAX_LIMIT: int = 100
+    BANK_CONCURRENCY_BACKOFF: float = 0.9  # множитель лимита при ошибке или росте задержки
+    BANK_CONCURRENCY_LATENCY_TOLERANCE: float = 1.5  # во сколько раз задержка может превысить базовую
+    BANK_CONCURRENCY_BASELINE_WINDOW: float = 30.0  # базовая задержка — минимум за это окно, сек
+    BANK_CONCURRENCY_QUEUE_SIZE: int = 50  # сверх этого запросы отклоняются сразу
+    BANK_CONCURRENCY_MAX_WAIT: float = 2.0  # сколько интерактивный запрос ждёт места, сек
+    BANK_CONCURRENCY_BACKGROUND_MAX_WAIT: float = 30.0
+    
+    # Массовая загрузка пользователей и подключений
+    PROVISIONING_HASH_WORKERS: int = 0  # процессов для хеширования паролей; 0 — по числу CPU
+    PROVISIONING_TOKEN_CONCURRENCY: int = 8  # одновременных запросов токенов в банки
+    PROVISIONING_BATCH_SIZE: int = 1000  # пользователей в одной транзакции вставки
+    
+    # Сводный баланс (net worth) и курсы валют
+    NET_WORTH_BASE_CURRENCY: str = "RUB"
+    FX_RATES_URL: str = "https://www.cbr-xml-daily.ru/daily_json.js"  # формат ЦБ РФ; пусто — только таблица fx_rates
+    FX_REFRESH_INTERVAL: float = 3600.0  # сек между загрузками курсов
+    
+    # Пакетные запросы транзакций
+    BATCH_MAX_ITEMS: int = 100
+    BATCH_PER_BANK_CONCURRENCY: int = 4
+    
+    # Фоновая синхронизация (POST /api/banks/sync)
+    SYNC_WORKERS: int = 4  # задач одновременно в одном воркере
+    SYNC_PER_BANK_CONCURRENCY: int = 2  # одновременных запросов в один банк на все задачи
+    SYNC_POLL_INTERVAL: float = 5.0  # как часто проверять очередь в БД, сек
+    SYNC_STALE_AFTER_SECONDS: float = 300.0  # задача без heartbeat дольше — вернуть в очередь
+    SYNC_MAX_ATTEMPTS: int = 3
+    
+    # Согласия, ожидающие одобрения клиентом: как часто перечитывать статус из банка
+    CONSENT_CHECK_INTERVAL: float = 30.0
+    CONSENT_CHECK_BATCH: int = 100  # согласий за один проход (сначала самые новые подключения)
+    
+    # Сверка переводов между своими счетами: максимальный разрыв во времени, часов
+    RECONCILE_WINDOW_HOURS: float = 72.0
+    
+    # Выгрузка истории транзакций: строк в порции (и в row group Parquet)
+    EXPORT_BATCH_SIZE: int = 5000
+    
+    # Фоновая проверка здоровья банков
+    BANK_HEALTH_PROBE_INTERVAL: float = 15.0  # сек между проверками
+    BANK_HEALTH_PROBE_TIMEOUT: float = 5.0
+    BANK_HEALTH_EWMA_ALPHA: float = 0.3  # вес последней проверки в сглаженных значениях
+    BANK_HEALTH_DEGRADED_LATENCY_MS: float = 2000.0
+    BANK_HEALTH_DEGRADED_ERROR_RATE: float = 0.3
+    BANK_HEALTH_DOWN_AFTER_FAILURES: int = 3  # неудачных проверок подряд
+    BANK_HEALTH_HISTORY_SIZE: int = 120
+    
+    # Профилирование запросов (заголовок X-Profile: <ADMIN_TOKEN> или случайная выборка)
+    PROFILING_ENABLED: bool = False
+    PROFILING_SAMPLE_RATE: float = 0.0  # доля профилируемых запросов без заголовка, 0..1
+    PROFILING_HISTORY_SIZE: int = 50
+    
+    # Трассировка (спаны обработчиков, SQL и запросов в банки)
+    TRACING_ENABLED: bool = False
+    TRACING_SAMPLE_RATE: float = 1.0  # доля трассируемых запросов без входящего traceparent
+    TRACING_EXPORT_PATH: str = ""  # файл для спанов (JSON Lines)
+    TRACING_COLLECTOR_URL: str = ""  # HTTP-коллектор, принимает POST {"spans": [...]}
+    TRACING_EXPORT_INTERVAL: float = 5.0
+    TRACING_BUFFER_SIZE: int = 10000
+    
+    # Поиск по транзакциям: сколько пользовательских индексов держать в памяти воркера
+    SEARCH_INDEX_MAX_USERS: int = 1000
+    # Окно перечитывания недавних транзакций: строки видны после commit, а не в момент created_at, сек
+    SEARCH_INDEX_CATCH_UP_OVERLAP: float = 120.0
+    
+    # === СОБЫТИЯ (SSE) ===
+    EVENTS_HEARTBEAT_SECONDS: float = 15.0
+    EVENTS_CONNECTION_BUFFER: int = 100  # Максимум непрочитанных событий на подключение
+    EVENTS_HISTORY_SIZE: int = 200  # Сколько событий пользователя хранить для Last-Event-ID
+    EVENTS_HISTORY_TTL: float = 86400.0  # Сколько хранить журнал событий после последнего события
+    EVENTS_POLL_INTERVAL: float = 1.0  # Как часто воркер забирает события, опубликованные другими воркерами
+    
     def get_banks(self) -> Dict[str, Dict[str, str]]:
         """Получить конфигурацию банков в зависимости от режима"""
         return self.LOCAL_BANKS if self.USE_LOCAL_BANKS else self.EXTERNAL_BANKS
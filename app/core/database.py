@@ -1,13 +1,30 @@
 """
 Подключение к базе данных
+
+Если задан DATABASE_REPLICA_URL, чтения можно отдавать реплике. Сессия
+запроса, помеченная зависимостью read_replica, отправляет на реплику только
+SELECT и только пока в ней ничего не записано; записи, SELECT ... FOR UPDATE
+и всё после первой записи идут в основную БД. Реплика используется, пока её
+отставание не больше DB_REPLICA_MAX_LAG_SECONDS (измеряется в фоне).
+
+Чтобы пользователь сразу видел свои изменения, после коммита с записью его
+чтения DB_REPLICA_STICKY_SECONDS секунд идут в основную БД (метка в общем
+состоянии, видна всем воркерам). Пока это окно не короче допустимого
+отставания, реплика не может отдать данные старше его собственной записи.
 """
 import logging
 import asyncio
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
-from sqlalchemy.orm import declarative_base
+from sqlalchemy.orm import Session, declarative_base
 from sqlalchemy.exc import OperationalError
-from sqlalchemy import text
+from sqlalchemy import text, inspect, Table, Column, Integer, Select
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import postgresql, sqlite
 from app.core.config import settings
+from app.core.db_instrumentation import instrument_engine
+from app.core.metrics import registry
+from app.core.state import get_state_backend
+from app.core.tracing import CLIENT, span
 
 logger = logging.getLogger(__name__)
 
@@ -15,22 +32,218 @@ logger = logging.getLogger(__name__)
 db_url_for_log = settings.DATABASE_URL.split('@')[1] if '@' in settings.DATABASE_URL else 'hidden'
 logger.info(f"Connecting to database at: {db_url_for_log}")
 
-engine = create_async_engine(
-    settings.DATABASE_URL,
-    echo=settings.DEBUG,
-    future=True,
-    pool_pre_ping=True,  # Проверка соединения перед использованием
-    pool_recycle=3600,  # Переподключение каждый час
+
+def _engine_options(url: str) -> dict:
+    """Параметры пула: размеры пула только для QueuePool (SQLite использует NullPool/StaticPool)"""
+    options = {
+        "echo": settings.DB_ECHO,
+        "future": True,
+        "pool_pre_ping": True,  # Проверка соединения перед использованием
+    }
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    return options
+
+
+engine = create_async_engine(settings.DATABASE_URL, **_engine_options(settings.DATABASE_URL))
+instrument_engine(engine.sync_engine)
+
+replica_engine = None
+if settings.DATABASE_REPLICA_URL:
+    replica_engine = create_async_engine(
+        settings.DATABASE_REPLICA_URL, **_engine_options(settings.DATABASE_REPLICA_URL)
+    )
+    instrument_engine(replica_engine.sync_engine)
+
+# Ключи session.info
+USE_REPLICA = "use_replica"  # чтения сессии можно отдавать реплике
+WROTE = "wrote"  # в сессии была запись — дальше только основная БД
+USER_ID = "user_id"  # чей запрос: после записи его чтения закрепляются за основной БД
+
+DB_REPLICA_LAG = registry.gauge("db_replica_lag_seconds", "Отставание реплики БД")
+DB_REPLICA_USABLE = registry.gauge("db_replica_usable", "Реплика БД доступна и отстаёт не больше допустимого")
+DB_READS_ROUTED_TOTAL = registry.counter(
+    "db_reads_routed_total", "SELECT из сессий, допускающих реплику, по месту выполнения", ("target",)
 )
 
+# Отставание реплики Postgres; без входящих изменений (LSN совпадают) — ноль,
+# иначе простой основной БД выглядел бы как растущее отставание
+_REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class ReplicaMonitor:
+    """Фоновое измерение отставания реплики"""
+
+    def __init__(self):
+        self.usable = False
+        self.lag_seconds: float | None = None
+        self.error: str | None = None
+
+    async def check(self) -> None:
+        try:
+            async with replica_engine.connect() as conn:
+                if conn.dialect.name == "postgresql":
+                    lag = float((await conn.execute(_REPLICA_LAG_SQL)).scalar() or 0.0)
+                else:
+                    await conn.execute(text("SELECT 1"))
+                    lag = 0.0
+        except Exception as e:
+            if self.usable or self.error is None:
+                logger.warning(f"Database replica is unavailable, reading from primary: {e}")
+            self.usable = False
+            self.lag_seconds = None
+            self.error = str(e)
+        else:
+            usable = lag <= settings.DB_REPLICA_MAX_LAG_SECONDS
+            if usable != self.usable:
+                logger.info(f"Database replica lag {lag:.1f}s, {'using' if usable else 'bypassing'} replica")
+            self.usable = usable
+            self.lag_seconds = lag
+            self.error = None
+            DB_REPLICA_LAG.set(round(lag, 3))
+        DB_REPLICA_USABLE.set(1 if self.usable else 0)
+
+    async def run(self) -> None:
+        """Периодическая проверка; запускается задачей в lifespan, если реплика задана"""
+        while True:
+            await self.check()
+            await asyncio.sleep(settings.DB_REPLICA_CHECK_INTERVAL)
+
+
+replica_monitor = ReplicaMonitor()
+
+
+class RoutingSession(Session):
+    """Синхронная часть сессии: выбирает основную БД или реплику для каждого запроса"""
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if replica_engine is None:
+            return super().get_bind(mapper, clause=clause, **kw)
+        is_read = (
+            not self._flushing
+            and isinstance(clause, Select)
+            and clause._for_update_arg is None
+        )
+        if not is_read:
+            self.info[WROTE] = True
+            return super().get_bind(mapper, clause=clause, **kw)
+        if not self.info.get(USE_REPLICA) or self.info.get(WROTE):
+            return super().get_bind(mapper, clause=clause, **kw)
+        if not replica_monitor.usable:
+            DB_READS_ROUTED_TOTAL.inc(target="primary")
+            return super().get_bind(mapper, clause=clause, **kw)
+        DB_READS_ROUTED_TOTAL.inc(target="replica")
+        return replica_engine.sync_engine
+
+
+class TracedAsyncSession(AsyncSession):
+    """Сессия, у которой commit виден в трассе отдельным спаном"""
+
+    async def commit(self) -> None:
+        with span("db.commit", CLIENT):
+            await super().commit()
+        if self.info.get(WROTE) and self.info.get(USER_ID) is not None:
+            await pin_to_primary(self.info[USER_ID])
+
+
 AsyncSessionLocal = async_sessionmaker(
     engine,
-    class_=AsyncSession,
+    class_=TracedAsyncSession,
+    sync_session_class=RoutingSession,
     expire_on_commit=False
 )
 
+
+def _primary_pin_key(user_id: int) -> str:
+    return f"db-primary-pin:{user_id}"
+
+
+async def pin_to_primary(user_id: int) -> None:
+    """Чтения пользователя DB_REPLICA_STICKY_SECONDS секунд идут в основную БД"""
+    await get_state_backend().set(_primary_pin_key(user_id), True, settings.DB_REPLICA_STICKY_SECONDS)
+
+
+async def is_pinned_to_primary(user_id: int) -> bool:
+    return await get_state_backend().get(_primary_pin_key(user_id)) is not None
+
+
+def dialect_insert(session: AsyncSession, entity):
+    """INSERT с поддержкой ON CONFLICT для диалекта основной БД сессии"""
+    if session.bind.dialect.name == "postgresql":
+        return postgresql.insert(entity)
+    return sqlite.insert(entity)
+
+
+def prefer_replica(session: AsyncSession) -> None:
+    """Разрешить сессии читать с реплики (если она настроена)"""
+    if replica_engine is not None:
+        session.info[USE_REPLICA] = True
+
 Base = declarative_base()
 
+# Версия схемы БД. Увеличивайте при добавлении таблиц/колонок и дописывайте
+# недостающие ALTER-ы в SCHEMA_MIGRATIONS под новым номером.
+SCHEMA_VERSION = 7
+
+SCHEMA_MIGRATIONS: dict[int, list[str]] = {
+    1: [
+        "ALTER TABLE bank_connections ADD COLUMN IF NOT EXISTS team_client_id VARCHAR(100)",
+        "ALTER TABLE bank_connections ADD COLUMN IF NOT EXISTS team_client_secret TEXT",
+    ],
+    2: [],  # account_directory (создаётся create_all)
+    3: [  # transactions (создаётся create_all), балансы в справочнике счетов
+        "ALTER TABLE account_directory ADD COLUMN IF NOT EXISTS balance NUMERIC(18, 2)",
+        "ALTER TABLE account_directory ADD COLUMN IF NOT EXISTS balance_updated_at TIMESTAMP",
+    ],
+    4: [  # сверка внутренних переводов
+        "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS transfer_group VARCHAR(64)",
+        "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS is_internal_transfer BOOLEAN NOT NULL DEFAULT FALSE",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_transfer_group ON transactions (transfer_group)",
+    ],
+    5: [],  # sync_jobs (создаётся create_all)
+    6: [  # net_worth_totals и fx_rates (создаются create_all), заполнение сводных балансов
+        # Балансы отключённых банков в сводный баланс не входят
+        """
+        UPDATE account_directory d SET balance = NULL
+        WHERE d.balance IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM bank_connections c
+            WHERE c.user_id = d.user_id AND c.bank_code = d.bank_code AND c.is_active
+        )
+        """,
+        """
+        INSERT INTO net_worth_totals (user_id, currency, total, accounts, updated_at)
+        SELECT user_id, currency, sum(balance), count(*), now()
+        FROM account_directory
+        WHERE balance IS NOT NULL AND currency IS NOT NULL
+        GROUP BY user_id, currency
+        ON CONFLICT (user_id, currency) DO NOTHING
+        """,
+    ],
+    7: [  # догрузка поискового индекса по created_at
+        "CREATE INDEX IF NOT EXISTS ix_transactions_user_created ON transactions (user_id, created_at)",
+    ],
+}
+
+schema_version_table = Table(
+    "schema_version",
+    Base.metadata,
+    Column("version", Integer, nullable=False),
+)
+
+# Ключ advisory-блокировки Postgres, чтобы воркеры не мигрировали схему одновременно
+_SCHEMA_LOCK_KEY = 72271
+
 
 async def get_db() -> AsyncSession:
     """Dependency для получения сессии БД"""
@@ -59,16 +272,53 @@ async def check_db_connection(retries: int = 5, delay: float = 2.0):
     return False
 
 
+async def warm_db_pool(connections: int) -> None:
+    """Открыть несколько соединений пула заранее, чтобы первые запросы не ждали handshake"""
+    async def touch():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(touch() for _ in range(max(connections, 1))))
+
+
+async def get_schema_version(conn) -> int:
+    """Текущая версия схемы (0 — таблицы версии ещё нет)"""
+    has_table = await conn.run_sync(lambda sync_conn: inspect(sync_conn).has_table("schema_version"))
+    if not has_table:
+        return 0
+    result = await conn.execute(text("SELECT max(version) FROM schema_version"))
+    return result.scalar() or 0
+
+
 async def init_db():
-    """Инициализация БД: создание таблиц"""
+    """Инициализация БД: создание таблиц, если версия схемы устарела"""
     try:
         # Проверяем подключение перед созданием таблиц
-        await check_db_connection()
-        
-        logger.info("Creating database tables...")
+        await check_db_connection(retries=1)
+
+        async with engine.connect() as conn:
+            current_version = await get_schema_version(conn)
+        if current_version >= SCHEMA_VERSION:
+            logger.info(f"Database schema is up to date (version {current_version})")
+            return
+
+        logger.info(f"Migrating database schema {current_version} -> {SCHEMA_VERSION}...")
         async with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": _SCHEMA_LOCK_KEY})
+                # Пока ждали блокировку, схему мог обновить другой воркер
+                current_version = await get_schema_version(conn)
+                if current_version >= SCHEMA_VERSION:
+                    return
             await conn.run_sync(Base.metadata.create_all)
-        logger.info("Database tables created successfully")
+            # Миграции написаны для Postgres; другие СУБД используются только с чистой схемой
+            if conn.dialect.name == "postgresql":
+                for version in range(current_version + 1, SCHEMA_VERSION + 1):
+                    for statement in SCHEMA_MIGRATIONS.get(version, []):
+                        await conn.execute(text(statement))
+            await conn.execute(schema_version_table.delete())
+            await conn.execute(schema_version_table.insert().values(version=SCHEMA_VERSION))
+        logger.info("Database schema migrated successfully")
     except Exception as e:
         logger.error(f"Failed to initialize database: {e}")
         # Логируем полный DATABASE_URL для отладки (в проде нужно убрать)
@@ -0,0 +1,180 @@
+"""
+Инструментирование SQL: счётчики на запрос, лог медленных запросов, поиск N+1
+
+Хуки SQLAlchemy считают количество запросов и время в БД для текущего
+HTTP-запроса (contextvar), пишут медленные запросы в лог с замаскированными
+параметрами и предупреждают, если один и тот же SQL выполнялся в рамках
+запроса слишком много раз.
+"""
+import logging
+import time
+from collections import Counter as StatementCounter
+from contextvars import ContextVar
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.profiling import DB, record_section
+from app.core.tracing import CLIENT, start_child_span
+
+logger = logging.getLogger(__name__)
+
+DB_QUERIES_TOTAL = registry.counter("db_queries_total", "Количество SQL-запросов")
+DB_QUERY_SECONDS = registry.histogram("db_query_seconds", "Длительность одного SQL-запроса")
+DB_SLOW_QUERIES_TOTAL = registry.counter("db_slow_queries_total", "SQL-запросы дольше DB_SLOW_QUERY_MS")
+DB_N_PLUS_ONE_TOTAL = registry.counter(
+    "db_n_plus_one_total", "HTTP-запросы с повторяющимся SQL (подозрение на N+1)", ("path",)
+)
+DB_REQUEST_QUERIES = registry.histogram(
+    "db_request_queries", "Количество SQL-запросов на HTTP-запрос", ("path",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)
+)
+DB_REQUEST_SECONDS = registry.histogram(
+    "db_request_seconds", "Суммарное время в БД на HTTP-запрос", ("path",)
+)
+
+
+class RequestDBStats:
+    """Статистика SQL в рамках одного HTTP-запроса"""
+
+    __slots__ = ("query_count", "total_seconds", "statements")
+
+    def __init__(self):
+        self.query_count = 0
+        self.total_seconds = 0.0
+        self.statements: StatementCounter[str] = StatementCounter()
+
+    def repeated_statements(self, threshold: int) -> list[tuple[str, int]]:
+        return [(sql, count) for sql, count in self.statements.items() if count >= threshold]
+
+
+current_db_stats: ContextVar[RequestDBStats | None] = ContextVar("current_db_stats", default=None)
+
+
+def redact_parameters(parameters: Any) -> Any:
+    """Скрыть значения параметров, оставив их структуру и типы"""
+    if isinstance(parameters, dict):
+        return {key: f"<{type(value).__name__}>" for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return f"<{len(parameters)} parameter sets>"
+        return [f"<{type(value).__name__}>" for value in parameters]
+    return "<redacted>"
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start_time", []).append(time.perf_counter())
+    # Спан SQL-запроса (только внутри трассы); параметры в спан не попадают
+    conn.info.setdefault("query_spans", []).append(
+        start_child_span("db.query", CLIENT) if settings.TRACING_ENABLED else None
+    )
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start_time"].pop()
+    elapsed = time.perf_counter() - started
+    _end_query_span(conn, statement, executemany)
+
+    DB_QUERIES_TOTAL.inc()
+    DB_QUERY_SECONDS.observe(elapsed)
+
+    stats = current_db_stats.get()
+    if stats is not None:
+        stats.query_count += 1
+        stats.total_seconds += elapsed
+        stats.statements[statement] += 1
+        record_section(DB, elapsed, statement[:120])
+
+    if elapsed * 1000 >= settings.DB_SLOW_QUERY_MS:
+        DB_SLOW_QUERIES_TOTAL.inc()
+        logger.warning(
+            f"Slow query ({elapsed * 1000:.1f} ms): {statement} "
+            f"parameters={redact_parameters(parameters)}"
+        )
+
+
+def _end_query_span(conn, statement: str, executemany: bool, error: BaseException | None = None) -> None:
+    spans = conn.info.get("query_spans")
+    span_ = spans.pop() if spans else None
+    if span_ is None:
+        return
+    span_.attributes.update({
+        "db.system": conn.dialect.name,
+        "db.statement": statement[:500],
+        "db.executemany": executemany,
+    })
+    if error is not None:
+        span_.record_error(error)
+    span_.end()
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute не вызывается при ошибке — снимаем начатое в before
+    conn = exception_context.connection
+    if conn is None or exception_context.execution_context is None:
+        return
+    starts = conn.info.get("query_start_time")
+    if not starts:
+        return
+    starts.pop()
+    _end_query_span(
+        conn,
+        exception_context.statement or "",
+        bool(exception_context.execution_context and exception_context.execution_context.executemany),
+        exception_context.original_exception
+    )
+
+
+def instrument_engine(engine: Engine) -> None:
+    """Подключить хуки к синхронному движку (для async — engine.sync_engine)"""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+def _report_request(path: str, stats: RequestDBStats) -> None:
+    DB_REQUEST_QUERIES.observe(stats.query_count, path=path)
+    DB_REQUEST_SECONDS.observe(stats.total_seconds, path=path)
+    repeated = stats.repeated_statements(settings.DB_N_PLUS_ONE_THRESHOLD)
+    if repeated:
+        DB_N_PLUS_ONE_TOTAL.inc(path=path)
+        for statement, count in repeated:
+            logger.warning(f"Possible N+1 in {path}: statement executed {count} times: {statement}")
+
+
+class DBStatsMiddleware:
+    """
+    ASGI-middleware: собирает статистику SQL за запрос.
+
+    В режиме DEBUG добавляет заголовки X-DB-Queries и X-DB-Time-Ms.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestDBStats()
+        token = current_db_stats.set(stats)
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start" and settings.DEBUG:
+                headers = list(message.get("headers", []))
+                headers.append((b"x-db-queries", str(stats.query_count).encode()))
+                headers.append((b"x-db-time-ms", f"{stats.total_seconds * 1000:.1f}".encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            current_db_stats.reset(token)
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            _report_request(path, stats)
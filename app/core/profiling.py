@@ -0,0 +1,312 @@
+"""
+Профилирование отдельных запросов
+
+Включается настройкой PROFILING_ENABLED. Профилируются запросы с заголовком
+X-Profile, равным ADMIN_TOKEN, и случайная доля PROFILING_SAMPLE_RATE
+остальных. Для профилируемого запроса в contextvar лежит RequestProfile, и
+инструментированные участки кода (запросы в банки, SQL, разбор JSON,
+хеширование паролей) добавляют в него своё время. Разбор и валидацию запроса
+и сериализацию ответа измеряет ProfiledRoute — route_class роутеров API.
+Последние PROFILING_HISTORY_SIZE профилей доступны в /api/admin/profiles.
+
+Время считается по настенным часам: участки, выполнявшиеся параллельно
+(asyncio.gather), суммируются, поэтому сумма по категориям может превышать
+общее время запроса. Если запрос не профилируется, участок стоит одного
+чтения contextvar; без PROFILING_ENABLED middleware не подключается вовсе.
+"""
+import functools
+import hmac
+import inspect
+import itertools
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List
+
+from fastapi.routing import APIRoute
+
+from app.core.config import settings
+
+# Категории участков
+UPSTREAM = "upstream"
+RATE_LIMIT_WAIT = "rate_limit_wait"
+DB = "db"
+JSON_DECODE = "json_decode"
+REQUEST_VALIDATE = "request_validate"
+SERIALIZE = "response_serialize"
+PASSWORD_HASH = "password_hash"
+
+# Сколько отдельных участков хранить в одном профиле
+MAX_SECTIONS_PER_PROFILE = 500
+
+
+class RequestProfile:
+    """Время по категориям в рамках одного HTTP-запроса"""
+
+    __slots__ = ("id", "method", "path", "started_at", "started", "wall_seconds", "status_code", "categories", "sections")
+
+    def __init__(self, profile_id: int, method: str, path: str):
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.wall_seconds = 0.0
+        self.status_code: int | None = None
+        self.categories: Dict[str, List[float]] = {}
+        self.sections: List[tuple] = []
+
+    def record(self, category: str, seconds: float, label: str = "", started: float | None = None) -> None:
+        totals = self.categories.setdefault(category, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += 1
+        if len(self.sections) < MAX_SECTIONS_PER_PROFILE:
+            offset = (started if started is not None else time.perf_counter() - seconds) - self.started
+            self.sections.append((category, label, offset, seconds))
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "started_at": self.started_at.isoformat(),
+            "status_code": self.status_code,
+            "wall_ms": round(self.wall_seconds * 1000, 2),
+            "categories": {
+                name: {"ms": round(seconds * 1000, 2), "count": count}
+                for name, (seconds, count) in sorted(self.categories.items(), key=lambda item: -item[1][0])
+            },
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            **self.summary(),
+            "sections": [
+                {"category": category, "label": label, "offset_ms": round(offset * 1000, 2), "ms": round(seconds * 1000, 2)}
+                for category, label, offset, seconds in self.sections
+            ],
+        }
+
+
+current_profile: ContextVar[RequestProfile | None] = ContextVar("current_profile", default=None)
+
+
+class _Section:
+    __slots__ = ("profile", "category", "label", "started")
+
+    def __init__(self, profile: RequestProfile, category: str, label: str):
+        self.profile = profile
+        self.category = category
+        self.label = label
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.record(self.category, time.perf_counter() - self.started, self.label, self.started)
+        return False
+
+
+class _NoopSection:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SECTION = _NoopSection()
+
+
+def profile_section(category: str, label: str = ""):
+    """Контекстный менеджер участка; без активного профиля ничего не делает"""
+    profile = current_profile.get()
+    if profile is None:
+        return _NOOP_SECTION
+    return _Section(profile, category, label)
+
+
+def record_section(category: str, seconds: float, label: str = "") -> None:
+    """Учесть уже измеренное время (например, из хуков SQLAlchemy)"""
+    profile = current_profile.get()
+    if profile is not None:
+        profile.record(category, seconds, label)
+
+
+class ProfileStore:
+    """Последние профили воркера"""
+
+    def __init__(self, size: int):
+        self._ids = itertools.count(1)
+        self._profiles: Deque[RequestProfile] = deque(maxlen=size)
+
+    def new_profile(self, method: str, path: str) -> RequestProfile:
+        return RequestProfile(next(self._ids), method, path)
+
+    def add(self, profile: RequestProfile) -> None:
+        self._profiles.append(profile)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [profile.summary() for profile in reversed(self._profiles)]
+
+    def get(self, profile_id: int) -> RequestProfile | None:
+        for profile in self._profiles:
+            if profile.id == profile_id:
+                return profile
+        return None
+
+
+profile_store = ProfileStore(settings.PROFILING_HISTORY_SIZE)
+
+
+def _should_profile(scope) -> bool:
+    if settings.ADMIN_TOKEN:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-profile":
+                return hmac.compare_digest(value.decode("latin-1"), settings.ADMIN_TOKEN)
+    return settings.PROFILING_SAMPLE_RATE > 0 and random.random() < settings.PROFILING_SAMPLE_RATE
+
+
+class ProfilingMiddleware:
+    """
+    ASGI-middleware: профиль выбранных запросов.
+
+    Профилированный ответ получает заголовок X-Profile-Id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = profile_store.new_profile(scope.get("method", ""), scope.get("path", ""))
+        token = current_profile.set(profile)
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", str(profile.id).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            current_profile.reset(token)
+            profile.wall_seconds = time.perf_counter() - profile.started
+            route = scope.get("route")
+            if route is not None:
+                profile.path = getattr(route, "path", profile.path)
+            profile_store.add(profile)
+
+
+def _recorded_seconds(profile: RequestProfile) -> float:
+    return sum(seconds for seconds, _ in profile.categories.values())
+
+
+class _EndpointTiming:
+    __slots__ = ("profile", "started", "finished", "recorded_before", "recorded_after")
+
+    def __init__(self, profile: RequestProfile):
+        self.profile = profile
+        self.started: float | None = None
+        self.finished: float | None = None
+        # сколько времени участков было записано к началу и к концу эндпоинта
+        self.recorded_before = 0.0
+        self.recorded_after = 0.0
+
+    def start(self) -> None:
+        self.recorded_before = _recorded_seconds(self.profile)
+        self.started = time.perf_counter()
+
+    def finish(self) -> None:
+        self.finished = time.perf_counter()
+        self.recorded_after = _recorded_seconds(self.profile)
+
+
+# Отметки начала и конца эндпоинта текущего запроса. Объект изменяемый:
+# синхронный эндпоинт работает в треде с копией контекста и заполняет его там же
+_endpoint_timing: ContextVar[_EndpointTiming | None] = ContextVar("endpoint_timing", default=None)
+
+
+def _timed_endpoint(endpoint: Callable) -> Callable:
+    """Обёртка эндпоинта, отмечающая его начало и конец; сигнатура сохраняется для FastAPI"""
+    if inspect.iscoroutinefunction(endpoint):
+        @functools.wraps(endpoint)
+        async def timed(*args, **kwargs):
+            timing = _endpoint_timing.get()
+            if timing is None:
+                return await endpoint(*args, **kwargs)
+            timing.start()
+            try:
+                return await endpoint(*args, **kwargs)
+            finally:
+                timing.finish()
+    else:
+        @functools.wraps(endpoint)
+        def timed(*args, **kwargs):
+            timing = _endpoint_timing.get()
+            if timing is None:
+                return endpoint(*args, **kwargs)
+            timing.start()
+            try:
+                return endpoint(*args, **kwargs)
+            finally:
+                timing.finish()
+    return timed
+
+
+class ProfiledRoute(APIRoute):
+    """
+    Маршрут, делящий обработку запроса FastAPI на участки вокруг эндпоинта.
+
+    До вызова эндпоинта FastAPI читает тело, разбирает JSON, валидирует
+    параметры и тело (pydantic) и вычисляет зависимости — это REQUEST_VALIDATE
+    за вычетом участков, уже учтённых за это время (SQL в get_current_user и
+    т. п.). После возврата эндпоинта — валидация и сериализация ответа
+    (SERIALIZE), тоже за вычетом вложенных участков. Используется только
+    публичный route_class, без подмены внутренних функций FastAPI; без
+    активного профиля обработчик вызывается как есть.
+    """
+
+    def __init__(self, path: str, endpoint: Callable, **kwargs):
+        super().__init__(path, _timed_endpoint(endpoint), **kwargs)
+
+    def get_route_handler(self) -> Callable:
+        handler = super().get_route_handler()
+
+        async def profiled_handler(request):
+            profile = current_profile.get()
+            if profile is None:
+                return await handler(request)
+
+            timing = _EndpointTiming(profile)
+            token = _endpoint_timing.set(timing)
+            started = time.perf_counter()
+            recorded_before = _recorded_seconds(profile)
+            try:
+                return await handler(request)
+            finally:
+                _endpoint_timing.reset(token)
+                finished = time.perf_counter()
+                if timing.started is None:
+                    # эндпоинт не вызывался: запрос не прошёл валидацию или зависимость
+                    validated, recorded = finished, _recorded_seconds(profile)
+                else:
+                    validated, recorded = timing.started, timing.recorded_before
+                profile.record(REQUEST_VALIDATE, max(validated - started - (recorded - recorded_before), 0.0), started=started)
+                if timing.finished is not None:
+                    # после эндпоинта FastAPI ещё закрывает yield-зависимости (сессию БД)
+                    nested = _recorded_seconds(profile) - timing.recorded_after
+                    profile.record(SERIALIZE, max(finished - timing.finished - nested, 0.0), started=timing.finished)
+
+        return profiled_handler
@@ -2,10 +2,11 @@
 Безопасность: хеширование паролей, создание JWT токенов
 """
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from app.core.config import settings
+from app.core.profiling import PASSWORD_HASH, profile_section
 
 pwd_context = CryptContext(
     schemes=["argon2", "bcrypt"],  # argon2 — по умолчанию для новых хэшей, bcrypt — для совместимости
@@ -28,14 +29,21 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Проверка пароля"""
     # bcrypt ограничивает длину входа 72 байт
     safe_plain = _truncate_for_bcrypt(plain_password)
-    return pwd_context.verify(safe_plain, hashed_password)
+    with profile_section(PASSWORD_HASH, "verify"):
+        return pwd_context.verify(safe_plain, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
     """Хеширование пароля"""
     # bcrypt ограничивает длину входа 72 байт
     safe_password = _truncate_for_bcrypt(password)
-    return pwd_context.hash(safe_password)
+    with profile_section(PASSWORD_HASH, "hash"):
+        return pwd_context.hash(safe_password)
+
+
+def hash_passwords(passwords: List[str]) -> List[str]:
+    """Хеширование пачки паролей (выполняется в пуле процессов при массовой загрузке)"""
+    return [pwd_context.hash(_truncate_for_bcrypt(password)) for password in passwords]
 
 
 def create_access_token(data: Dict[str, Any], expires_delta: Optional[timedelta] = None) -> str:
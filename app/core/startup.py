@@ -0,0 +1,100 @@
+"""
+Прогрев приложения при старте и состояние готовности воркера
+
+Старт не блокирует приём запросов: `/livez` отвечает сразу, а `/readyz`
+возвращает 503, пока не прогреты пул БД и HTTP-пулы к банкам. Балансировщик
+при rolling deploy направляет трафик только на готовые воркеры.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict
+
+from app.core.config import settings
+from app.core.database import init_db, warm_db_pool
+from app.services.bank_service import warm_up_bank
+
+logger = logging.getLogger(__name__)
+
+# Максимальная пауза между попытками подключиться к БД при старте
+STARTUP_RETRY_MAX_DELAY = 10.0
+
+
+class StartupState:
+    """Состояние прогрева текущего воркера"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.db_ready = False
+        self.banks_warmed = False
+        self.banks: Dict[str, Dict[str, Any]] = {}
+        self.timings_ms: Dict[str, float] = {}
+        self.ready_after_ms: float | None = None
+        self.last_error: str | None = None
+
+    @property
+    def ready(self) -> bool:
+        return self.db_ready and self.banks_warmed
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "status": "ready" if self.ready else "starting",
+            "database": self.db_ready,
+            "bank_pools": self.banks_warmed,
+            "banks": self.banks,
+            "startup_ms": self.ready_after_ms,
+            "timings_ms": self.timings_ms,
+            "last_error": self.last_error,
+        }
+
+
+startup_state = StartupState()
+
+
+def _elapsed_ms(started: float) -> float:
+    return round((time.monotonic() - started) * 1000, 1)
+
+
+async def _prepare_database() -> None:
+    """Схема и прогрев пула БД; повторяем, пока БД не станет доступна"""
+    started = time.monotonic()
+    delay = 0.5
+    while True:
+        try:
+            await init_db()
+            await warm_db_pool(settings.DB_POOL_WARM_CONNECTIONS)
+            break
+        except Exception as e:
+            startup_state.last_error = f"database: {e}"
+            logger.warning(f"Database is not ready yet, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, STARTUP_RETRY_MAX_DELAY)
+    startup_state.db_ready = True
+    startup_state.timings_ms["database"] = _elapsed_ms(started)
+
+
+async def refresh_bank_reachability() -> Dict[str, Dict[str, Any]]:
+    """Проверить доступность всех банков (заодно прогревая их пулы)"""
+    banks = settings.get_banks()
+    results = await asyncio.gather(*(warm_up_bank(config) for config in banks.values()))
+    startup_state.banks = dict(zip(banks.keys(), results))
+    return startup_state.banks
+
+
+async def _warm_bank_pools() -> None:
+    started = time.monotonic()
+    await refresh_bank_reachability()
+    startup_state.banks_warmed = True
+    startup_state.timings_ms["bank_pools"] = _elapsed_ms(started)
+
+
+async def warm_up() -> None:
+    """Прогреть БД и пулы банков параллельно и зафиксировать время холодного старта"""
+    await asyncio.gather(_prepare_database(), _warm_bank_pools())
+    startup_state.ready_after_ms = _elapsed_ms(startup_state.started_at)
+    startup_state.last_error = None
+    unreachable = [code for code, info in startup_state.banks.items() if not info.get("reachable")]
+    logger.info(
+        f"Worker ready in {startup_state.ready_after_ms} ms "
+        f"(timings: {startup_state.timings_ms}, unreachable banks: {unreachable or 'none'})"
+    )
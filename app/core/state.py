@@ -0,0 +1,501 @@
+"""
+Общее хранилище состояния для кэшей и межпроцессных блокировок
+
+Кэши приложения (банковские токены, ответы банков и т.п.) не должны жить
+внутри одного воркера uvicorn: при нескольких воркерах каждый из них ходил бы
+в банк за одними и теми же данными. Поэтому все кэши работают через
+`StateBackend`, у которого есть три реализации:
+
+- `MemoryStateBackend` — в памяти процесса (один воркер, разработка);
+- `SQLiteStateBackend` — файл SQLite на локальном диске (несколько воркеров
+  на одном хосте);
+- `RedisStateBackend` — сетевое хранилище (несколько хостов).
+
+Кроме ключей и блокировок хранилище ведёт короткие журналы (append_log /
+read_log): записи с возрастающими номерами, общими для всех воркеров, — через
+них идут события для SSE-подписчиков любого воркера.
+
+Значения должны сериализоваться в JSON.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from app.core.config import settings
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:  # pragma: no cover - redis нужен только для STATE_BACKEND=redis
+    redis_asyncio = None
+
+logger = logging.getLogger(__name__)
+
+
+class StateLockTimeout(TimeoutError):
+    """Не удалось дождаться блокировки"""
+
+
+class StateBackend(ABC):
+    """Интерфейс общего хранилища состояния"""
+
+    @abstractmethod
+    async def get(self, key: str) -> Any | None:
+        """Получить значение (None, если ключа нет или он истёк)"""
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        """Сохранить значение, ttl — время жизни в секундах"""
+
+    @abstractmethod
+    async def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        """Сохранить значение, только если ключа ещё нет. True — если записали"""
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        """Удалить ключ"""
+
+    @abstractmethod
+    async def append_log(self, key: str, value: Any, maxlen: int, ttl: float | None = None) -> int:
+        """
+        Дописать запись в журнал и вернуть её номер.
+
+        Номера растут строго и одинаковы для всех воркеров; в журнале остаются
+        последние maxlen записей, ttl — время жизни журнала после последней записи.
+        """
+
+    @abstractmethod
+    async def read_log(self, key: str, after: int = 0) -> List[Tuple[int, Any]]:
+        """Записи журнала с номером больше after, по возрастанию номера"""
+
+    @abstractmethod
+    async def _try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        """Попытаться захватить блокировку на ttl секунд"""
+
+    @abstractmethod
+    async def _release(self, name: str, owner: str) -> None:
+        """Освободить блокировку, если она всё ещё принадлежит owner"""
+
+    @abstractmethod
+    async def _extend(self, name: str, owner: str, ttl: float) -> bool:
+        """Продлить блокировку owner на ttl секунд. False — блокировка уже не его"""
+
+    async def close(self) -> None:
+        """Закрыть соединения"""
+
+    @asynccontextmanager
+    async def lock(
+        self,
+        name: str,
+        ttl: float = 30.0,
+        wait: float = 30.0,
+        renew: bool = False
+    ) -> AsyncIterator[None]:
+        """
+        Межпроцессная блокировка (single-flight).
+
+        ttl — сколько блокировка живёт, если владелец упал, не освободив её;
+        wait — сколько ждать захвата, после чего поднимается StateLockTimeout;
+        renew — продлевать блокировку, пока блок выполняется: тогда ttl
+        ограничивает только время жизни блокировки упавшего владельца, а не
+        длительность работы под ней.
+        """
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.01
+        while not await self._try_acquire(name, owner, ttl):
+            if time.monotonic() >= deadline:
+                raise StateLockTimeout(f"Timed out waiting for lock '{name}'")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.2)
+        renewer = asyncio.create_task(self._renew(name, owner, ttl)) if renew else None
+        try:
+            yield
+        finally:
+            if renewer is not None:
+                renewer.cancel()
+                await asyncio.gather(renewer, return_exceptions=True)
+            await self._release(name, owner)
+
+    async def _renew(self, name: str, owner: str, ttl: float) -> None:
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self._extend(name, owner, ttl):
+                    logger.warning(f"Lock '{name}' expired before it was released")
+                    return
+            except Exception as e:
+                # Хранилище недоступно — попробуем на следующем круге, пока ttl не истёк
+                logger.warning(f"Failed to extend lock '{name}': {e}")
+
+    async def get_or_set(
+        self,
+        key: str,
+        factory: Callable[[], Awaitable[Any]],
+        ttl: float | None = None,
+        lock_ttl: float = 30.0
+    ) -> Any:
+        """
+        Получить значение из кэша или вычислить его ровно один раз на все воркеры.
+
+        Пока один воркер вычисляет значение, остальные ждут на блокировке и
+        затем читают готовый результат.
+        """
+        value = await self.get(key)
+        if value is not None:
+            return value
+
+        async with self.lock(f"{key}:lock", ttl=lock_ttl, wait=lock_ttl):
+            value = await self.get(key)
+            if value is not None:
+                return value
+            value = await factory()
+            await self.set(key, value, ttl)
+            return value
+
+
+class MemoryStateBackend(StateBackend):
+    """Хранилище в памяти процесса"""
+
+    def __init__(self):
+        self._data: Dict[str, tuple[Any, float | None]] = {}
+        self._locks: Dict[str, tuple[str, float]] = {}
+        self._logs: Dict[str, tuple[int, Deque[tuple[int, Any]], float | None]] = {}
+
+    def _expired(self, expires_at: float | None) -> bool:
+        return expires_at is not None and expires_at <= time.monotonic()
+
+    def _expires_at(self, ttl: float | None) -> float | None:
+        return time.monotonic() + ttl if ttl is not None else None
+
+    async def get(self, key: str) -> Any | None:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if self._expired(expires_at):
+            self._data.pop(key, None)
+            return None
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        self._data[key] = (value, self._expires_at(ttl))
+
+    async def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        if await self.get(key) is not None:
+            return False
+        self._data[key] = (value, self._expires_at(ttl))
+        return True
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def append_log(self, key: str, value: Any, maxlen: int, ttl: float | None = None) -> int:
+        last_id, entries, expires_at = self._logs.get(key, (0, deque(), None))
+        if self._expired(expires_at):
+            entries = deque()
+        last_id += 1
+        entries.append((last_id, value))
+        while len(entries) > maxlen:
+            entries.popleft()
+        self._logs[key] = (last_id, entries, self._expires_at(ttl))
+        return last_id
+
+    async def read_log(self, key: str, after: int = 0) -> List[Tuple[int, Any]]:
+        item = self._logs.get(key)
+        if item is None or self._expired(item[2]):
+            return []
+        return [(entry_id, value) for entry_id, value in item[1] if entry_id > after]
+
+    async def _try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        current = self._locks.get(name)
+        if current is not None and not self._expired(current[1]):
+            return False
+        self._locks[name] = (owner, time.monotonic() + ttl)
+        return True
+
+    async def _release(self, name: str, owner: str) -> None:
+        current = self._locks.get(name)
+        if current is not None and current[0] == owner:
+            del self._locks[name]
+
+    async def _extend(self, name: str, owner: str, ttl: float) -> bool:
+        current = self._locks.get(name)
+        if current is None or current[0] != owner or self._expired(current[1]):
+            return False
+        self._locks[name] = (owner, time.monotonic() + ttl)
+        return True
+
+
+class SQLiteStateBackend(StateBackend):
+    """Хранилище в файле SQLite, общее для всех воркеров на одном хосте"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=5.0, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS logs ("
+            "key TEXT NOT NULL, id INTEGER NOT NULL, value TEXT NOT NULL, expires_at REAL, "
+            "PRIMARY KEY (key, id))"
+        )
+        self._mutex = threading.Lock()
+
+    async def _run(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        def call():
+            with self._mutex:
+                return fn(self._conn)
+        return await asyncio.to_thread(call)
+
+    @staticmethod
+    def _expires_at(ttl: float | None) -> float | None:
+        # Для SQLite нужно время, общее для процессов, поэтому time.time()
+        return time.time() + ttl if ttl is not None else None
+
+    async def get(self, key: str) -> Any | None:
+        def op(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time())
+            ).fetchone()
+        row = await self._run(op)
+        return json.loads(row[0]) if row else None
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        payload = json.dumps(value)
+        expires_at = self._expires_at(ttl)
+        await self._run(lambda conn: conn.execute(
+            "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, payload, expires_at)
+        ))
+
+    async def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        payload = json.dumps(value)
+        expires_at = self._expires_at(ttl)
+
+        def op(conn: sqlite3.Connection) -> bool:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM kv WHERE key = ? AND expires_at <= ?", (key, time.time()))
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, payload, expires_at)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return cursor.rowcount == 1
+
+        return await self._run(op)
+
+    async def delete(self, key: str) -> None:
+        await self._run(lambda conn: conn.execute("DELETE FROM kv WHERE key = ?", (key,)))
+
+    async def append_log(self, key: str, value: Any, maxlen: int, ttl: float | None = None) -> int:
+        payload = json.dumps(value)
+        expires_at = self._expires_at(ttl)
+
+        def op(conn: sqlite3.Connection) -> int:
+            # BEGIN IMMEDIATE упорядочивает запись между процессами: номер и строка появляются вместе
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT MAX(id) FROM logs WHERE key = ?", (key,)).fetchone()
+                entry_id = (row[0] or 0) + 1
+                conn.execute(
+                    "INSERT INTO logs (key, id, value, expires_at) VALUES (?, ?, ?, ?)",
+                    (key, entry_id, payload, expires_at)
+                )
+                # Номер последней записи остаётся, чтобы номера не начались заново
+                conn.execute("DELETE FROM logs WHERE key = ? AND id <= ?", (key, entry_id - maxlen))
+                conn.execute("UPDATE logs SET expires_at = ? WHERE key = ?", (expires_at, key))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return entry_id
+
+        return await self._run(op)
+
+    async def read_log(self, key: str, after: int = 0) -> List[Tuple[int, Any]]:
+        def op(conn: sqlite3.Connection):
+            return conn.execute(
+                "SELECT id, value FROM logs WHERE key = ? AND id > ? AND (expires_at IS NULL OR expires_at > ?) "
+                "ORDER BY id",
+                (key, after, time.time())
+            ).fetchall()
+        rows = await self._run(op)
+        return [(entry_id, json.loads(value)) for entry_id, value in rows]
+
+    async def _try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        def op(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("DELETE FROM locks WHERE name = ? AND expires_at <= ?", (name, now))
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO locks (name, owner, expires_at) VALUES (?, ?, ?)",
+                    (name, owner, now + ttl)
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return cursor.rowcount == 1
+
+        return await self._run(op)
+
+    async def _release(self, name: str, owner: str) -> None:
+        await self._run(lambda conn: conn.execute(
+            "DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner)
+        ))
+
+    async def _extend(self, name: str, owner: str, ttl: float) -> bool:
+        def op(conn: sqlite3.Connection) -> bool:
+            now = time.time()
+            cursor = conn.execute(
+                "UPDATE locks SET expires_at = ? WHERE name = ? AND owner = ? AND expires_at > ?",
+                (now + ttl, name, owner, now)
+            )
+            return cursor.rowcount == 1
+
+        return await self._run(op)
+
+    async def close(self) -> None:
+        await self._run(lambda conn: conn.close())
+
+
+class RedisStateBackend(StateBackend):
+    """
+    Хранилище в Redis (или совместимом сервере).
+
+    Клиент можно передать явно — например, локальную заглушку в тестах.
+    """
+
+    _RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    _EXTEND_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    # Номер и запись появляются атомарно, поэтому в списке записи идут строго по номерам.
+    # Счётчик не истекает вместе со списком: номера не начинаются заново
+    _APPEND_LOG_SCRIPT = """
+    local id = redis.call('incr', KEYS[1])
+    redis.call('rpush', KEYS[2], id .. ':' .. ARGV[1])
+    redis.call('ltrim', KEYS[2], -tonumber(ARGV[2]), -1)
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('pexpire', KEYS[2], ARGV[3])
+    end
+    return id
+    """
+
+    def __init__(self, url: str | None = None, client: Any | None = None, prefix: str = "multibank:"):
+        if client is None:
+            if redis_asyncio is None:
+                raise RuntimeError("STATE_BACKEND=redis requires the 'redis' package")
+            client = redis_asyncio.from_url(url, decode_responses=True)
+        self._client = client
+        self._prefix = prefix
+
+    def _key(self, key: str) -> str:
+        return f"{self._prefix}{key}"
+
+    @staticmethod
+    def _px(ttl: float | None) -> Optional[int]:
+        return max(int(ttl * 1000), 1) if ttl is not None else None
+
+    async def get(self, key: str) -> Any | None:
+        raw = await self._client.get(self._key(key))
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        await self._client.set(self._key(key), json.dumps(value), px=self._px(ttl))
+
+    async def add(self, key: str, value: Any, ttl: float | None = None) -> bool:
+        return bool(await self._client.set(self._key(key), json.dumps(value), px=self._px(ttl), nx=True))
+
+    async def delete(self, key: str) -> None:
+        await self._client.delete(self._key(key))
+
+    async def append_log(self, key: str, value: Any, maxlen: int, ttl: float | None = None) -> int:
+        entry_id = await self._client.eval(
+            self._APPEND_LOG_SCRIPT, 2,
+            self._key(f"log:{key}:seq"), self._key(f"log:{key}"),
+            json.dumps(value), maxlen, self._px(ttl) or 0
+        )
+        return int(entry_id)
+
+    async def read_log(self, key: str, after: int = 0) -> List[Tuple[int, Any]]:
+        entries = []
+        for raw in await self._client.lrange(self._key(f"log:{key}"), 0, -1):
+            entry_id, _, payload = raw.partition(":")
+            if int(entry_id) > after:
+                entries.append((int(entry_id), json.loads(payload)))
+        return entries
+
+    async def _try_acquire(self, name: str, owner: str, ttl: float) -> bool:
+        return bool(await self._client.set(self._key(f"lock:{name}"), owner, px=self._px(ttl), nx=True))
+
+    async def _release(self, name: str, owner: str) -> None:
+        await self._client.eval(self._RELEASE_SCRIPT, 1, self._key(f"lock:{name}"), owner)
+
+    async def _extend(self, name: str, owner: str, ttl: float) -> bool:
+        return bool(await self._client.eval(self._EXTEND_SCRIPT, 1, self._key(f"lock:{name}"), owner, self._px(ttl)))
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+_backend: StateBackend | None = None
+
+
+def create_state_backend(kind: str | None = None) -> StateBackend:
+    """Создать хранилище по настройке STATE_BACKEND"""
+    kind = (kind or settings.STATE_BACKEND).lower()
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "sqlite":
+        return SQLiteStateBackend(settings.STATE_SQLITE_PATH)
+    if kind == "redis":
+        return RedisStateBackend(settings.STATE_REDIS_URL)
+    raise ValueError(f"Unknown STATE_BACKEND: {kind}")
+
+
+def get_state_backend() -> StateBackend:
+    """Общее хранилище состояния процесса"""
+    global _backend
+    if _backend is None:
+        _backend = create_state_backend()
+        logger.info(f"Using state backend: {type(_backend).__name__}")
+    return _backend
+
+
+async def close_state_backend() -> None:
+    """Закрыть хранилище при остановке приложения"""
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
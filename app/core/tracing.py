@@ -0,0 +1,283 @@
+"""
+Трассировка запросов (спаны в формате W3C Trace Context)
+
+Включается настройкой TRACING_ENABLED. Для каждого HTTP-запроса создаётся
+корневой спан обработчика; внутри него — спаны зависимостей и хелперов
+(декоратор traced), каждого SQL-запроса и каждого запроса в банк. В запросы
+к банкам добавляется заголовок traceparent, входящий traceparent продолжает
+трассу клиента.
+
+Завершённые спаны копятся в памяти и раз в TRACING_EXPORT_INTERVAL секунд
+выгружаются фоновой задачей: строками JSON в файл TRACING_EXPORT_PATH и/или
+POST-запросом на TRACING_COLLECTOR_URL.
+
+Спаны создаются только внутри уже начатой трассы, поэтому без
+TRACING_ENABLED (middleware не подключается) каждая точка инструментирования
+стоит одного чтения contextvar.
+"""
+import asyncio
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List
+
+import httpx
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+SPANS_EXPORTED_TOTAL = registry.counter("tracing_spans_exported_total", "Выгруженные спаны")
+SPANS_DROPPED_TOTAL = registry.counter("tracing_spans_dropped_total", "Спаны, не попавшие в выгрузку")
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+SERVER = "server"
+CLIENT = "client"
+INTERNAL = "internal"
+
+
+class Span:
+    """Один участок трассы"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns", "attributes", "status", "error")
+
+    def __init__(self, name: str, kind: str, trace_id: str, parent_id: str | None, attributes: Dict[str, Any] | None = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: int | None = None
+        self.attributes: Dict[str, Any] = dict(attributes or {})
+        self.status = "ok"
+        self.error: str | None = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set_attribute(self, name: str, value: Any) -> None:
+        self.attributes[name] = value
+
+    def record_error(self, error: BaseException | str) -> None:
+        self.status = "error"
+        self.error = error if isinstance(error, str) else f"{type(error).__name__}: {error}"
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            span_exporter.add(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_unix_ns": self.start_ns,
+            "duration_ms": round(((self.end_ns or time.time_ns()) - self.start_ns) / 1e6, 3),
+            "attributes": self.attributes,
+            "status": self.status,
+            "error": self.error,
+        }
+
+
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+def start_child_span(name: str, kind: str = INTERNAL, attributes: Dict[str, Any] | None = None) -> Span | None:
+    """Новый спан внутри текущей трассы (не делая его текущим); None вне трассы"""
+    parent = current_span.get()
+    if parent is None:
+        return None
+    return Span(name, kind, parent.trace_id, parent.span_id, attributes)
+
+
+class _SpanScope:
+    __slots__ = ("span", "token")
+
+    def __init__(self, span: Span):
+        self.span = span
+
+    def __enter__(self) -> Span:
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        current_span.reset(self.token)
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.span.record_error(exc)
+        self.span.end()
+        return False
+
+
+class _NoopScope:
+    __slots__ = ()
+
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NOOP_SCOPE = _NoopScope()
+
+
+def span(name: str, kind: str = INTERNAL, attributes: Dict[str, Any] | None = None):
+    """Контекстный менеджер дочернего спана; вне трассы ничего не делает (отдаёт None)"""
+    child = start_child_span(name, kind, attributes)
+    if child is None:
+        return _NOOP_SCOPE
+    return _SpanScope(child)
+
+
+def traced(name: str | None = None):
+    """Декоратор: выполнять async-функцию в отдельном спане"""
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inject_traceparent(headers: Dict[str, str] | None, span_: Span | None) -> Dict[str, str] | None:
+    """Заголовки исходящего запроса с traceparent (исходный словарь не меняется)"""
+    if span_ is None:
+        return headers
+    return {**(headers or {}), "traceparent": span_.traceparent}
+
+
+def parse_traceparent(value: str | None) -> tuple[str, str, bool] | None:
+    """(trace_id, parent_span_id, sampled) из заголовка traceparent"""
+    if not value:
+        return None
+    match = _TRACEPARENT_RE.match(value.strip().lower())
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+
+
+class SpanExporter:
+    """Буфер завершённых спанов и их выгрузка в файл или коллектор"""
+
+    def __init__(self, max_buffer: int):
+        self._buffer: Deque[Span] = deque(maxlen=max_buffer)
+
+    def add(self, span_: Span) -> None:
+        if len(self._buffer) == self._buffer.maxlen:
+            SPANS_DROPPED_TOTAL.inc()
+        self._buffer.append(span_)
+
+    def drain(self) -> List[Dict[str, Any]]:
+        spans = []
+        while self._buffer:
+            spans.append(self._buffer.popleft().to_dict())
+        return spans
+
+    @staticmethod
+    def _write_file(path: str, spans: List[Dict[str, Any]]) -> None:
+        with open(path, "a", encoding="utf-8") as f:
+            for item in spans:
+                f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+
+    async def flush(self) -> None:
+        spans = self.drain()
+        if not spans:
+            return
+        try:
+            if settings.TRACING_EXPORT_PATH:
+                await asyncio.to_thread(self._write_file, settings.TRACING_EXPORT_PATH, spans)
+            if settings.TRACING_COLLECTOR_URL:
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    response = await client.post(settings.TRACING_COLLECTOR_URL, json={"spans": spans})
+                    response.raise_for_status()
+            SPANS_EXPORTED_TOTAL.inc(len(spans))
+        except Exception as e:
+            SPANS_DROPPED_TOTAL.inc(len(spans))
+            logger.warning(f"Failed to export {len(spans)} spans: {e}")
+
+    async def run(self) -> None:
+        """Периодическая выгрузка; запускается задачей в lifespan"""
+        try:
+            while True:
+                await asyncio.sleep(settings.TRACING_EXPORT_INTERVAL)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+span_exporter = SpanExporter(settings.TRACING_BUFFER_SIZE)
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware: корневой спан обработчика.
+
+    Продолжает входящий traceparent, отвечает заголовком X-Trace-Id.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        incoming = None
+        for name, value in scope.get("headers", ()):
+            if name == b"traceparent":
+                incoming = parse_traceparent(value.decode("latin-1"))
+                break
+        if incoming is not None:
+            trace_id, parent_id, sampled = incoming
+        else:
+            trace_id, parent_id = os.urandom(16).hex(), None
+            sampled = random.random() < settings.TRACING_SAMPLE_RATE
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        root = Span(f"{scope.get('method', '')} {scope.get('path', '')}", SERVER, trace_id, parent_id, {
+            "http.method": scope.get("method"),
+            "http.target": scope.get("path"),
+        })
+        token = current_span.set(root)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                root.set_attribute("http.status_code", message["status"])
+                if message["status"] >= 500:
+                    root.status = "error"
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", trace_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        except Exception as e:
+            root.record_error(e)
+            raise
+        finally:
+            current_span.reset(token)
+            route = scope.get("route")
+            if route is not None:
+                root.name = f"{scope.get('method', '')} {route.path}"
+                root.set_attribute("http.route", route.path)
+            root.end()
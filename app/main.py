@@ -4,12 +4,25 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.responses import HTMLResponse, FileResponse, JSONResponse, PlainTextResponse
 from contextlib import asynccontextmanager
 from app.core.config import settings
-from app.core.database import init_db, engine
-from app.api import auth, banks
-
+from app.core.database import engine, replica_engine, replica_monitor
+from app.core.db_instrumentation import DBStatsMiddleware
+from app.core.metrics import registry
+from app.core.profiling import ProfilingMiddleware
+from app.core.tracing import TracingMiddleware, span_exporter
+from app.core.state import close_state_backend
+from app.core.startup import startup_state, warm_up
+from app.services.bank_health import bank_health
+from app.services.sync_jobs import sync_pool
+from app.services.net_worth import fx_rates
+from app.services.events import event_broker
+from app.services.consents import consent_monitor
+from app.services.bank_service import close_http_clients
+from app.api import admin, auth, banks
+
+import asyncio
 import os
 
 
@@ -19,22 +32,40 @@ async def lifespan(app: FastAPI):
     import logging
     logger = logging.getLogger(__name__)
     
-    try:
-        logger.info("Starting application initialization...")
-        # Инициализация БД
-        await init_db()
-        logger.info("Application initialized successfully")
-    except Exception as e:
-        logger.error(f"Failed to initialize application: {e}")
-        # Не падаем сразу, возможно БД просто еще не готова
-        # При следующем запросе будет повторная попытка
-        pass
+    logger.info("Starting application initialization...")
+    # Прогрев идёт в фоне: /livez отвечает сразу, /readyz — после прогрева
+    warm_up_task = asyncio.create_task(warm_up())
+    health_task = asyncio.create_task(bank_health.run())
+    sync_task = asyncio.create_task(sync_pool.run())
+    fx_task = asyncio.create_task(fx_rates.run())
+    events_task = asyncio.create_task(event_broker.run())
+    consents_task = asyncio.create_task(consent_monitor.run())
+    tracing_task = asyncio.create_task(span_exporter.run()) if settings.TRACING_ENABLED else None
+    replica_task = asyncio.create_task(replica_monitor.run()) if replica_engine is not None else None
     
     yield
     
     # Очистка при остановке
     logger.info("Shutting down application...")
+    if not warm_up_task.done():
+        warm_up_task.cancel()
+    health_task.cancel()
+    fx_task.cancel()
+    events_task.cancel()
+    consents_task.cancel()
+    # Незавершённые задачи синхронизации возвращаются в очередь
+    sync_task.cancel()
+    await asyncio.gather(sync_task, return_exceptions=True)
+    if tracing_task is not None:
+        tracing_task.cancel()
+        await asyncio.gather(tracing_task, return_exceptions=True)
+    if replica_task is not None:
+        replica_task.cancel()
+    await close_http_clients()
     await engine.dispose()
+    if replica_engine is not None:
+        await replica_engine.dispose()
+    await close_state_backend()
     logger.info("Application shut down")
 
 
@@ -55,9 +86,21 @@ app.add_middleware(
     allow_origin_regex=settings.CORS_ORIGIN_REGEX,
 )
 
+# Статистика SQL на запрос
+app.add_middleware(DBStatsMiddleware)
+
+# Профилирование выбранных запросов (по заголовку или выборке)
+if settings.PROFILING_ENABLED:
+    app.add_middleware(ProfilingMiddleware)
+
+# Трассировка: корневой спан на запрос
+if settings.TRACING_ENABLED:
+    app.add_middleware(TracingMiddleware)
+
 # Подключение роутеров
 app.include_router(auth.router)
 app.include_router(banks.router)
+app.include_router(admin.router)
 
 # Статические файлы для фронтенда
 frontend_path = os.path.join(os.path.dirname(__file__), "..", "frontend")
@@ -107,3 +150,28 @@ async def health():
     """Health check endpoint"""
     return {"status": "ok", "version": settings.APP_VERSION}
 
+
+@app.get("/livez")
+async def livez():
+    """Liveness: процесс жив и обрабатывает event loop"""
+    return {"status": "ok", "version": settings.APP_VERSION}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return registry.render()
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: пул БД и пулы банков прогреты, с доступностью каждого банка.
+
+    Сам в банки не ходит; перепроверить доступность — POST /api/admin/banks/reachability.
+    """
+    return JSONResponse(
+        status_code=200 if startup_state.ready else 503,
+        content=startup_state.to_dict()
+    )
+
@@ -1,5 +1,9 @@
 from .user import User
 from .bank_connection import BankConnection
+from .account_directory import AccountDirectoryEntry
+from .transaction import Transaction
+from .sync_job import SyncJob
+from .net_worth import NetWorthTotal, FxRate
 
-__all__ = ["User", "BankConnection"]
+__all__ = ["User", "BankConnection", "AccountDirectoryEntry", "Transaction", "SyncJob", "NetWorthTotal", "FxRate"]
 
@@ -0,0 +1,28 @@
+"""
+Справочник счетов пользователя
+"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, Numeric
+from datetime import datetime
+from app.core.database import Base
+
+
+class AccountDirectoryEntry(Base):
+    """Где живёт счёт: банк, подключение, клиент и согласие для запросов к нему"""
+    __tablename__ = "account_directory"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    account_id = Column(String(100), nullable=False)  # acc-123 (уникален только внутри банка)
+    bank_code = Column(String(50), nullable=False)
+    connection_id = Column(Integer, ForeignKey("bank_connections.id"), nullable=False)
+    client_id = Column(String(100), nullable=True)  # person_id клиента в банке
+    consent_id = Column(String(100), nullable=True)
+    currency = Column(String(10), nullable=True)
+    balance = Column(Numeric(18, 2), nullable=True)  # Последний известный баланс
+    balance_updated_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_account_directory_user_bank_account", "user_id", "bank_code", "account_id", unique=True),
+        Index("ix_account_directory_user_account", "user_id", "account_id"),
+    )
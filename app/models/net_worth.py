@@ -0,0 +1,37 @@
+"""
+Модели сводного баланса пользователя и курсов валют
+"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, Numeric
+from datetime import datetime
+from app.core.database import Base
+
+
+class NetWorthTotal(Base):
+    """Сумма последних известных балансов счетов пользователя в одной валюте"""
+    __tablename__ = "net_worth_totals"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    currency = Column(String(10), nullable=False)
+    total = Column(Numeric(18, 2), nullable=False, default=0)
+    accounts = Column(Integer, nullable=False, default=0)  # счетов с известным балансом
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_net_worth_totals_user_currency", "user_id", "currency", unique=True),
+    )
+
+
+class FxRate(Base):
+    """Курс валюты: сколько единиц базовой валюты стоит единица currency"""
+    __tablename__ = "fx_rates"
+
+    id = Column(Integer, primary_key=True, index=True)
+    base_currency = Column(String(10), nullable=False)
+    currency = Column(String(10), nullable=False)
+    rate = Column(Numeric(20, 10), nullable=False)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_fx_rates_base_currency", "base_currency", "currency", unique=True),
+    )
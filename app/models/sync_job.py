@@ -0,0 +1,51 @@
+"""
+Модели фоновых задач синхронизации с банками
+"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index, text
+from datetime import datetime
+from app.core.database import Base
+
+# Статусы задачи
+SYNC_PENDING = "pending"
+SYNC_RUNNING = "running"
+SYNC_SUCCEEDED = "succeeded"
+SYNC_PARTIAL = "partial"  # часть счетов не синхронизировалась
+SYNC_FAILED = "failed"
+
+SYNC_ACTIVE_STATUSES = (SYNC_PENDING, SYNC_RUNNING)
+
+
+class SyncJob(Base):
+    """Задача полной синхронизации пользователя (или одного банка)"""
+    __tablename__ = "sync_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    bank_code = Column(String(50), nullable=True)  # None — все подключённые банки
+    # Одинаковые незавершённые задачи не дублируются: user_id:bank_code
+    dedupe_key = Column(String(100), nullable=False)
+
+    status = Column(String(20), nullable=False, default=SYNC_PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    total_accounts = Column(Integer, nullable=False, default=0)
+    done_accounts = Column(Integer, nullable=False, default=0)
+    failed_accounts = Column(Integer, nullable=False, default=0)
+    new_transactions = Column(Integer, nullable=False, default=0)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    # Обновляется по ходу выполнения: по нему находят задачи упавших воркеров
+    heartbeat_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index(
+            "uq_sync_jobs_active_dedupe_key",
+            "dedupe_key",
+            unique=True,
+            postgresql_where=text("status IN ('pending', 'running')"),
+            sqlite_where=text("status IN ('pending', 'running')"),
+        ),
+        Index("ix_sync_jobs_status_created", "status", "created_at"),
+    )
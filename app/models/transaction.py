@@ -0,0 +1,36 @@
+"""
+Модели транзакций, полученных из банков
+"""
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Numeric, Index, Boolean
+from datetime import datetime
+from app.core.database import Base
+
+
+class Transaction(Base):
+    """Транзакция счёта, сохранённая при синхронизации с банком"""
+    __tablename__ = "transactions"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    bank_code = Column(String(50), nullable=False)
+    account_id = Column(String(100), nullable=False)
+    transaction_id = Column(String(100), nullable=False)  # Идентификатор в банке
+    
+    amount = Column(Numeric(18, 2), nullable=False)  # Всегда положительная сумма
+    currency = Column(String(10), nullable=True)
+    credit_debit = Column(String(10), nullable=True)  # Credit, Debit
+    status = Column(String(20), nullable=True)
+    booking_date = Column(DateTime, nullable=True)
+    description = Column(Text, nullable=True)
+    
+    # Сверка: перевод между своими счетами (пара списание/зачисление)
+    transfer_group = Column(String(64), nullable=True, index=True)
+    is_internal_transfer = Column(Boolean, default=False, nullable=False)
+    
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_transactions_user_bank_tx", "user_id", "bank_code", "transaction_id", unique=True),
+        Index("ix_transactions_user_booking", "user_id", "booking_date"),
+        Index("ix_transactions_user_created", "user_id", "created_at"),
+    )
@@ -0,0 +1,148 @@
+"""
+Справочник счетов: account_id -> банк, подключение, клиент, согласие
+
+Заполняется при каждом получении счетов из банка, чтобы транзакции можно было
+запрашивать по одному account_id без повторного запроса счетов. Изменения
+балансов сразу учитываются в сводном балансе пользователя (net_worth).
+"""
+from datetime import datetime
+from decimal import Decimal
+from typing import Any, List, Tuple
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import dialect_insert
+from app.models.account_directory import AccountDirectoryEntry
+from app.models.bank_connection import BankConnection
+from app.services.net_worth import CENT, apply_balance_change
+from app.services.normalization import normalize_accounts, normalize_balance
+
+
+async def record_accounts(
+    db: AsyncSession,
+    connection: BankConnection,
+    client_id: str | None,
+    payload: Any
+) -> List[AccountDirectoryEntry]:
+    """
+    Обновить справочник по ответу банка со счетами (commit делает вызывающий).
+
+    Записи вставляются через INSERT ... ON CONFLICT DO UPDATE: параллельные
+    запросы счетов (вкладки, фоновая синхронизация) не создают дубликат и
+    не падают на уникальном индексе.
+    """
+    accounts = {account.account_id: account for account in normalize_accounts(payload)}
+    if not accounts:
+        return []
+
+    # Валюта может смениться у счёта с известным балансом — это нужно учесть
+    # в сводном балансе, поэтому такие записи читаются под блокировкой строки
+    result = await db.execute(
+        select(AccountDirectoryEntry.account_id, AccountDirectoryEntry.currency, AccountDirectoryEntry.balance)
+        .where(
+            AccountDirectoryEntry.user_id == connection.user_id,
+            AccountDirectoryEntry.bank_code == connection.bank_code,
+            AccountDirectoryEntry.account_id.in_(list(accounts)),
+            AccountDirectoryEntry.balance.is_not(None)
+        )
+        .with_for_update()
+    )
+    for account_id, currency, balance in result.all():
+        new_currency = accounts[account_id].currency
+        if new_currency and new_currency != currency:
+            # Баланс без валюты (или в другой валюте) переносится в сводном балансе
+            await apply_balance_change(db, connection.user_id, currency, balance, new_currency, balance)
+
+    now = datetime.utcnow()
+    statement = dialect_insert(db, AccountDirectoryEntry)
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "bank_code", "account_id"],
+        set_={
+            "connection_id": statement.excluded.connection_id,
+            "client_id": func.coalesce(statement.excluded.client_id, AccountDirectoryEntry.client_id),
+            "consent_id": statement.excluded.consent_id,
+            "currency": func.coalesce(statement.excluded.currency, AccountDirectoryEntry.currency),
+            "updated_at": statement.excluded.updated_at,
+        }
+    ).returning(AccountDirectoryEntry)
+    result = await db.scalars(
+        statement,
+        [
+            {
+                "user_id": connection.user_id,
+                "account_id": account_id,
+                "bank_code": connection.bank_code,
+                "connection_id": connection.id,
+                "client_id": client_id,
+                "consent_id": connection.consent_id,
+                "currency": account.currency,
+                "updated_at": now,
+            }
+            for account_id, account in accounts.items()
+        ],
+        execution_options={"populate_existing": True}
+    )
+    return list(result.all())
+
+
+async def resolve_account(
+    db: AsyncSession,
+    user_id: int,
+    account_id: str,
+    bank_code: str | None = None
+) -> List[AccountDirectoryEntry]:
+    """Найти счёт пользователя в справочнике (account_id может повторяться в разных банках)"""
+    query = select(AccountDirectoryEntry).where(
+        AccountDirectoryEntry.user_id == user_id,
+        AccountDirectoryEntry.account_id == account_id
+    )
+    if bank_code:
+        query = query.where(AccountDirectoryEntry.bank_code == bank_code)
+    result = await db.execute(query)
+    return list(result.scalars().all())
+
+
+async def record_balance(
+    db: AsyncSession,
+    entry: AccountDirectoryEntry,
+    payload: Any
+) -> Tuple[Decimal | None, Decimal] | None:
+    """
+    Запомнить баланс счёта из ответа банка и учесть его в сводном балансе (commit делает вызывающий).
+
+    Возвращает (старый, новый) баланс, если он изменился.
+    """
+    balance = normalize_balance(payload)
+    if balance is None:
+        return None
+    # Как в колонке balance — иначе приращения сводного баланса разойдутся с суммой балансов
+    amount = balance.amount.quantize(CENT)
+    # Старый баланс перечитывается под блокировкой строки: параллельный запрос
+    # того же счёта не должен применить то же приращение второй раз
+    result = await db.execute(
+        select(AccountDirectoryEntry.balance, AccountDirectoryEntry.currency)
+        .where(AccountDirectoryEntry.id == entry.id)
+        .with_for_update()
+    )
+    old, old_currency = result.one()
+    currency = balance.currency or old_currency
+    entry.balance = amount
+    entry.balance_updated_at = datetime.utcnow()
+    entry.currency = currency
+    await apply_balance_change(db, entry.user_id, old_currency, old, currency, amount)
+    if old is not None and Decimal(old) == amount:
+        return None
+    return old, amount
+
+
+async def forget_balances(db: AsyncSession, user_id: int, bank_code: str) -> None:
+    """Исключить счета отключённого банка из сводного баланса (commit делает вызывающий)"""
+    result = await db.execute(
+        select(AccountDirectoryEntry).where(
+            AccountDirectoryEntry.user_id == user_id,
+            AccountDirectoryEntry.bank_code == bank_code,
+            AccountDirectoryEntry.balance.isnot(None)
+        ).with_for_update()
+    )
+    for entry in result.scalars().all():
+        await apply_balance_change(db, user_id, entry.currency, entry.balance, None, None)
+        entry.balance = None
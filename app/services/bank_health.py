@@ -0,0 +1,157 @@
+"""
+Фоновая проверка здоровья банков
+
+Каждые BANK_HEALTH_PROBE_INTERVAL секунд воркер делает дешёвый запрос
+(JWKS) в каждый банк из настроек и ведёт экспоненциально сглаженные (EWMA)
+задержку и долю ошибок. По ним вычисляется состояние банка:
+
+- healthy — отвечает быстро и без ошибок;
+- degraded — медленно или с заметной долей ошибок;
+- down — несколько проверок подряд без ответа.
+
+Пакетные запросы сразу пропускают банки в состоянии down, а список банков
+и ответы помечают состояние, чтобы интерфейс не ждал таймаута в 30 секунд.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.services.bank_service import warm_up_bank
+
+logger = logging.getLogger(__name__)
+
+HEALTHY = "healthy"
+DEGRADED = "degraded"
+DOWN = "down"
+UNKNOWN = "unknown"
+
+_STATE_CODES = {HEALTHY: 0, DEGRADED: 1, DOWN: 2, UNKNOWN: -1}
+
+BANK_HEALTH_STATE = registry.gauge(
+    "bank_health_state", "Состояние банка: 0 healthy, 1 degraded, 2 down, -1 unknown", ("bank",)
+)
+BANK_LATENCY_EWMA = registry.gauge("bank_probe_latency_ewma_ms", "Сглаженная задержка проверки банка, мс", ("bank",))
+BANK_ERROR_RATE_EWMA = registry.gauge("bank_probe_error_rate_ewma", "Сглаженная доля неудачных проверок банка", ("bank",))
+
+
+class BankHealth:
+    """Сглаженные показатели и история проверок одного банка"""
+
+    def __init__(self, bank_code: str, history_size: int):
+        self.bank_code = bank_code
+        self.state = UNKNOWN
+        self.latency_ewma_ms: float | None = None
+        self.error_rate_ewma = 0.0
+        self.consecutive_failures = 0
+        self.last_probe_at: datetime | None = None
+        self.last_error: str | None = None
+        self.changed_at: datetime | None = None
+        self.history: Deque[Dict[str, Any]] = deque(maxlen=history_size)
+
+    def observe(self, result: Dict[str, Any]) -> str | None:
+        """Учесть результат проверки; возвращает прежнее состояние, если оно сменилось"""
+        alpha = settings.BANK_HEALTH_EWMA_ALPHA
+        ok = bool(result.get("reachable"))
+        latency = result.get("latency_ms", 0.0)
+        now = datetime.utcnow()
+
+        # Задержку неудачных проверок не учитываем: это время до таймаута
+        if ok:
+            self.latency_ewma_ms = latency if self.latency_ewma_ms is None else (
+                alpha * latency + (1 - alpha) * self.latency_ewma_ms
+            )
+            self.consecutive_failures = 0
+            self.last_error = None
+        else:
+            self.consecutive_failures += 1
+            self.last_error = result.get("error") or f"HTTP {result.get('status_code')}"
+        self.error_rate_ewma = alpha * (0.0 if ok else 1.0) + (1 - alpha) * self.error_rate_ewma
+        self.last_probe_at = now
+        self.history.append({"at": now.isoformat(), "ok": ok, **result})
+
+        previous = self.state
+        self.state = self._evaluate()
+        BANK_HEALTH_STATE.set(_STATE_CODES[self.state], bank=self.bank_code)
+        BANK_ERROR_RATE_EWMA.set(round(self.error_rate_ewma, 4), bank=self.bank_code)
+        if self.latency_ewma_ms is not None:
+            BANK_LATENCY_EWMA.set(round(self.latency_ewma_ms, 1), bank=self.bank_code)
+        if previous != self.state:
+            self.changed_at = now
+            return previous
+        return None
+
+    def _evaluate(self) -> str:
+        if self.consecutive_failures >= settings.BANK_HEALTH_DOWN_AFTER_FAILURES:
+            return DOWN
+        if self.error_rate_ewma >= settings.BANK_HEALTH_DEGRADED_ERROR_RATE:
+            return DEGRADED
+        if self.latency_ewma_ms is not None and self.latency_ewma_ms >= settings.BANK_HEALTH_DEGRADED_LATENCY_MS:
+            return DEGRADED
+        return HEALTHY
+
+    def to_dict(self, with_history: bool = False) -> Dict[str, Any]:
+        data = {
+            "state": self.state,
+            "latency_ewma_ms": round(self.latency_ewma_ms, 1) if self.latency_ewma_ms is not None else None,
+            "error_rate_ewma": round(self.error_rate_ewma, 3),
+            "consecutive_failures": self.consecutive_failures,
+            "last_probe_at": self.last_probe_at.isoformat() if self.last_probe_at else None,
+            "changed_at": self.changed_at.isoformat() if self.changed_at else None,
+            "last_error": self.last_error,
+        }
+        if with_history:
+            data["history"] = list(self.history)
+        return data
+
+
+class BankHealthMonitor:
+    """Периодические проверки всех банков из настроек"""
+
+    def __init__(self):
+        self._banks: Dict[str, BankHealth] = {}
+
+    def _health(self, bank_code: str) -> BankHealth:
+        health = self._banks.get(bank_code)
+        if health is None:
+            health = BankHealth(bank_code, settings.BANK_HEALTH_HISTORY_SIZE)
+            self._banks[bank_code] = health
+        return health
+
+    def state(self, bank_code: str) -> str:
+        health = self._banks.get(bank_code)
+        return health.state if health else UNKNOWN
+
+    def is_down(self, bank_code: str) -> bool:
+        return self.state(bank_code) == DOWN
+
+    async def probe_all(self) -> None:
+        banks = settings.get_banks()
+        results = await asyncio.gather(*(
+            warm_up_bank(config, timeout=settings.BANK_HEALTH_PROBE_TIMEOUT) for config in banks.values()
+        ))
+        for bank_code, result in zip(banks.keys(), results):
+            previous = self._health(bank_code).observe(result)
+            if previous is not None:
+                logger.warning(f"Bank '{bank_code}' health changed: {previous} -> {self._banks[bank_code].state}")
+
+    async def run(self) -> None:
+        """Цикл проверок; запускается задачей в lifespan"""
+        while True:
+            started = time.monotonic()
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Bank health probe failed: {e}")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(settings.BANK_HEALTH_PROBE_INTERVAL - elapsed, 0.0))
+
+    def snapshot(self, with_history: bool = False) -> Dict[str, Dict[str, Any]]:
+        return {code: health.to_dict(with_history) for code, health in self._banks.items()}
+
+
+bank_health = BankHealthMonitor()
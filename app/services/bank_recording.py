@@ -0,0 +1,287 @@
+"""
+Запись и воспроизведение обменов с банками
+
+Для нагрузочных тестов без доступа к песочнице: в режиме записи
+(BANK_RECORD_DIR) каждый запрос к банку и ответ на него сохраняются в архив,
+в режиме воспроизведения (BANK_REPLAY_PATH) ответы берутся из архивов вместо
+сети — приложение целиком работает на реальных по форме и размеру данных.
+
+Архив — zip (deflate), по файлу на обмен в exchanges/ и индекс index.json
+(ключ запроса -> файл, статус, задержка), который пишется при остановке. Без
+индекса (воркер упал) архив читается перебором exchanges/. Каждый воркер
+пишет свой архив: bank-<pid>-<время>.zip.
+
+Секреты в архив не попадают: заголовки авторизации и client_secret в query
+заменяются на REDACTED, токены в JSON-телах — тоже. Ключ запроса (метод,
+URL без секретов, хеш тела) одинаков при записи и воспроизведении.
+
+Воспроизведение детерминировано: n-й запрос с данным ключом получает n-ю
+запись с этим ключом (по кругу), с записанной задержкой, умноженной на
+BANK_REPLAY_LATENCY_SCALE (0 — без задержки). Запрос без записи получает 502.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+from datetime import datetime
+from typing import Any, Dict, List
+from urllib.parse import urlencode
+
+import httpx
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+RECORDED_TOTAL = registry.counter("bank_exchanges_recorded_total", "Записанные обмены с банками")
+REPLAYED_TOTAL = registry.counter("bank_exchanges_replayed_total", "Воспроизведённые обмены с банками", ("result",))
+
+REDACTED = "REDACTED"
+# Заголовки, query-параметры и поля JSON, которые не сохраняются
+SECRET_HEADERS = frozenset({"authorization", "cookie", "set-cookie", "x-admin-token"})
+SECRET_PARAMS = frozenset({"client_secret", "password", "access_token"})
+SECRET_FIELDS = frozenset({"access_token", "refresh_token", "id_token", "client_secret", "password"})
+# Тело хранится раскодированным, поэтому заголовки транспорта не воспроизводятся
+TRANSPORT_HEADERS = frozenset({"content-encoding", "content-length", "transfer-encoding", "connection", "keep-alive"})
+
+
+def _redact_json(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            key: REDACTED if key in SECRET_FIELDS and isinstance(value[key], str) else _redact_json(value[key])
+            for key in value
+        }
+    if isinstance(value, list):
+        return [_redact_json(item) for item in value]
+    return value
+
+
+def _redact_body(content: bytes) -> bytes:
+    """JSON-тело без секретов; не-JSON возвращается как есть"""
+    if not content:
+        return content
+    try:
+        payload = json.loads(content)
+    except ValueError:
+        return content
+    return json.dumps(_redact_json(payload), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _redact_url(url: httpx.URL) -> str:
+    params = sorted(
+        (key, REDACTED if key.lower() in SECRET_PARAMS else value)
+        for key, value in url.params.multi_items()
+    )
+    return str(url.copy_with(query=urlencode(params).encode("ascii") if params else None))
+
+
+def _redact_headers(headers: httpx.Headers) -> List[List[str]]:
+    return [
+        [key, REDACTED if key.lower() in SECRET_HEADERS else value]
+        for key, value in headers.multi_items()
+        if key.lower() not in TRANSPORT_HEADERS
+    ]
+
+
+def exchange_key(request: httpx.Request) -> str:
+    """Ключ запроса: метод, URL без секретов и хеш тела без секретов"""
+    body = _redact_body(request.content)
+    digest = hashlib.sha256(body).hexdigest()[:16] if body else "-"
+    return f"{request.method} {_redact_url(request.url)} {digest}"
+
+
+def _encode_body(content: bytes) -> Dict[str, str]:
+    try:
+        return {"body": content.decode("utf-8")}
+    except UnicodeDecodeError:
+        return {"body_b64": base64.b64encode(content).decode("ascii")}
+
+
+def _decode_body(exchange: Dict[str, Any]) -> bytes:
+    if exchange.get("body_b64") is not None:
+        return base64.b64decode(exchange["body_b64"])
+    return (exchange.get("body") or "").encode("utf-8")
+
+
+class ExchangeRecorder:
+    """Архив записи одного воркера"""
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        name = f"bank-{os.getpid()}-{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}.zip"
+        self.path = os.path.join(directory, name)
+        self._zip = zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED)
+        self._index: List[Dict[str, Any]] = []
+
+    def record(self, request: httpx.Request, response: httpx.Response, latency: float) -> None:
+        if self._zip is None:
+            return
+        seq = len(self._index) + 1
+        filename = f"exchanges/{seq:08d}.json"
+        key = exchange_key(request)
+        request_body = _redact_body(request.content)
+        response_body = _redact_body(response.content)
+        exchange = {
+            "seq": seq,
+            "key": key,
+            "method": request.method,
+            "url": _redact_url(request.url),
+            "request_headers": _redact_headers(request.headers),
+            "request_body": request_body.decode("utf-8", errors="replace") if request_body else None,
+            "status": response.status_code,
+            "response_headers": _redact_headers(response.headers),
+            "latency": round(latency, 6),
+            "recorded_at": datetime.utcnow().isoformat(),
+            **_encode_body(response_body),
+        }
+        # Запись синхронная: режим записи нужен на стенде, а не в продакшене
+        self._zip.writestr(filename, json.dumps(exchange, ensure_ascii=False))
+        self._index.append({
+            "seq": seq,
+            "key": key,
+            "file": filename,
+            "status": response.status_code,
+            "latency": exchange["latency"],
+            "size": len(response_body),
+        })
+        RECORDED_TOTAL.inc()
+
+    def close(self) -> None:
+        """Дописать индекс и закрыть архив"""
+        if self._zip is None:
+            return
+        self._zip.writestr("index.json", json.dumps({"version": 1, "exchanges": self._index}, ensure_ascii=False))
+        self._zip.close()
+        self._zip = None
+        logger.info(f"Recorded {len(self._index)} bank exchanges to {self.path}")
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Транспорт, записывающий каждый обмен с банком"""
+
+    def __init__(self, inner: httpx.AsyncBaseTransport, recorder: ExchangeRecorder):
+        self._inner = inner
+        self._recorder = recorder
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self._inner.handle_async_request(request)
+        # Тело нужно целиком; ответы банков небольшие и всё равно читаются полностью
+        await response.aread()
+        self._recorder.record(request, response, time.perf_counter() - started)
+        return response
+
+    async def aclose(self) -> None:
+        await self._inner.aclose()
+
+
+class ReplayArchive:
+    """Записи из архивов по ключам, в порядке записи"""
+
+    def __init__(self, path: str):
+        if os.path.isdir(path):
+            files = sorted(
+                os.path.join(path, name) for name in os.listdir(path) if name.endswith(".zip")
+            )
+        else:
+            files = [path]
+        self._zips = [zipfile.ZipFile(file) for file in files]
+        self._entries: Dict[str, List[tuple[int, str, float]]] = {}
+        self._cache: Dict[tuple[int, str], Dict[str, Any]] = {}
+        self._occurrences: Dict[str, int] = {}
+        for archive_number, archive in enumerate(self._zips):
+            for item in self._read_index(archive):
+                self._entries.setdefault(item["key"], []).append(
+                    (archive_number, item["file"], float(item.get("latency") or 0.0))
+                )
+        logger.info(
+            f"Loaded {sum(len(items) for items in self._entries.values())} bank exchanges "
+            f"({len(self._entries)} distinct requests) from {len(files)} archive(s)"
+        )
+
+    @staticmethod
+    def _read_index(archive: zipfile.ZipFile) -> List[Dict[str, Any]]:
+        names = set(archive.namelist())
+        if "index.json" in names:
+            return json.loads(archive.read("index.json"))["exchanges"]
+        # Архив без индекса (запись оборвалась) — перебор файлов обменов
+        items = []
+        for name in sorted(name for name in names if name.startswith("exchanges/")):
+            exchange = json.loads(archive.read(name))
+            items.append({"key": exchange["key"], "file": name, "latency": exchange.get("latency")})
+        return items
+
+    def next(self, key: str) -> tuple[Dict[str, Any], float] | None:
+        """Следующая по кругу запись с этим ключом и её задержка (None — записи нет)"""
+        items = self._entries.get(key)
+        if not items:
+            return None
+        occurrence = self._occurrences.get(key, 0)
+        self._occurrences[key] = occurrence + 1
+        archive_number, filename, latency = items[occurrence % len(items)]
+        cache_key = (archive_number, filename)
+        exchange = self._cache.get(cache_key)
+        if exchange is None:
+            exchange = json.loads(self._zips[archive_number].read(filename))
+            self._cache[cache_key] = exchange
+        return exchange, latency
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Транспорт, отвечающий записанными ответами вместо банков"""
+
+    def __init__(self, archive: ReplayArchive, latency_scale: float):
+        self._archive = archive
+        self._latency_scale = latency_scale
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        found = self._archive.next(exchange_key(request))
+        if found is None:
+            REPLAYED_TOTAL.inc(result="miss")
+            return httpx.Response(
+                502,
+                json={"detail": f"No recorded exchange for {request.method} {_redact_url(request.url)}"},
+                request=request
+            )
+        exchange, latency = found
+        if self._latency_scale > 0 and latency > 0:
+            await asyncio.sleep(latency * self._latency_scale)
+        REPLAYED_TOTAL.inc(result="hit")
+        return httpx.Response(
+            exchange["status"],
+            headers=[(key, value) for key, value in exchange["response_headers"]],
+            content=_decode_body(exchange),
+            request=request
+        )
+
+
+_recorder: ExchangeRecorder | None = None
+_replay_archive: ReplayArchive | None = None
+
+
+def bank_transport(limits: httpx.Limits) -> httpx.AsyncBaseTransport | None:
+    """Транспорт для HTTP-клиентов банков по настройкам записи/воспроизведения (None — обычный)"""
+    global _recorder, _replay_archive
+    if settings.BANK_REPLAY_PATH:
+        if _replay_archive is None:
+            _replay_archive = ReplayArchive(settings.BANK_REPLAY_PATH)
+        # Архив (и счётчики повторов) общий: пересозданный клиент продолжает ту же последовательность
+        return ReplayTransport(_replay_archive, settings.BANK_REPLAY_LATENCY_SCALE)
+    if settings.BANK_RECORD_DIR:
+        if _recorder is None:
+            _recorder = ExchangeRecorder(settings.BANK_RECORD_DIR)
+        return RecordingTransport(httpx.AsyncHTTPTransport(limits=limits), _recorder)
+    return None
+
+
+def close_recorder() -> None:
+    """Дописать индекс архива записи (при остановке)"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
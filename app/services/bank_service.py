@@ -1,37 +1,250 @@
 """
 Сервис для работы с банковскими API
 """
+import asyncio
+import hashlib
+import time
 import httpx
 from typing import Dict, Any
+from app.core.config import settings
+from app.core.profiling import JSON_DECODE, RATE_LIMIT_WAIT, UPSTREAM, profile_section
+from app.core.state import get_state_backend
+from app.core.tracing import CLIENT, inject_traceparent, span
+from app.services.rate_limiter import (
+    rate_limiter,
+    BankRateLimitExceeded,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_NAMES,
+)
+from app.services.concurrency_limiter import concurrency_limiter
+from app.services.single_flight import single_flight
+from app.services.bank_recording import bank_transport, close_recorder
+
+# Запас до истечения банковского токена, после которого кэш считается устаревшим
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+# Общие HTTP-клиенты (пулы keep-alive соединений) по origin банка
+_http_clients: Dict[str, httpx.AsyncClient] = {}
+
+
+def get_http_client(url: str) -> httpx.AsyncClient:
+    """Общий HTTP-клиент для хоста банка"""
+    parsed = httpx.URL(url)
+    origin = f"{parsed.scheme}://{parsed.netloc.decode('ascii')}"
+    client = _http_clients.get(origin)
+    if client is None or client.is_closed:
+        limits = httpx.Limits(
+            max_connections=settings.BANK_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.BANK_HTTP_MAX_KEEPALIVE
+        )
+        client = httpx.AsyncClient(
+            timeout=30.0,
+            limits=limits,
+            # Запись или воспроизведение обменов с банками (BANK_RECORD_DIR / BANK_REPLAY_PATH)
+            transport=bank_transport(limits)
+        )
+        _http_clients[origin] = client
+    return client
+
+
+async def close_http_clients() -> None:
+    """Закрыть все пулы соединений к банкам"""
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+    close_recorder()
+
+
+async def warm_up_bank(bank_config: Dict[str, str], timeout: float = 5.0) -> Dict[str, Any]:
+    """
+    Прогреть пул соединений к банку дешёвым запросом (JWKS).
+
+    Возвращает доступность банка и задержку ответа.
+    """
+    url = bank_config.get("well_known_url") or bank_config["base_url"]
+    started = time.perf_counter()
+    try:
+        response = await get_http_client(url).get(url, timeout=timeout)
+        return {
+            "reachable": response.status_code < 500,
+            "status_code": response.status_code,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+    except httpx.HTTPError as e:
+        return {
+            "reachable": False,
+            "error": f"{type(e).__name__}: {e}",
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+
+
+def connection_bank_config(bank_code: str, connection: Any = None) -> Dict[str, str] | None:
+    """Настройки банка с командными client_id/secret подключения (None — банк неизвестен)"""
+    banks = settings.get_banks()
+    if bank_code not in banks:
+        return None
+
+    bank_config = banks[bank_code].copy()
+    if connection:
+        if connection.team_client_id:
+            bank_config["client_id"] = connection.team_client_id
+        if connection.team_client_secret:
+            bank_config["client_secret"] = connection.team_client_secret
+    return bank_config
 
 
 class BankService:
     """Сервис для взаимодействия с банковским API"""
     
-    def __init__(self, bank_config: Dict[str, str]):
+    def __init__(
+        self,
+        bank_config: Dict[str, str],
+        bank_code: str | None = None,
+        priority: str = "interactive"
+    ):
         self.config = bank_config
         self.base_url = bank_config["base_url"]
+        self.bank_code = bank_code or self.base_url
         self.client_id = bank_config.get("client_id")
         self.client_secret = bank_config.get("client_secret")
+        self.priority = PRIORITY_NAMES.get(priority, PRIORITY_INTERACTIVE)
     
-    async def get_bank_token(self) -> Dict[str, Any]:
-        """Получить токен от банка"""
-        if not self.client_id or not self.client_secret:
-            raise Exception("Bank credentials are not configured")
+    async def _request(self, method: str, url: str, endpoint: str, attempt: int = 1, **kwargs) -> httpx.Response:
+        """
+        Выполнить запрос к банку через общий пул соединений с учётом квоты команды.
+
+        endpoint — имя эндпоинта без идентификаторов (например, "transactions"):
+        по нему адаптивный лимит считает базовую задержку. attempt — номер
+        попытки для трассы: сам _request не повторяет запросы (429 уходит
+        вызывающему вместе с Retry-After), повтор — решение вызывающего.
+        """
+        with span("bank.rate_limit_wait") as trace:
+            if trace is not None:
+                trace.attributes.update({"bank.code": self.bank_code, "bank.priority": self.priority})
+            with profile_section(RATE_LIMIT_WAIT, self.bank_code):
+                await rate_limiter.acquire(self.bank_code, self.client_id, self.priority)
+        with span("bank.request", CLIENT) as trace:
+            if trace is not None:
+                trace.attributes.update({
+                    "bank.code": self.bank_code,
+                    "bank.endpoint": httpx.URL(url).path,
+                    "bank.route": endpoint,
+                    "bank.attempt": attempt,
+                    "http.method": method,
+                    "http.url": url,
+                })
+                # Банк (или его шлюз) может продолжить нашу трассу
+                kwargs["headers"] = inject_traceparent(kwargs.get("headers"), trace)
+            # Адаптивный лимит одновременных запросов к банку
+            async with concurrency_limiter.slot(self.bank_code, endpoint, self.priority) as outcome:
+                with profile_section(UPSTREAM, f"{method} {url}"):
+                    response = await get_http_client(url).request(method, url, **kwargs)
+                outcome.failed = response.status_code == 429 or response.status_code >= 500
+            retry_after = None
+            if response.status_code == 429:
+                try:
+                    retry_after = float(response.headers.get("Retry-After", 1))
+                except ValueError:
+                    retry_after = 1.0
+            if trace is not None:
+                trace.set_attribute("http.status_code", response.status_code)
+                if retry_after is not None:
+                    # Квота команды будет заблокирована на это время (penalize ниже)
+                    trace.set_attribute("bank.retry_after", retry_after)
+                if response.status_code >= 400:
+                    trace.status = "error"
+        if retry_after is not None:
+            rate_limiter.penalize(self.bank_code, self.client_id, retry_after)
+            raise BankRateLimitExceeded(
+                f"Bank '{self.bank_code}' rate limit exceeded",
+                retry_after=retry_after
+            )
+        return response
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                self.config["auth_url"],
-                params={
-                    "client_id": self.client_id,
-                    "client_secret": self.client_secret
-                },
+    async def _get_json(
+        self,
+        url: str,
+        headers: Dict[str, str] | None,
+        params: Dict[str, str] | None,
+        error_message: str,
+        endpoint: str
+    ) -> Any:
+        """GET к банку; одинаковые одновременные запросы объединяются в один"""
+        async def fetch():
+            response = await self._request(
+                "GET",
+                url,
+                endpoint,
+                headers=headers,
+                params=params,
                 timeout=30.0
             )
             
             if response.status_code != 200:
-                raise Exception(f"Failed to get token: {response.status_code} - {response.text}")
+                raise Exception(f"{error_message}: {response.status_code} - {response.text}")
             
+            with profile_section(JSON_DECODE, self.bank_code):
+                return response.json()
+
+        key = (
+            self.bank_code,
+            url,
+            tuple(sorted((params or {}).items())),
+            tuple(sorted((headers or {}).items())),
+        )
+        return await single_flight.do(key, fetch, label=self.bank_code)
+
+    def _token_cache_key(self) -> str:
+        raw = f"{self.config['auth_url']}|{self.client_id}|{self.client_secret}"
+        return f"bank-token:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+    async def get_bank_token(self, force_refresh: bool = False) -> Dict[str, Any]:
+        """
+        Получить токен от банка (общий кэш на все воркеры).
+
+        force_refresh — не брать токен из кэша (например, он уже истёк по exp).
+        """
+        if not self.client_id or not self.client_secret:
+            raise Exception("Bank credentials are not configured")
+
+        state = get_state_backend()
+        cache_key = self._token_cache_key()
+        if not force_refresh:
+            cached = await state.get(cache_key)
+            if cached is not None:
+                return cached
+
+        # Один воркер ходит за токеном, остальные ждут и берут его из кэша
+        async with state.lock(f"{cache_key}:lock", ttl=35.0, wait=35.0):
+            cached = await state.get(cache_key)
+            if cached is not None and not force_refresh:
+                return cached
+
+            token_data = await self._fetch_bank_token()
+            ttl = settings.BANK_TOKEN_CACHE_TTL
+            expires_in = token_data.get("expires_in")
+            if isinstance(expires_in, (int, float)):
+                ttl = min(ttl, expires_in - TOKEN_EXPIRY_MARGIN_SECONDS)
+            if ttl > 0:
+                await state.set(cache_key, token_data, ttl)
+            return token_data
+
+    async def _fetch_bank_token(self) -> Dict[str, Any]:
+        response = await self._request(
+            "POST",
+            self.config["auth_url"],
+            "token",
+            params={
+                "client_id": self.client_id,
+                "client_secret": self.client_secret
+            },
+            timeout=30.0
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"Failed to get token: {response.status_code} - {response.text}")
+        
+        with profile_section(JSON_DECODE, self.bank_code):
             return response.json()
     
     async def get_accounts(
@@ -53,18 +266,13 @@ class BankService:
         if consent_id:
             headers["X-Consent-Id"] = consent_id
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/accounts",
-                headers=headers,
-                params=params or None,
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Failed to get accounts: {response.status_code} - {response.text}")
-            
-            return response.json()
+        return await self._get_json(
+            f"{self.base_url}/accounts",
+            headers=headers,
+            params=params or None,
+            error_message="Failed to get accounts",
+            endpoint="accounts"
+        )
     
     async def get_transactions(
         self,
@@ -89,18 +297,41 @@ class BankService:
         if client_id:
             params["client_id"] = client_id
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/accounts/{account_id}/transactions",
-                headers=headers,
-                params=params or None,
-                timeout=30.0
-            )
-            
-            if response.status_code != 200:
-                raise Exception(f"Failed to get transactions: {response.status_code} - {response.text}")
-            
-            return response.json()
+        return await self._get_json(
+            f"{self.base_url}/accounts/{account_id}/transactions",
+            headers=headers,
+            params=params or None,
+            error_message="Failed to get transactions",
+            endpoint="transactions"
+        )
+    
+    async def get_balances(
+        self,
+        access_token: str,
+        account_id: str,
+        requesting_bank: str | None = None,
+        client_id: str | None = None,
+        consent_id: str | None = None
+    ) -> Dict[str, Any]:
+        """Получить балансы счёта"""
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "X-Requesting-Bank": requesting_bank or self.client_id or ""
+        }
+        if consent_id:
+            headers["X-Consent-Id"] = consent_id
+
+        params = {}
+        if client_id:
+            params["client_id"] = client_id
+
+        return await self._get_json(
+            f"{self.base_url}/accounts/{account_id}/balances",
+            headers=headers,
+            params=params or None,
+            error_message="Failed to get balances",
+            endpoint="balances"
+        )
     
     async def create_consent(
         self,
@@ -111,29 +342,50 @@ class BankService:
         requesting_bank_name: str | None = None
     ) -> Dict[str, Any]:
         """Создать согласие для доступа к данным"""
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/account-consents/request",
-                headers={
-                    "Authorization": f"Bearer {access_token}",
-                    "X-Requesting-Bank": requesting_bank or self.client_id or "",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "client_id": client_id,
-                    "permissions": permissions,
-                    "reason": "Мультибанковское приложение",
-                    "requesting_bank": requesting_bank or self.client_id,
-                    "requesting_bank_name": requesting_bank_name or "Мультибанк"
-                },
-                timeout=30.0
-            )
-            
-            if response.status_code not in [200, 201]:
-                raise Exception(f"Failed to create consent: {response.status_code} - {response.text}")
-            
+        response = await self._request(
+            "POST",
+            f"{self.base_url}/account-consents/request",
+            "consent",
+            headers={
+                "Authorization": f"Bearer {access_token}",
+                "X-Requesting-Bank": requesting_bank or self.client_id or "",
+                "Content-Type": "application/json"
+            },
+            json={
+                "client_id": client_id,
+                "permissions": permissions,
+                "reason": "Мультибанковское приложение",
+                "requesting_bank": requesting_bank or self.client_id,
+                "requesting_bank_name": requesting_bank_name or "Мультибанк"
+            },
+            timeout=30.0
+        )
+        
+        if response.status_code not in [200, 201]:
+            raise Exception(f"Failed to create consent: {response.status_code} - {response.text}")
+        
+        with profile_section(JSON_DECODE, self.bank_code):
             return response.json()
 
+    async def get_consent(
+        self,
+        consent_id: str,
+        access_token: str,
+        requesting_bank: str | None = None
+    ) -> Dict[str, Any]:
+        """Получить согласие (в том числе его текущий статус)"""
+        headers = {
+            "Authorization": f"Bearer {access_token}",
+            "X-Requesting-Bank": requesting_bank or self.client_id or ""
+        }
+        return await self._get_json(
+            f"{self.base_url}/account-consents/{consent_id}",
+            headers=headers,
+            params=None,
+            error_message="Failed to get consent",
+            endpoint="consent_status"
+        )
+
     async def get_clients(
         self,
         access_token: str | None = None,
@@ -146,15 +398,11 @@ class BankService:
         if requesting_bank or self.client_id:
             headers["X-Requesting-Bank"] = requesting_bank or self.client_id or ""
 
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/banker/clients",
-                headers=headers or None,
-                timeout=30.0
-            )
-
-            if response.status_code != 200:
-                raise Exception(f"Failed to get clients: {response.status_code} - {response.text}")
-
-            return response.json()
+        return await self._get_json(
+            f"{self.base_url}/banker/clients",
+            headers=headers or None,
+            params=None,
+            error_message="Failed to get clients",
+            endpoint="clients"
+        )
 
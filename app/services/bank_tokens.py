@@ -0,0 +1,207 @@
+"""
+Токены банков: JWKS и локальная проверка
+
+У каждого банка в настройках есть well_known_url с набором ключей (JWKS).
+Ключи загружаются один раз и кэшируются на BANK_JWKS_CACHE_TTL секунд; если
+токен подписан ключом с неизвестным kid (банк сменил ключи), набор
+перезагружается, но не чаще раза в BANK_JWKS_MIN_REFRESH_INTERVAL секунд,
+чтобы поток токенов с чужим kid не превратился в поток запросов к банку.
+
+Подпись токена проверяется локально, а из проверенного exp берётся реальный
+срок жизни — он сохраняется в BankConnection.token_expires_at. Истёкший
+токен обновляется до запроса в банк, а не после гарантированного 401.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict
+
+from jose import JWTError, jwt
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.models.bank_connection import BankConnection
+from app.services.bank_service import (
+    BankService,
+    TOKEN_EXPIRY_MARGIN_SECONDS,
+    connection_bank_config,
+    get_http_client,
+)
+
+logger = logging.getLogger(__name__)
+
+JWKS_FETCH_TOTAL = registry.counter("bank_jwks_fetch_total", "Загрузки JWKS банков", ("bank", "result"))
+TOKEN_VERIFY_TOTAL = registry.counter("bank_token_verify_total", "Локальные проверки токенов банков", ("bank", "result"))
+TOKEN_REFRESH_TOTAL = registry.counter("bank_token_refresh_total", "Обновления истёкших токенов подключений", ("bank",))
+
+
+class BankTokenInvalid(Exception):
+    """Токен банка не прошёл проверку подписи"""
+
+
+class BankTokenUnverifiable(Exception):
+    """Токен нельзя проверить локально: не JWT, нет JWKS или ключа с таким kid"""
+
+
+class JWKSClient:
+    """Кэш наборов ключей банков"""
+
+    def __init__(self):
+        self._keys: Dict[str, Dict[str | None, Dict[str, Any]]] = {}
+        self._fetched_at: Dict[str, float] = {}
+        self._attempted_at: Dict[str, float] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _can_refresh(self, bank_code: str) -> bool:
+        attempted = self._attempted_at.get(bank_code)
+        return attempted is None or time.monotonic() - attempted >= settings.BANK_JWKS_MIN_REFRESH_INTERVAL
+
+    def _is_stale(self, bank_code: str) -> bool:
+        fetched = self._fetched_at.get(bank_code)
+        return fetched is None or time.monotonic() - fetched >= settings.BANK_JWKS_CACHE_TTL
+
+    async def _refresh(self, bank_code: str) -> None:
+        bank_config = settings.get_banks().get(bank_code) or {}
+        url = bank_config.get("well_known_url")
+        self._attempted_at[bank_code] = time.monotonic()
+        if not url:
+            return
+        try:
+            response = await get_http_client(url).get(url, timeout=10.0)
+            response.raise_for_status()
+            keys = response.json().get("keys") or []
+        except Exception as e:
+            JWKS_FETCH_TOTAL.inc(bank=bank_code, result="error")
+            logger.warning(f"Failed to fetch JWKS of bank '{bank_code}': {e}")
+            return
+        self._keys[bank_code] = {key.get("kid"): key for key in keys if isinstance(key, dict)}
+        self._fetched_at[bank_code] = time.monotonic()
+        JWKS_FETCH_TOTAL.inc(bank=bank_code, result="ok")
+
+    def _lookup(self, bank_code: str, kid: str | None) -> Dict[str, Any] | None:
+        keys = self._keys.get(bank_code) or {}
+        if kid is None and len(keys) == 1:
+            # Токен без kid при единственном ключе в наборе
+            return next(iter(keys.values()))
+        return keys.get(kid)
+
+    async def get_key(self, bank_code: str, kid: str | None) -> Dict[str, Any] | None:
+        """Ключ банка по kid; неизвестный kid вызывает перезагрузку набора (с ограничением частоты)"""
+        key = self._lookup(bank_code, kid)
+        if key is not None and not self._is_stale(bank_code):
+            return key
+
+        lock = self._locks.setdefault(bank_code, asyncio.Lock())
+        async with lock:
+            # Пока ждали, набор мог перезагрузить другой запрос
+            key = self._lookup(bank_code, kid)
+            if (key is None or self._is_stale(bank_code)) and self._can_refresh(bank_code):
+                await self._refresh(bank_code)
+                key = self._lookup(bank_code, kid)
+        return key
+
+
+jwks_client = JWKSClient()
+
+
+async def verify_bank_token(bank_code: str, token: str) -> Dict[str, Any]:
+    """
+    Проверить подпись токена банка по его JWKS и вернуть claims.
+
+    Срок действия не проверяется — им распоряжается вызывающий (exp в claims).
+    """
+    try:
+        header = jwt.get_unverified_header(token)
+    except JWTError as e:
+        TOKEN_VERIFY_TOTAL.inc(bank=bank_code, result="unverifiable")
+        raise BankTokenUnverifiable(f"Bank '{bank_code}' token is not a JWT: {e}")
+
+    algorithm = header.get("alg")
+    # Симметричные алгоритмы и "none" не принимаются: ключ из JWKS публичный
+    if algorithm not in settings.BANK_TOKEN_ALGORITHMS:
+        TOKEN_VERIFY_TOTAL.inc(bank=bank_code, result="invalid")
+        raise BankTokenInvalid(f"Bank '{bank_code}' token uses unsupported algorithm '{algorithm}'")
+
+    key = await jwks_client.get_key(bank_code, header.get("kid"))
+    if key is None:
+        TOKEN_VERIFY_TOTAL.inc(bank=bank_code, result="unverifiable")
+        raise BankTokenUnverifiable(f"No JWKS key '{header.get('kid')}' for bank '{bank_code}'")
+
+    try:
+        claims = jwt.decode(
+            token,
+            key,
+            algorithms=[algorithm],
+            options={"verify_aud": False, "verify_exp": False}
+        )
+    except JWTError as e:
+        TOKEN_VERIFY_TOTAL.inc(bank=bank_code, result="invalid")
+        raise BankTokenInvalid(f"Bank '{bank_code}' token signature is invalid: {e}")
+    TOKEN_VERIFY_TOTAL.inc(bank=bank_code, result="valid")
+    return claims
+
+
+async def bank_token_expiry(bank_code: str, token_data: Dict[str, Any]) -> datetime | None:
+    """
+    Когда истекает токен банка (naive UTC).
+
+    Приоритет у exp из локально проверенного токена; если проверить нельзя —
+    expires_in из ответа банка; иначе срок неизвестен (None).
+    """
+    token = token_data.get("access_token")
+    if token:
+        try:
+            claims = await verify_bank_token(bank_code, token)
+        except BankTokenUnverifiable:
+            claims = None
+        except BankTokenInvalid as e:
+            logger.warning(str(e))
+            claims = None
+        exp = claims.get("exp") if claims else None
+        if isinstance(exp, (int, float)):
+            return datetime.fromtimestamp(exp, timezone.utc).replace(tzinfo=None)
+
+    expires_in = token_data.get("expires_in")
+    if isinstance(expires_in, (int, float)):
+        return datetime.utcnow() + timedelta(seconds=expires_in)
+    return None
+
+
+def token_expired(connection: BankConnection) -> bool:
+    """Истёк ли (или вот-вот истечёт) токен подключения"""
+    expires_at = connection.token_expires_at
+    if expires_at is None:
+        return False
+    return datetime.utcnow() >= expires_at - timedelta(seconds=TOKEN_EXPIRY_MARGIN_SECONDS)
+
+
+async def ensure_fresh_token(connection: BankConnection) -> bool:
+    """
+    Обновить токен подключения, если он истёк (commit делает вызывающий).
+
+    Подключения, у которых срок неизвестен, проверяются по JWKS, чтобы
+    заполнить token_expires_at. Возвращает True, если токен обновлён.
+    """
+    if connection.token_expires_at is None and connection.access_token:
+        expires_at = await bank_token_expiry(connection.bank_code, {"access_token": connection.access_token})
+        # Неизвестный срок не записывается: подключение не становится изменённым на каждом запросе
+        if expires_at is not None:
+            connection.token_expires_at = expires_at
+    if not token_expired(connection):
+        return False
+
+    bank_config = connection_bank_config(connection.bank_code, connection)
+    if bank_config is None:
+        raise Exception(f"Bank '{connection.bank_code}' not found")
+    service = BankService(bank_config, bank_code=connection.bank_code)
+    expired_token = connection.access_token
+    # Токен из общего кэша может оказаться тем же истёкшим — тогда запросить новый
+    token_data = await service.get_bank_token()
+    if token_data.get("access_token") == expired_token:
+        token_data = await service.get_bank_token(force_refresh=True)
+
+    connection.access_token = token_data["access_token"]
+    connection.token_expires_at = await bank_token_expiry(connection.bank_code, token_data)
+    TOKEN_REFRESH_TOTAL.inc(bank=connection.bank_code)
+    return True
@@ -0,0 +1,245 @@
+"""
+Адаптивное ограничение одновременных запросов к банку (AIMD)
+
+Для каждого банка держится лимит запросов «в полёте». Пока банк отвечает
+без ошибок и без роста задержки, лимит растёт примерно на единицу за каждые
+limit успешных ответов (аддитивно). Ошибка, таймаут, 429/5xx или задержка
+выше BANK_CONCURRENCY_LATENCY_TOLERANCE × базовой уменьшают лимит в
+BANK_CONCURRENCY_BACKOFF раз (мультипликативно), не чаще раза за базовую
+задержку, чтобы одна волна ошибок не обрушила лимит до минимума.
+
+Базовая задержка считается отдельно для каждого эндпоинта банка: выписка
+по счёту всегда отвечает медленнее списка счетов, и общая на банк базовая
+задержка (минимум по быстрым эндпоинтам) принимала бы обычные медленные
+ответы за перегрузку.
+
+Запросы сверх лимита ждут в очереди ограниченное время (фоновые — дольше) и
+затем отклоняются BankConcurrencyLimitExceeded: при перегрузке банка лучше
+быстро ответить 503, чем копить запросы до таймаута в 30 секунд.
+
+Как и квоты, лимит считается на воркер.
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Tuple
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.services.rate_limiter import BankRateLimitExceeded, PRIORITY_INTERACTIVE
+
+CONCURRENCY_LIMIT = registry.gauge("bank_concurrency_limit", "Текущий адаптивный лимит одновременных запросов к банку", ("bank",))
+IN_FLIGHT = registry.gauge("bank_concurrency_in_flight", "Запросы к банку в полёте", ("bank",))
+BASELINE_LATENCY = registry.gauge(
+    "bank_concurrency_baseline_latency_ms", "Базовая задержка эндпоинта банка для лимитера, мс", ("bank", "endpoint")
+)
+SHED_TOTAL = registry.counter("bank_concurrency_shed_total", "Запросы, отклонённые лимитом одновременности", ("bank", "priority"))
+LIMIT_DECREASES_TOTAL = registry.counter("bank_concurrency_decreases_total", "Снижения лимита", ("bank", "reason"))
+
+
+class BankConcurrencyLimitExceeded(BankRateLimitExceeded):
+    """Банк перегружен: лимит одновременных запросов занят и не освободился вовремя"""
+
+
+class LatencyBaseline:
+    """
+    Базовая задержка эндпоинта — минимальная за окно, как min RTT в TCP Vegas/BBR.
+
+    Сглаженное среднее под постоянной нагрузкой подтягивалось бы к задержке
+    с очередью, и лимит рос бы без конца; минимум за окно держится около
+    задержки без нагрузки и всё же следует за ней, если эндпоинт
+    действительно стал медленнее.
+    """
+
+    def __init__(self):
+        self.value: float | None = None
+        # Минимальная задержка по секундам за окно BANK_CONCURRENCY_BASELINE_WINDOW
+        self._minimums: Deque[Tuple[int, float]] = deque()
+
+    def record(self, latency: float, now: float) -> None:
+        second = int(now)
+        if self._minimums and self._minimums[-1][0] == second:
+            if latency < self._minimums[-1][1]:
+                self._minimums[-1] = (second, latency)
+        else:
+            self._minimums.append((second, latency))
+        window_start = now - settings.BANK_CONCURRENCY_BASELINE_WINDOW
+        while self._minimums[0][0] < window_start:
+            self._minimums.popleft()
+        self.value = min(value for _, value in self._minimums)
+
+
+class AdaptiveLimit:
+    """AIMD-лимит одновременных запросов к одному банку"""
+
+    def __init__(self, bank: str):
+        self.bank = bank
+        self.limit = float(settings.BANK_CONCURRENCY_INITIAL_LIMIT)
+        self.in_flight = 0
+        self._baselines: Dict[str, LatencyBaseline] = {}
+        self._last_decrease = 0.0
+        self._waiters: Deque[Tuple[int, asyncio.Future]] = deque()
+        self._publish()
+
+    def _publish(self) -> None:
+        CONCURRENCY_LIMIT.set(round(self.limit, 2), bank=self.bank)
+        IN_FLIGHT.set(self.in_flight, bank=self.bank)
+
+    def baseline_latency(self, endpoint: str) -> float | None:
+        baseline = self._baselines.get(endpoint)
+        return baseline.value if baseline is not None else None
+
+    def _slowest_baseline(self) -> float:
+        return max((baseline.value or 0.0 for baseline in self._baselines.values()), default=0.0)
+
+    def _has_capacity(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    async def acquire(self, priority: int) -> None:
+        if self._has_capacity() and not self._waiters:
+            self.in_flight += 1
+            self._publish()
+            return
+
+        priority_name = "interactive" if priority == PRIORITY_INTERACTIVE else "background"
+        if len(self._waiters) >= settings.BANK_CONCURRENCY_QUEUE_SIZE:
+            SHED_TOTAL.inc(bank=self.bank, priority=priority_name)
+            raise self._overloaded()
+
+        max_wait = (
+            settings.BANK_CONCURRENCY_MAX_WAIT if priority == PRIORITY_INTERACTIVE
+            else settings.BANK_CONCURRENCY_BACKGROUND_MAX_WAIT
+        )
+        future = asyncio.get_running_loop().create_future()
+        waiter = (priority, future)
+        # Интерактивные запросы встают перед фоновыми
+        if priority == PRIORITY_INTERACTIVE:
+            position = next((i for i, (p, _) in enumerate(self._waiters) if p > priority), len(self._waiters))
+            self._waiters.insert(position, waiter)
+        else:
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout=max_wait)
+        except asyncio.TimeoutError:
+            self._discard(waiter)
+            SHED_TOTAL.inc(bank=self.bank, priority=priority_name)
+            raise self._overloaded()
+        except asyncio.CancelledError:
+            self._discard(waiter)
+            if future.done() and not future.cancelled():
+                # Место уже было выдано, но запрос отменили — вернуть его
+                self.abandon()
+            raise
+
+    def _discard(self, waiter: Tuple[int, asyncio.Future]) -> None:
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+    def _overloaded(self) -> BankConcurrencyLimitExceeded:
+        return BankConcurrencyLimitExceeded(
+            f"Bank '{self.bank}' is overloaded: {self.in_flight} requests in flight, limit {int(self.limit)}",
+            retry_after=max(self._slowest_baseline(), 1.0)
+        )
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self._has_capacity():
+            _, future = self._waiters.popleft()
+            if future.done():
+                continue
+            # Место передаётся ожидающему сразу, чтобы новый запрос его не перехватил
+            self.in_flight += 1
+            future.set_result(True)
+
+    def abandon(self) -> None:
+        """Вернуть место, не делая выводов о банке (запрос отменён)"""
+        self.in_flight -= 1
+        self._wake_waiters()
+        self._publish()
+
+    def release(self, endpoint: str, latency: float, failed: bool) -> None:
+        """Вернуть место и скорректировать лимит по результату запроса к эндпоинту"""
+        self.in_flight -= 1
+        now = time.monotonic()
+        baseline = self._baselines.get(endpoint)
+        if baseline is None:
+            baseline = self._baselines[endpoint] = LatencyBaseline()
+
+        # Задержка сравнивается с базовой того же эндпоинта
+        overloaded_by_latency = (
+            not failed
+            and baseline.value is not None
+            and latency > baseline.value * settings.BANK_CONCURRENCY_LATENCY_TOLERANCE
+        )
+        if failed or overloaded_by_latency:
+            cooldown = baseline.value or 0.0
+            if now - self._last_decrease >= cooldown:
+                self.limit = max(settings.BANK_CONCURRENCY_MIN_LIMIT, self.limit * settings.BANK_CONCURRENCY_BACKOFF)
+                self._last_decrease = now
+                LIMIT_DECREASES_TOTAL.inc(bank=self.bank, reason="error" if failed else "latency")
+        elif self.in_flight + 1 >= self.limit / 2:
+            # Растём, только если лимит действительно используется
+            self.limit = min(settings.BANK_CONCURRENCY_MAX_LIMIT, self.limit + 1.0 / self.limit)
+
+        if not failed:
+            baseline.record(latency, now)
+            BASELINE_LATENCY.set(round(baseline.value * 1000, 1), bank=self.bank, endpoint=endpoint)
+
+        self._wake_waiters()
+        self._publish()
+
+
+class BankConcurrencyLimiter:
+    """Адаптивные лимиты по банкам"""
+
+    def __init__(self):
+        self._limits: Dict[str, AdaptiveLimit] = {}
+
+    def limit(self, bank_code: str) -> AdaptiveLimit:
+        limit = self._limits.get(bank_code)
+        if limit is None:
+            limit = AdaptiveLimit(bank_code)
+            self._limits[bank_code] = limit
+        return limit
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        bank_code: str,
+        endpoint: str,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> AsyncIterator["_Outcome"]:
+        """
+        Занять место на время запроса к эндпоинту банка.
+
+        Вызывающий отмечает неудачу через outcome.failed = True (429, 5xx);
+        исключение внутри блока тоже считается неудачей.
+        """
+        if not settings.BANK_CONCURRENCY_ENABLED:
+            yield _Outcome()
+            return
+        limit = self.limit(bank_code)
+        await limit.acquire(priority)
+        outcome = _Outcome()
+        started = time.monotonic()
+        try:
+            yield outcome
+        except asyncio.CancelledError:
+            # Отмена клиентом ничего не говорит о состоянии банка
+            limit.abandon()
+            raise
+        except Exception:
+            limit.release(endpoint, time.monotonic() - started, failed=True)
+            raise
+        else:
+            limit.release(endpoint, time.monotonic() - started, failed=outcome.failed)
+
+
+class _Outcome:
+    __slots__ = ("failed",)
+
+    def __init__(self):
+        self.failed = False
+
+
+concurrency_limiter = BankConcurrencyLimiter()
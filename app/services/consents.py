@@ -0,0 +1,144 @@
+"""
+Статус согласий, ожидающих одобрения клиентом
+
+Согласие без автоодобрения остаётся pending, пока клиент не подтвердит его в
+банке, а банк об этом сам не сообщает. Поэтому статус таких согласий
+перечитывается из банка (GET /account-consents/{id}): фоновым циклом раз в
+CONSENT_CHECK_INTERVAL секунд и в начале каждой фоновой синхронизации.
+Новый статус сохраняется в подключении и публикуется событием consent.
+
+Проход фонового цикла выполняет один воркер на интервал. Если проходы всё же
+пересеклись (проход дольше интервала), статус меняется условным UPDATE ...
+WHERE consent_status = <старый>, поэтому событие публикуется один раз.
+"""
+import asyncio
+import logging
+import time
+from typing import List, Tuple
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.core.startup import startup_state
+from app.core.state import get_state_backend
+from app.models.bank_connection import BankConnection
+from app.services.bank_service import BankService, connection_bank_config
+from app.services.bank_tokens import ensure_fresh_token
+from app.services.events import notify_consent_status
+from app.services.normalization import consent_status
+
+logger = logging.getLogger(__name__)
+
+CONSENT_CHECKS_TOTAL = registry.counter("consent_checks_total", "Проверки статуса ожидающих согласий", ("result",))
+
+# Статусы ожидающего согласия (банки пишут их по-разному)
+PENDING_STATUSES = ("pending", "awaitingauthorization", "awaitingauthorisation")
+
+ConsentChange = Tuple[str | None, str]
+
+
+def consent_pending(status: str | None) -> bool:
+    return (status or "pending").lower() in PENDING_STATUSES
+
+
+async def refresh_consent_status(
+    db: AsyncSession,
+    connection: BankConnection,
+    priority: str = "background"
+) -> ConsentChange | None:
+    """
+    Перечитать статус ожидающего согласия из банка (commit делает вызывающий).
+
+    Возвращает (старый, новый), если статус изменился; токен подключения
+    должен быть действующим.
+    """
+    if not connection.consent_id or not consent_pending(connection.consent_status):
+        return None
+    bank_config = connection_bank_config(connection.bank_code, connection)
+    if bank_config is None:
+        raise ValueError(f"Bank '{connection.bank_code}' is not configured")
+    service = BankService(bank_config, bank_code=connection.bank_code, priority=priority)
+    payload = await service.get_consent(
+        connection.consent_id,
+        access_token=connection.access_token,
+        requesting_bank=connection.team_client_id
+    )
+    status = consent_status(payload)
+    old_status = connection.consent_status
+    if not status or status == old_status:
+        CONSENT_CHECKS_TOTAL.inc(result="unchanged")
+        return None
+
+    condition = (
+        BankConnection.consent_status.is_(None) if old_status is None
+        else BankConnection.consent_status == old_status
+    )
+    result = await db.execute(
+        update(BankConnection)
+        .where(BankConnection.id == connection.id, condition)
+        .values(consent_status=status)
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        # Статус уже сменил параллельный проход — событие опубликует он
+        await db.refresh(connection, ["consent_status"])
+        CONSENT_CHECKS_TOTAL.inc(result="unchanged")
+        return None
+    set_committed_value(connection, "consent_status", status)
+    CONSENT_CHECKS_TOTAL.inc(result="changed")
+    return old_status, status
+
+
+class ConsentMonitor:
+    """Фоновая проверка ожидающих согласий всех пользователей"""
+
+    async def check(self) -> int:
+        """Проверить ожидающие согласия; вернуть число сменивших статус"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(BankConnection).where(
+                    BankConnection.is_active == True,
+                    BankConnection.consent_id.is_not(None),
+                    func.lower(func.coalesce(BankConnection.consent_status, "pending")).in_(PENDING_STATUSES)
+                ).order_by(BankConnection.connected_at.desc()).limit(settings.CONSENT_CHECK_BATCH)
+            )
+            changes: List[Tuple[BankConnection, ConsentChange]] = []
+            for connection in result.scalars().all():
+                try:
+                    await ensure_fresh_token(connection)
+                    change = await refresh_consent_status(db, connection)
+                except Exception as e:
+                    CONSENT_CHECKS_TOTAL.inc(result="error")
+                    logger.warning(f"Failed to check consent of connection {connection.id} ({connection.bank_code}): {e}")
+                    continue
+                if change is not None:
+                    changes.append((connection, change))
+            # Вместе со статусами сохраняются и обновлённые токены
+            await db.commit()
+
+            for connection, (old_status, new_status) in changes:
+                await notify_consent_status(connection.user_id, connection.bank_code, old_status, new_status)
+        return len(changes)
+
+    async def run(self) -> None:
+        """Цикл проверок; запускается задачей в lifespan"""
+        while not startup_state.db_ready:
+            await asyncio.sleep(0.5)
+        interval = settings.CONSENT_CHECK_INTERVAL
+        while True:
+            started = time.monotonic()
+            try:
+                # Проход выполняет тот воркер, который первым занял интервал
+                if await get_state_backend().add("consents:check", True, ttl=interval):
+                    await self.check()
+            except Exception as e:
+                logger.error(f"Pending consent check failed: {e}")
+            elapsed = time.monotonic() - started
+            await asyncio.sleep(max(interval - elapsed, 1.0))
+
+
+consent_monitor = ConsentMonitor()
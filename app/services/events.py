@@ -0,0 +1,226 @@
+"""
+События для фронтенда (Server-Sent Events)
+
+События пользователя пишутся в журнал общего хранилища состояния
+(append_log), поэтому номер события одинаков для всех воркеров: клиент,
+переподключившийся к другому воркеру, дочитывает пропущенное по Last-Event-ID.
+Журнал хранит последние EVENTS_HISTORY_SIZE событий пользователя.
+
+Каждый воркер раздаёт события своим подписчикам: фоновый цикл перечитывает
+журналы пользователей с открытыми подключениями раз в EVENTS_POLL_INTERVAL
+секунд, а после публикации в этом же воркере — сразу. Очередь каждого
+подключения ограничена: если клиент не успевает читать, самые старые
+непрочитанные события вытесняются.
+"""
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Set
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.state import get_state_backend
+
+logger = logging.getLogger(__name__)
+
+EVENTS_PUBLISHED_TOTAL = registry.counter("events_published_total", "Опубликованные события", ("type",))
+EVENTS_DROPPED_TOTAL = registry.counter("events_dropped_total", "События, вытесненные из переполненной очереди")
+EVENT_SUBSCRIBERS = registry.gauge("event_subscribers", "Открытые SSE-подключения")
+
+# Сколько новых транзакций передавать в одном событии
+MAX_TRANSACTIONS_PER_EVENT = 50
+
+
+class Event:
+    """Событие пользователя"""
+
+    __slots__ = ("id", "type", "data")
+
+    def __init__(self, event_id: int, event_type: str, data: Dict[str, Any]):
+        self.id = event_id
+        self.type = event_type
+        self.data = data
+
+    def encode(self) -> str:
+        payload = json.dumps(self.data, ensure_ascii=False, default=str)
+        return f"id: {self.id}\nevent: {self.type}\ndata: {payload}\n\n"
+
+
+class Subscription:
+    """Подписка одного SSE-подключения с ограниченной очередью"""
+
+    def __init__(self, broker: "EventBroker", user_id: int, buffer_size: int, last_id: int):
+        self.broker = broker
+        self.user_id = user_id
+        # Номер последнего события, переданного в очередь: повторно не отдаётся
+        self.last_id = last_id
+        self.queue: asyncio.Queue[Event] = asyncio.Queue(maxsize=buffer_size)
+
+    def push(self, event: Event) -> None:
+        if event.id <= self.last_id:
+            return
+        self.last_id = event.id
+        if self.queue.full():
+            self.queue.get_nowait()
+            EVENTS_DROPPED_TOTAL.inc()
+        self.queue.put_nowait(event)
+
+    async def next(self, timeout: float) -> Event | None:
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self) -> None:
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    """Публикация событий в общий журнал и раздача подписчикам воркера"""
+
+    def __init__(self, history_size: int, buffer_size: int, poll_interval: float, history_ttl: float):
+        self.history_size = history_size
+        self.buffer_size = buffer_size
+        self.poll_interval = poll_interval
+        self.history_ttl = history_ttl
+        self._subscribers: Dict[int, Set[Subscription]] = {}
+        self._wakeup = asyncio.Event()
+
+    @staticmethod
+    def _log_key(user_id: int) -> str:
+        return f"events:{user_id}"
+
+    async def publish(self, user_id: int, event_type: str, data: Dict[str, Any]) -> Event | None:
+        """Опубликовать событие; None — хранилище недоступно (события не обязательны для запроса)"""
+        try:
+            event_id = await get_state_backend().append_log(
+                self._log_key(user_id), {"type": event_type, "data": data}, self.history_size, self.history_ttl
+            )
+        except Exception as e:
+            logger.warning(f"Failed to publish '{event_type}' event for user {user_id}: {e}")
+            return None
+        EVENTS_PUBLISHED_TOTAL.inc(type=event_type)
+        if user_id in self._subscribers:
+            self._wakeup.set()
+        return Event(event_id, event_type, data)
+
+    async def subscribe(self, user_id: int, last_event_id: int | None = None) -> Subscription:
+        """Подписаться; при last_event_id сначала отдаются пропущенные события"""
+        entries = await get_state_backend().read_log(self._log_key(user_id))
+        latest = entries[-1][0] if entries else 0
+        if last_event_id is None or last_event_id > latest:
+            # Номер из будущего — журнал истёк или хранилище пересоздано: читаем с текущего места
+            subscription = Subscription(self, user_id, self.buffer_size, latest)
+        else:
+            subscription = Subscription(self, user_id, self.buffer_size, last_event_id)
+            for entry_id, entry in entries:
+                subscription.push(Event(entry_id, entry["type"], entry["data"]))
+        self._subscribers.setdefault(user_id, set()).add(subscription)
+        EVENT_SUBSCRIBERS.inc()
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        subscribers = self._subscribers.get(subscription.user_id)
+        if subscribers and subscription in subscribers:
+            subscribers.discard(subscription)
+            EVENT_SUBSCRIBERS.dec()
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+
+    async def deliver(self) -> None:
+        """Раздать подписчикам воркера новые события из журналов"""
+        state = get_state_backend()
+        for user_id, subscribers in list(self._subscribers.items()):
+            after = min(subscription.last_id for subscription in subscribers)
+            entries = await state.read_log(self._log_key(user_id), after)
+            for entry_id, entry in entries:
+                event = Event(entry_id, entry["type"], entry["data"])
+                for subscription in list(self._subscribers.get(user_id, ())):
+                    subscription.push(event)
+
+    async def run(self) -> None:
+        """Цикл раздачи событий; запускается задачей в lifespan"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._subscribers:
+                continue
+            try:
+                await self.deliver()
+            except Exception as e:
+                logger.warning(f"Event delivery failed: {e}")
+
+
+event_broker = EventBroker(
+    settings.EVENTS_HISTORY_SIZE,
+    settings.EVENTS_CONNECTION_BUFFER,
+    settings.EVENTS_POLL_INTERVAL,
+    settings.EVENTS_HISTORY_TTL
+)
+
+
+async def notify_new_transactions(user_id: int, bank_code: str, account_id: str, transactions: List[Any]) -> None:
+    """Событие о новых транзакциях счёта"""
+    if not transactions:
+        return
+    await event_broker.publish(user_id, "transactions", {
+        "bank_code": bank_code,
+        "account_id": account_id,
+        "count": len(transactions),
+        "transactions": [
+            {
+                "transaction_id": tx.transaction_id,
+                "amount": str(tx.amount),
+                "currency": tx.currency,
+                "credit_debit": tx.credit_debit,
+                "booking_date": tx.booking_date.isoformat() if tx.booking_date else None,
+                "description": tx.description,
+            }
+            for tx in transactions[:MAX_TRANSACTIONS_PER_EVENT]
+        ],
+    })
+
+
+async def notify_balance_changed(user_id: int, bank_code: str, account_id: str, old: Any, new: Any, currency: str | None) -> None:
+    """Событие об изменении баланса счёта"""
+    await event_broker.publish(user_id, "balance", {
+        "bank_code": bank_code,
+        "account_id": account_id,
+        "old_balance": str(old) if old is not None else None,
+        "balance": str(new),
+        "currency": currency,
+    })
+
+
+async def notify_consent_status(user_id: int, bank_code: str, old: str | None, new: str | None) -> None:
+    """Событие о смене статуса согласия"""
+    await event_broker.publish(user_id, "consent", {
+        "bank_code": bank_code,
+        "old_status": old,
+        "status": new,
+    })
+
+
+async def notify_sync_job(
+    user_id: int,
+    job_id: int,
+    bank_code: str | None,
+    status: str,
+    done: int,
+    failed: int,
+    total: int,
+    new_transactions: int
+) -> None:
+    """Событие о ходе фоновой синхронизации"""
+    await event_broker.publish(user_id, "sync", {
+        "job_id": job_id,
+        "bank_code": bank_code,
+        "status": status,
+        "done_accounts": done,
+        "failed_accounts": failed,
+        "total_accounts": total,
+        "new_transactions": new_transactions,
+    })
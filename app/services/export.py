@@ -0,0 +1,181 @@
+"""
+Потоковая выгрузка истории транзакций (CSV, Parquet)
+
+Транзакции читаются из БД серверным курсором порциями по EXPORT_BATCH_SIZE и
+сразу отдаются клиенту, поэтому память воркера не зависит от объёма истории.
+Parquet пишется группами строк (одна порция — одна row group) и требует
+пакета pyarrow.
+"""
+import asyncio
+import csv
+import io
+from datetime import datetime
+from typing import AsyncIterator, List, Sequence
+
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, prefer_replica
+from app.models.transaction import Transaction
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover - pyarrow нужен только для выгрузки в Parquet
+    pa = None
+    pq = None
+
+EXPORT_COLUMNS = (
+    "bank_code",
+    "account_id",
+    "transaction_id",
+    "booking_date",
+    "amount",
+    "currency",
+    "credit_debit",
+    "status",
+    "description",
+    "internal_transfer",
+)
+
+
+def parquet_available() -> bool:
+    return pa is not None
+
+
+def _export_query(
+    user_id: int,
+    bank_codes: Sequence[str] | None,
+    date_from: datetime | None,
+    date_to: datetime | None
+):
+    query = select(
+        Transaction.bank_code,
+        Transaction.account_id,
+        Transaction.transaction_id,
+        Transaction.booking_date,
+        Transaction.amount,
+        Transaction.currency,
+        Transaction.credit_debit,
+        Transaction.status,
+        Transaction.description,
+        Transaction.is_internal_transfer,
+    ).where(Transaction.user_id == user_id)
+    if bank_codes:
+        query = query.where(Transaction.bank_code.in_(list(bank_codes)))
+    if date_from:
+        query = query.where(Transaction.booking_date >= date_from)
+    if date_to:
+        query = query.where(Transaction.booking_date <= date_to)
+    return query.order_by(Transaction.booking_date, Transaction.id).execution_options(
+        yield_per=settings.EXPORT_BATCH_SIZE
+    )
+
+
+async def _iter_batches(user_id, bank_codes, date_from, date_to, use_replica) -> AsyncIterator[List[tuple]]:
+    # Своя сессия: зависимость get_db закрывается до начала отправки тела ответа
+    async with AsyncSessionLocal() as session:
+        if use_replica:
+            prefer_replica(session)
+        result = await session.stream(_export_query(user_id, bank_codes, date_from, date_to))
+        async for partition in result.partitions(settings.EXPORT_BATCH_SIZE):
+            yield [tuple(row) for row in partition]
+
+
+async def stream_csv(
+    user_id: int,
+    bank_codes: Sequence[str] | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    use_replica: bool = False
+) -> AsyncIterator[bytes]:
+    """CSV по порциям; первая строка — заголовок"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    # BOM, чтобы Excel открыл кириллицу в UTF-8
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    async for rows in _iter_batches(user_id, bank_codes, date_from, date_to, use_replica):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(
+            (bank, account, tx_id, booked.isoformat() if booked else "", amount, currency, cd, st, desc, internal)
+            for bank, account, tx_id, booked, amount, currency, cd, st, desc, internal in rows
+        )
+        yield buffer.getvalue().encode("utf-8")
+
+
+class _ChunkSink(io.RawIOBase):
+    """Файл, который копит записанные байты до следующего забора"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        chunk = bytes(data)
+        self._chunks.append(chunk)
+        self._position += len(chunk)
+        return len(chunk)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _parquet_schema():
+    return pa.schema([
+        ("bank_code", pa.dictionary(pa.int32(), pa.string())),
+        ("account_id", pa.string()),
+        ("transaction_id", pa.string()),
+        ("booking_date", pa.timestamp("us")),
+        ("amount", pa.decimal128(18, 2)),
+        ("currency", pa.dictionary(pa.int32(), pa.string())),
+        ("credit_debit", pa.dictionary(pa.int32(), pa.string())),
+        ("status", pa.dictionary(pa.int32(), pa.string())),
+        ("description", pa.string()),
+        ("internal_transfer", pa.bool_()),
+    ])
+
+
+def _rows_to_table(rows: List[tuple], schema):
+    columns = list(zip(*rows))
+    arrays = [
+        pa.array(column, type=field.type.value_type).dictionary_encode()
+        if pa.types.is_dictionary(field.type) else pa.array(column, type=field.type)
+        for column, field in zip(columns, schema)
+    ]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+async def stream_parquet(
+    user_id: int,
+    bank_codes: Sequence[str] | None = None,
+    date_from: datetime | None = None,
+    date_to: datetime | None = None,
+    use_replica: bool = False
+) -> AsyncIterator[bytes]:
+    """Parquet по группам строк; футер файла уходит последним"""
+    if pa is None:
+        raise RuntimeError("Parquet export requires the 'pyarrow' package")
+
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        async for rows in _iter_batches(user_id, bank_codes, date_from, date_to, use_replica):
+            # Кодирование и сжатие — работа CPU, не держим на ней event loop
+            table = await asyncio.to_thread(_rows_to_table, rows, schema)
+            await asyncio.to_thread(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
@@ -0,0 +1,101 @@
+"""
+Идемпотентные POST-запросы (заголовок Idempotency-Key)
+
+Мобильные клиенты повторяют запросы при обрыве сети, а подключение банка и
+создание согласия — это запросы в банк (токен, новое согласие). С ключом
+идемпотентности первый запрос выполняется, а его ответ вместе с отпечатком
+тела запроса хранится в общем хранилище состояния IDEMPOTENCY_KEY_TTL секунд:
+
+- повтор с тем же ключом и телом получает сохранённый ответ без обращения
+  к банку;
+- одновременный повтор ждёт на межпроцессной блокировке, пока первый
+  запрос не завершится, и тоже получает его ответ (но не дольше
+  IDEMPOTENCY_WAIT_TIMEOUT — затем IdempotencyKeyInProgress). Блокировка
+  продлевается, пока первый запрос выполняется, поэтому долгий запрос в
+  банк не выполнится второй раз;
+- тот же ключ с другим телом — ошибка клиента (IdempotencyKeyMismatch).
+
+Сохраняются только успешные ответы: после ошибки повтор с тем же ключом
+выполняется заново.
+"""
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from app.core.config import settings
+from app.core.metrics import registry
+from app.core.state import StateLockTimeout, get_state_backend
+
+IDEMPOTENT_REQUESTS_TOTAL = registry.counter(
+    "idempotent_requests_total", "Запросы с Idempotency-Key", ("scope", "result")
+)
+
+
+class IdempotencyKeyMismatch(Exception):
+    """Ключ уже использован для запроса с другим телом"""
+
+
+class IdempotencyKeyInProgress(Exception):
+    """Запрос с этим ключом всё ещё выполняется"""
+
+
+def request_fingerprint(payload: Dict[str, Any]) -> str:
+    """Отпечаток тела запроса (секреты в хранилище не попадают — только хеш)"""
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+async def run_idempotent(
+    scope: str,
+    user_id: int,
+    key: str,
+    payload: Dict[str, Any],
+    execute: Callable[[], Awaitable[Dict[str, Any]]]
+) -> Tuple[Dict[str, Any], bool]:
+    """
+    Выполнить execute() один раз на ключ и вернуть (ответ, повтор ли это).
+
+    scope — операция (например, "connect"); ключи разных пользователей и
+    операций не пересекаются. Ответ execute() должен сериализоваться в JSON.
+    """
+    state = get_state_backend()
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    cache_key = f"idempotency:{scope}:{user_id}:{digest}"
+    fingerprint = request_fingerprint(payload)
+
+    stored = await state.get(cache_key)
+    if stored is None:
+        locked = False
+        try:
+            # Блокировка продлевается всё время execute(): запрос в банк может идти дольше
+            # её TTL, и повтор не должен получить её раньше, чем сохранён ответ
+            async with state.lock(
+                f"{cache_key}:lock",
+                ttl=settings.IDEMPOTENCY_LOCK_TTL,
+                wait=settings.IDEMPOTENCY_WAIT_TIMEOUT,
+                renew=True
+            ):
+                locked = True
+                # Пока ждали блокировку, первый запрос мог завершиться
+                stored = await state.get(cache_key)
+                if stored is None:
+                    body = await execute()
+                    await state.set(
+                        cache_key,
+                        {"fingerprint": fingerprint, "body": body},
+                        settings.IDEMPOTENCY_KEY_TTL
+                    )
+                    IDEMPOTENT_REQUESTS_TOTAL.inc(scope=scope, result="executed")
+                    return body, False
+        except StateLockTimeout:
+            if locked:
+                # Блокировку не дождался сам запрос (например, общий кэш токенов)
+                raise
+            IDEMPOTENT_REQUESTS_TOTAL.inc(scope=scope, result="in_progress")
+            raise IdempotencyKeyInProgress("A request with this Idempotency-Key is still in progress")
+
+    if stored["fingerprint"] != fingerprint:
+        IDEMPOTENT_REQUESTS_TOTAL.inc(scope=scope, result="mismatch")
+        raise IdempotencyKeyMismatch("Idempotency-Key was already used with a different request body")
+    IDEMPOTENT_REQUESTS_TOTAL.inc(scope=scope, result="replayed")
+    return stored["body"], True
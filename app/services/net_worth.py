@@ -0,0 +1,224 @@
+"""
+Сводный баланс пользователя по всем банкам (net worth)
+
+Сумма последних известных балансов счетов по каждой валюте хранится в
+net_worth_totals и обновляется приращениями при каждом изменении баланса
+счёта в справочнике (запрос балансов, фоновая синхронизация, отключение
+банка). Поэтому GET /api/banks/net-worth читает несколько строк и никогда не
+ходит в банки.
+
+Перевод в базовую валюту NET_WORTH_BASE_CURRENCY идёт по курсам из таблицы
+fx_rates. Её раз в FX_REFRESH_INTERVAL секунд обновляет один из воркеров
+(курсы ЦБ РФ из FX_RATES_URL), остальные только перечитывают; если источник
+недоступен, используются последние сохранённые курсы.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal
+from app.core.metrics import registry
+from app.core.startup import startup_state
+from app.core.state import StateLockTimeout, get_state_backend
+from app.models.net_worth import FxRate, NetWorthTotal
+from app.services.bank_service import get_http_client
+
+logger = logging.getLogger(__name__)
+
+FX_REFRESH_TOTAL = registry.counter("fx_rates_refresh_total", "Загрузки курсов валют", ("result",))
+
+CENT = Decimal("0.01")
+
+
+async def _add_to_total(db: AsyncSession, user_id: int, currency: str, delta: Decimal, accounts: int) -> None:
+    now = datetime.utcnow()
+    change = update(NetWorthTotal).where(
+        NetWorthTotal.user_id == user_id,
+        NetWorthTotal.currency == currency
+    ).values(
+        total=NetWorthTotal.total + delta,
+        accounts=NetWorthTotal.accounts + accounts,
+        updated_at=now
+    )
+    result = await db.execute(change)
+    if result.rowcount:
+        return
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(NetWorthTotal).values(
+                user_id=user_id, currency=currency, total=delta, accounts=accounts, updated_at=now
+            ))
+    except IntegrityError:
+        # Строку валюты успел создать параллельный запрос
+        await db.execute(change)
+
+
+async def apply_balance_change(
+    db: AsyncSession,
+    user_id: int,
+    old_currency: str | None,
+    old_amount: Decimal | None,
+    new_currency: str | None,
+    new_amount: Decimal | None
+) -> None:
+    """
+    Учесть изменение баланса счёта в сводном балансе (commit делает вызывающий).
+
+    None в сумме — баланс неизвестен (счёт не учитывается); балансы без
+    валюты в сводный баланс не входят.
+    """
+    if old_amount is not None and old_currency:
+        if new_amount is not None and new_currency == old_currency:
+            delta = Decimal(new_amount) - Decimal(old_amount)
+            if delta:
+                await _add_to_total(db, user_id, old_currency, delta, 0)
+            return
+        await _add_to_total(db, user_id, old_currency, -Decimal(old_amount), -1)
+    if new_amount is not None and new_currency:
+        await _add_to_total(db, user_id, new_currency, Decimal(new_amount), 1)
+
+
+class FxRates:
+    """Курсы к базовой валюте: таблица fx_rates и её копия в памяти воркера"""
+
+    def __init__(self):
+        self.base_currency = settings.NET_WORTH_BASE_CURRENCY
+        self.rates: Dict[str, Decimal] = {self.base_currency: Decimal(1)}
+        self.updated_at: datetime | None = None
+
+    def _is_fresh(self) -> bool:
+        return (
+            self.updated_at is not None
+            and datetime.utcnow() - self.updated_at < timedelta(seconds=settings.FX_REFRESH_INTERVAL)
+        )
+
+    async def load(self) -> None:
+        """Перечитать курсы из таблицы"""
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(FxRate).where(FxRate.base_currency == self.base_currency))
+            rows = result.scalars().all()
+        rates = {row.currency: Decimal(row.rate) for row in rows}
+        rates[self.base_currency] = Decimal(1)
+        self.rates = rates
+        self.updated_at = max((row.updated_at for row in rows), default=None)
+
+    async def _fetch(self) -> Dict[str, Decimal]:
+        """Курсы ЦБ РФ (рублей за единицу валюты) -> единиц базовой валюты за единицу"""
+        url = settings.FX_RATES_URL
+        response = await get_http_client(url).get(url, timeout=10.0)
+        response.raise_for_status()
+        quotes = {"RUB": Decimal(1)}
+        for code, item in (response.json().get("Valute") or {}).items():
+            try:
+                quotes[code] = Decimal(str(item["Value"])) / Decimal(str(item.get("Nominal") or 1))
+            except (KeyError, TypeError, InvalidOperation):
+                continue
+        base_quote = quotes.get(self.base_currency)
+        if not base_quote:
+            raise ValueError(f"No FX rate for base currency '{self.base_currency}'")
+        return {code: quote / base_quote for code, quote in quotes.items() if quote}
+
+    async def _store(self, rates: Dict[str, Decimal]) -> None:
+        now = datetime.utcnow()
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(FxRate).where(FxRate.base_currency == self.base_currency))
+            await db.execute(insert(FxRate), [
+                {"base_currency": self.base_currency, "currency": code, "rate": rate, "updated_at": now}
+                for code, rate in rates.items()
+            ])
+            await db.commit()
+
+    async def refresh(self) -> None:
+        """Обновить курсы, если они устарели; загружает из источника только один воркер"""
+        await self.load()
+        if self._is_fresh() or not settings.FX_RATES_URL:
+            return
+        state = get_state_backend()
+        try:
+            async with state.lock("fx-rates:refresh", ttl=60.0, wait=0.5):
+                # Пока ждали, курсы мог обновить другой воркер
+                await self.load()
+                if self._is_fresh():
+                    return
+                try:
+                    rates = await self._fetch()
+                except Exception as e:
+                    FX_REFRESH_TOTAL.inc(result="error")
+                    logger.warning(f"Failed to fetch FX rates, keeping rates from {self.updated_at}: {e}")
+                    return
+                await self._store(rates)
+                FX_REFRESH_TOTAL.inc(result="ok")
+        except StateLockTimeout:
+            # Курсы загружает другой воркер — перечитаем на следующем круге
+            return
+        await self.load()
+
+    async def run(self) -> None:
+        """Цикл обновления курсов; запускается задачей в lifespan"""
+        while not startup_state.db_ready:
+            await asyncio.sleep(0.5)
+        while True:
+            started = time.monotonic()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"FX rates refresh failed: {e}")
+            elapsed = time.monotonic() - started
+            # Перечитываем чаще, чем обновляем: курсы мог загрузить другой воркер
+            await asyncio.sleep(max(min(settings.FX_REFRESH_INTERVAL / 4, 300.0) - elapsed, 1.0))
+
+    def convert(self, amount: Decimal, currency: str) -> Decimal | None:
+        rate = self.rates.get(currency)
+        if rate is None:
+            return None
+        return (amount * rate).quantize(CENT)
+
+
+fx_rates = FxRates()
+
+
+async def get_net_worth(db: AsyncSession, user_id: int) -> Dict[str, Any]:
+    """Сводный баланс пользователя по валютам и в базовой валюте (без запросов в банки)"""
+    result = await db.execute(
+        select(NetWorthTotal).where(
+            NetWorthTotal.user_id == user_id,
+            NetWorthTotal.accounts > 0
+        ).order_by(NetWorthTotal.currency)
+    )
+    rows = result.scalars().all()
+
+    currencies = []
+    unconverted = []
+    total = Decimal(0)
+    for row in rows:
+        amount = Decimal(row.total).quantize(CENT)
+        converted = fx_rates.convert(amount, row.currency)
+        if converted is None:
+            unconverted.append(row.currency)
+        else:
+            total += converted
+        currencies.append({
+            "currency": row.currency,
+            "total": amount,
+            "accounts": row.accounts,
+            "rate": fx_rates.rates.get(row.currency),
+            "converted": converted,
+        })
+
+    updated_at = max((row.updated_at for row in rows if row.updated_at), default=None)
+    return {
+        "base_currency": fx_rates.base_currency,
+        "total": total,
+        "currencies": currencies,
+        "unconverted_currencies": unconverted,
+        "updated_at": updated_at.isoformat() if updated_at else None,
+        "rates_updated_at": fx_rates.updated_at.isoformat() if fx_rates.updated_at else None,
+    }
@@ -0,0 +1,274 @@
+"""
+Нормализация ответов банков
+
+Банки отдают одни и те же сущности в разной форме: список, {"data": [...]},
+{"data": {"account": [...]}}, {"accounts": [...]} и т.п. Здесь ответ один раз
+разбирается в компактные записи (классы со __slots__), а повторяющиеся короткие
+строки — коды банков, валюты, статусы, идентификаторы счетов — интернируются,
+чтобы тысячи транзакций одного счёта ссылались на одни и те же объекты.
+
+Дальше по коду (хранилище транзакций, справочник счетов, индекс поиска)
+используются только эти записи; форма ответа конкретного банка разбирается
+только здесь.
+"""
+import sys
+from datetime import datetime, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any, Dict, List
+
+# Какой тип баланса считать текущим (по порядку предпочтения)
+BALANCE_TYPE_PREFERENCE = ("InterimAvailable", "InterimBooked", "ClosingBooked", "Expected")
+
+
+def intern_code(value: Any) -> str | None:
+    """Интернированная строка для часто повторяющихся значений (код банка, валюта, статус)"""
+    if value is None or value == "":
+        return None
+    return sys.intern(str(value))
+
+
+def parse_datetime(value: Any) -> datetime | None:
+    """ISO-дата из ответа банка -> naive UTC datetime"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def parse_amount(value: Any) -> Decimal | None:
+    """Сумма из ответа банка ({"amount": "100.00"} или число/строка)"""
+    if isinstance(value, dict):
+        value = value.get("amount")
+    if value is None:
+        return None
+    try:
+        return abs(Decimal(str(value)))
+    except InvalidOperation:
+        return None
+
+
+def _amount_currency(item: Dict[str, Any]) -> Any:
+    amount_block = item.get("amount")
+    if isinstance(amount_block, dict) and amount_block.get("currency"):
+        return amount_block["currency"]
+    return item.get("currency")
+
+
+# Ключи списка транзакций в ответах банков
+TRANSACTION_KEYS = ("transaction", "transactions")
+
+
+def payload_items(payload: Any, *keys: str) -> List[Dict[str, Any]]:
+    """
+    Элементы списка из ответа банка в любой из известных форм.
+
+    Список; {"data": [...]}; {"data": {<key>: [...]}}; {<key>: [...]}.
+    """
+    if isinstance(payload, list):
+        items = payload
+    elif isinstance(payload, dict):
+        data = payload.get("data", payload)
+        if isinstance(data, list):
+            items = data
+        elif isinstance(data, dict):
+            items = next((data[key] for key in keys if data.get(key)), None)
+            if items is None and data is not payload:
+                items = next((payload[key] for key in keys if payload.get(key)), None)
+        else:
+            items = None
+    else:
+        items = None
+    if not isinstance(items, list):
+        return []
+    return [item for item in items if isinstance(item, dict)]
+
+
+def replace_payload_items(payload: Any, items: List[Dict[str, Any]], *keys: str) -> Any:
+    """
+    Копия ответа банка с другим списком элементов — в той же форме, что и исходный.
+
+    Список ищется так же, как в payload_items; ответ без списка возвращается как есть.
+    """
+    if isinstance(payload, list):
+        return items
+    if not isinstance(payload, dict):
+        return payload
+    data = payload.get("data", payload)
+    if isinstance(data, list):
+        return {**payload, "data": items}
+    if not isinstance(data, dict):
+        return payload
+    key = next((key for key in keys if data.get(key)), None)
+    if key is not None:
+        if data is payload:
+            return {**payload, key: items}
+        return {**payload, "data": {**data, key: items}}
+    key = next((key for key in keys if payload.get(key)), None) if data is not payload else None
+    if key is not None:
+        return {**payload, key: items}
+    return payload
+
+
+def transaction_items(payload: Any) -> List[Dict[str, Any]]:
+    """Исходные элементы транзакций (нужны, когда ответ банка отдаётся клиенту как есть)"""
+    return payload_items(payload, *TRANSACTION_KEYS)
+
+
+def replace_transaction_items(payload: Any, items: List[Dict[str, Any]]) -> Any:
+    """Копия ответа банка с другим списком транзакций"""
+    return replace_payload_items(payload, items, *TRANSACTION_KEYS)
+
+
+def item_transaction_id(item: Dict[str, Any]) -> str | None:
+    """Идентификатор транзакции в банке (поле называется по-разному)"""
+    transaction_id = item.get("transactionId") or item.get("transaction_id")
+    return str(transaction_id) if transaction_id else None
+
+
+def client_items(payload: Any) -> List[Dict[str, Any]]:
+    """Исходные элементы списка клиентов банка (banker API)"""
+    return payload_items(payload, "clients", "client")
+
+
+class AccountRecord:
+    """Счёт из ответа банка"""
+
+    __slots__ = ("account_id", "currency", "account_type", "status", "name")
+
+    def __init__(
+        self,
+        account_id: str,
+        currency: str | None,
+        account_type: str | None = None,
+        status: str | None = None,
+        name: str | None = None
+    ):
+        self.account_id = account_id
+        self.currency = currency
+        self.account_type = account_type
+        self.status = status
+        self.name = name
+
+
+class TransactionRecord:
+    """Транзакция из ответа банка; amount — модуль суммы, направление в credit_debit"""
+
+    __slots__ = (
+        "transaction_id", "account_id", "amount", "currency", "credit_debit",
+        "status", "booking_date", "description",
+    )
+
+    def __init__(
+        self,
+        transaction_id: str,
+        account_id: str,
+        amount: Decimal,
+        currency: str | None,
+        credit_debit: str | None,
+        status: str | None,
+        booking_date: datetime | None,
+        description: str | None
+    ):
+        self.transaction_id = transaction_id
+        self.account_id = account_id
+        self.amount = amount
+        self.currency = currency
+        self.credit_debit = credit_debit
+        self.status = status
+        self.booking_date = booking_date
+        self.description = description
+
+
+class BalanceRecord:
+    """Текущий баланс счёта; amount со знаком (Debit — отрицательный)"""
+
+    __slots__ = ("amount", "currency", "balance_type")
+
+    def __init__(self, amount: Decimal, currency: str | None, balance_type: str | None):
+        self.amount = amount
+        self.currency = currency
+        self.balance_type = balance_type
+
+
+def normalize_accounts(payload: Any) -> List[AccountRecord]:
+    """Счета из ответа банка (data.account, accounts или список); без accountId пропускаются"""
+    records = []
+    for item in payload_items(payload, "account", "accounts"):
+        account_id = item.get("accountId") or item.get("account_id")
+        if not account_id:
+            continue
+        name = item.get("nickname")
+        if not name:
+            identifiers = item.get("account")
+            if isinstance(identifiers, list) and identifiers and isinstance(identifiers[0], dict):
+                name = identifiers[0].get("name")
+        records.append(AccountRecord(
+            account_id=intern_code(account_id),
+            currency=intern_code(item.get("currency")),
+            account_type=intern_code(item.get("accountSubType") or item.get("accountType")),
+            status=intern_code(item.get("status")),
+            name=name
+        ))
+    return records
+
+
+def consent_status(payload: Any) -> str | None:
+    """Статус согласия из ответа банка ({"data": {...}} или плоский объект)"""
+    if not isinstance(payload, dict):
+        return None
+    data = payload.get("data")
+    source = data if isinstance(data, dict) else payload
+    status = source.get("status")
+    return str(status) if status else None
+
+
+def normalize_transactions(payload: Any, account_id: str) -> List[TransactionRecord]:
+    """
+    Транзакции из ответа банка (data.transaction, transactions или список).
+
+    account_id — счёт запроса, если банк не указывает его в транзакции;
+    транзакции без идентификатора или суммы пропускаются.
+    """
+    records = []
+    for item in transaction_items(payload):
+        transaction_id = item_transaction_id(item)
+        amount = parse_amount(item.get("amount"))
+        if not transaction_id or amount is None:
+            continue
+        records.append(TransactionRecord(
+            transaction_id=transaction_id,
+            account_id=intern_code(item.get("accountId") or account_id),
+            amount=amount,
+            currency=intern_code(_amount_currency(item)),
+            credit_debit=intern_code(item.get("creditDebitIndicator")),
+            status=intern_code(item.get("status")),
+            booking_date=parse_datetime(item.get("bookingDateTime") or item.get("valueDateTime")),
+            description=item.get("transactionInformation") or item.get("description")
+        ))
+    return records
+
+
+def normalize_balance(payload: Any) -> BalanceRecord | None:
+    """Текущий баланс из ответа банка (data.balance): тип выбирается по BALANCE_TYPE_PREFERENCE"""
+    balances = payload_items(payload, "balance", "balances")
+    if not balances:
+        return None
+
+    def rank(item: Dict[str, Any]) -> int:
+        balance_type = item.get("type")
+        if balance_type in BALANCE_TYPE_PREFERENCE:
+            return BALANCE_TYPE_PREFERENCE.index(balance_type)
+        return len(BALANCE_TYPE_PREFERENCE)
+
+    best = min(balances, key=rank)
+    amount = parse_amount(best.get("amount"))
+    if amount is None:
+        return None
+    if best.get("creditDebitIndicator") == "Debit":
+        amount = -amount
+    return BalanceRecord(amount, intern_code(_amount_currency(best)), intern_code(best.get("type")))
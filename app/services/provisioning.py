@@ -0,0 +1,407 @@
+"""
+Массовая загрузка пользователей и подключений к банкам
+
+Вход — CSV (с заголовком) или JSON Lines с полями email, password, full_name
+и необязательными bank_code, client_id, client_secret. Несколько строк с
+одним email — один пользователь с несколькими подключениями (пароль берётся
+из первой строки).
+
+Порядок работы:
+
+1. Строки проверяются; уже зарегистрированные email отсеиваются одним
+   запросом на пачку.
+2. Пароли хешируются в пуле процессов (Argon2 занимает процессор, в цикле
+   событий он остановил бы весь воркер).
+3. Токены банков запрашиваются по одному на уникальные командные учётные
+   данные, не больше PROVISIONING_TOKEN_CONCURRENCY одновременно и с фоновым
+   приоритетом квоты.
+4. Пользователи и подключения вставляются пачками по PROVISIONING_BATCH_SIZE
+   пользователей: через COPY на asyncpg, многострочным INSERT в остальных
+   случаях. Если пачка не вставилась (например, email успели
+   зарегистрировать), она повторяется построчно, чтобы ошибка досталась
+   только своей строке.
+
+Результат — отчёт с числом созданных записей и ошибкой по каждой строке.
+
+Запуск из командной строки:
+
+    python -m app.services.provisioning users.csv --report report.json
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from pydantic import BaseModel, EmailStr, ValidationError
+from sqlalchemy import insert, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, engine, init_db
+from app.core.security import hash_passwords
+from app.models.bank_connection import BankConnection
+from app.models.user import User
+from app.services.bank_service import BankService, close_http_clients
+from app.services.bank_tokens import bank_token_expiry
+
+logger = logging.getLogger(__name__)
+
+# Паролей в одной задаче пула: меньше накладных расходов на передачу между процессами
+HASH_CHUNK_SIZE = 64
+
+USER_COLUMNS = ("email", "password_hash", "full_name", "is_active", "created_at", "updated_at")
+CONNECTION_COLUMNS = (
+    "user_id", "bank_code", "bank_name", "team_client_id", "team_client_secret",
+    "access_token", "token_expires_at", "consent_status", "is_active", "connected_at",
+)
+
+
+class ProvisioningRow(BaseModel):
+    """Строка входного файла"""
+    email: EmailStr
+    password: str | None = None
+    full_name: str | None = None
+    bank_code: str | None = None
+    client_id: str | None = None
+    client_secret: str | None = None
+
+
+class _PendingConnection:
+    __slots__ = ("row", "bank_code", "client_id", "client_secret", "token")
+
+    def __init__(self, row: int, bank_code: str, client_id: str, client_secret: str):
+        self.row = row
+        self.bank_code = bank_code
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token: Dict[str, Any] | None = None
+
+
+class _PendingUser:
+    __slots__ = ("row", "email", "password", "full_name", "password_hash", "connections")
+
+    def __init__(self, row: int, email: str, password: str, full_name: str | None):
+        self.row = row
+        self.email = email
+        self.password = password
+        self.full_name = full_name
+        self.password_hash: str | None = None
+        self.connections: List[_PendingConnection] = []
+
+
+class ProvisioningReport:
+    """Итог загрузки с ошибками по строкам"""
+
+    def __init__(self):
+        self.rows = 0
+        self.users_created = 0
+        self.connections_created = 0
+        self.errors: List[Dict[str, Any]] = []
+        self.started = time.perf_counter()
+
+    def error(self, row: int, email: str | None, message: str) -> None:
+        self.errors.append({"row": row, "email": email, "error": message})
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "rows": self.rows,
+            "users_created": self.users_created,
+            "connections_created": self.connections_created,
+            "failed_rows": len({item["row"] for item in self.errors}),
+            "duration_seconds": round(time.perf_counter() - self.started, 2),
+            "errors": sorted(self.errors, key=lambda item: item["row"]),
+        }
+
+
+def _csv_rows(text: str) -> Iterator[Tuple[int, Dict[str, Any] | str]]:
+    reader = csv.DictReader(io.StringIO(text))
+    for record in reader:
+        yield reader.line_num, {key.strip(): (value or "").strip() for key, value in record.items() if key}
+
+
+def _jsonl_rows(text: str) -> Iterator[Tuple[int, Dict[str, Any] | str]]:
+    for line_number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(record, dict):
+            yield line_number, "Each line must be a JSON object"
+            continue
+        yield line_number, record
+
+
+def parse_rows(content: bytes, fmt: str) -> Iterator[Tuple[int, Dict[str, Any] | str]]:
+    """
+    Строки файла: (номер строки, поля) или (номер строки, текст ошибки разбора).
+
+    fmt — csv или jsonl; номера строк считаются как в файле (заголовок CSV — строка 1).
+    Неверный формат или кодировка — ValueError сразу, до разбора строк.
+    """
+    if fmt not in ("csv", "jsonl"):
+        raise ValueError("format must be 'csv' or 'jsonl'")
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError as e:
+        raise ValueError(f"File must be UTF-8: {e}")
+    return _csv_rows(text) if fmt == "csv" else _jsonl_rows(text)
+
+
+def _collect(rows: Iterable[Tuple[int, Dict[str, Any] | str]], report: ProvisioningReport) -> Dict[str, _PendingUser]:
+    banks = settings.get_banks()
+    users: Dict[str, _PendingUser] = {}
+    failed_emails = set()
+    for row, record in rows:
+        report.rows += 1
+        if isinstance(record, str):
+            report.error(row, None, record)
+            continue
+        try:
+            # Пустые ячейки CSV — отсутствующие значения
+            parsed = ProvisioningRow.model_validate({key: value for key, value in record.items() if value not in ("", None)})
+        except ValidationError as e:
+            first = e.errors()[0]
+            report.error(row, record.get("email"), f"{'.'.join(map(str, first['loc']))}: {first['msg']}")
+            continue
+
+        email = str(parsed.email)
+        if email in failed_emails:
+            report.error(row, email, "User row for this email failed")
+            continue
+        user = users.get(email)
+        if user is None:
+            if not parsed.password:
+                failed_emails.add(email)
+                report.error(row, email, "password is required")
+                continue
+            user = _PendingUser(row, email, parsed.password, parsed.full_name)
+            users[email] = user
+
+        if parsed.bank_code:
+            if parsed.bank_code not in banks:
+                report.error(row, email, f"Bank '{parsed.bank_code}' not found")
+            elif not parsed.client_id or not parsed.client_secret:
+                report.error(row, email, "client_id and client_secret are required for a bank connection")
+            elif any(conn.bank_code == parsed.bank_code for conn in user.connections):
+                report.error(row, email, f"Bank '{parsed.bank_code}' is already listed for this user")
+            else:
+                user.connections.append(
+                    _PendingConnection(row, parsed.bank_code, parsed.client_id, parsed.client_secret)
+                )
+    return users
+
+
+async def _drop_registered(users: Dict[str, _PendingUser], report: ProvisioningReport) -> None:
+    emails = list(users)
+    async with AsyncSessionLocal() as db:
+        for start in range(0, len(emails), settings.PROVISIONING_BATCH_SIZE):
+            chunk = emails[start:start + settings.PROVISIONING_BATCH_SIZE]
+            result = await db.execute(select(User.email).where(User.email.in_(chunk)))
+            for email in result.scalars().all():
+                user = users.pop(email)
+                report.error(user.row, email, "Email already registered")
+                for connection in user.connections:
+                    report.error(connection.row, email, "Email already registered")
+
+
+async def _hash_all(users: List[_PendingUser]) -> None:
+    if not users:
+        return
+    workers = settings.PROVISIONING_HASH_WORKERS or os.cpu_count() or 1
+    loop = asyncio.get_running_loop()
+    chunks = [users[i:i + HASH_CHUNK_SIZE] for i in range(0, len(users), HASH_CHUNK_SIZE)]
+    # spawn: форк процесса с работающим циклом событий и потоками небезопасен
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        hashed = await asyncio.gather(*(
+            loop.run_in_executor(pool, hash_passwords, [user.password for user in chunk])
+            for chunk in chunks
+        ))
+    for chunk, hashes in zip(chunks, hashed):
+        for user, password_hash in zip(chunk, hashes):
+            user.password_hash = password_hash
+            user.password = None
+
+
+async def _fetch_tokens(users: List[_PendingUser], report: ProvisioningReport) -> None:
+    by_credentials: Dict[Tuple[str, str, str], List[Tuple[str, _PendingConnection]]] = {}
+    for user in users:
+        for connection in user.connections:
+            key = (connection.bank_code, connection.client_id, connection.client_secret)
+            by_credentials.setdefault(key, []).append((user.email, connection))
+
+    banks = settings.get_banks()
+    semaphore = asyncio.Semaphore(settings.PROVISIONING_TOKEN_CONCURRENCY)
+
+    async def fetch(key: Tuple[str, str, str], connections: List[Tuple[str, _PendingConnection]]) -> None:
+        bank_code, client_id, client_secret = key
+        config = {**banks[bank_code], "client_id": client_id, "client_secret": client_secret}
+        service = BankService(config, bank_code=bank_code, priority="background")
+        try:
+            async with semaphore:
+                token_data = await service.get_bank_token()
+                token_data = {**token_data, "expires_at": await bank_token_expiry(bank_code, token_data)}
+        except Exception as e:
+            for email, connection in connections:
+                report.error(connection.row, email, f"Failed to get bank token: {e}")
+            return
+        # Один токен на командные учётные данные — общий для всех их подключений
+        for _, connection in connections:
+            connection.token = token_data
+
+    await asyncio.gather(*(fetch(key, connections) for key, connections in by_credentials.items()))
+
+
+def _user_values(user: _PendingUser, now: datetime) -> Dict[str, Any]:
+    return {
+        "email": user.email,
+        "password_hash": user.password_hash,
+        "full_name": user.full_name,
+        "is_active": True,
+        "created_at": now,
+        "updated_at": now,
+    }
+
+
+def _connection_values(user_id: int, connection: _PendingConnection, now: datetime) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "bank_code": connection.bank_code,
+        "bank_name": settings.get_banks()[connection.bank_code]["name"],
+        "team_client_id": connection.client_id,
+        "team_client_secret": connection.client_secret,
+        "access_token": connection.token["access_token"],
+        "token_expires_at": connection.token["expires_at"],
+        "consent_status": "pending",
+        "is_active": True,
+        "connected_at": now,
+    }
+
+
+async def _copy_rows(db: AsyncSession, table: str, columns: Tuple[str, ...], rows: List[Dict[str, Any]]) -> None:
+    connection = await db.connection()
+    raw = await connection.get_raw_connection()
+    await raw.driver_connection.copy_records_to_table(
+        table, records=[tuple(row[column] for column in columns) for row in rows], columns=list(columns)
+    )
+
+
+async def _insert_batch(db: AsyncSession, users: List[_PendingUser]) -> Tuple[int, int]:
+    """Вставить пачку одной транзакцией; (пользователей, подключений)"""
+    now = datetime.utcnow()
+    use_copy = (await db.connection()).dialect.driver == "asyncpg"
+
+    user_rows = [_user_values(user, now) for user in users]
+    if use_copy:
+        await _copy_rows(db, User.__tablename__, USER_COLUMNS, user_rows)
+        result = await db.execute(select(User.email, User.id).where(User.email.in_([user.email for user in users])))
+    else:
+        result = await db.execute(insert(User).returning(User.email, User.id), user_rows)
+    ids = dict(result.all())
+
+    connection_rows = [
+        _connection_values(ids[user.email], connection, now)
+        for user in users
+        for connection in user.connections
+        if connection.token is not None
+    ]
+    if connection_rows:
+        if use_copy:
+            await _copy_rows(db, BankConnection.__tablename__, CONNECTION_COLUMNS, connection_rows)
+        else:
+            await db.execute(insert(BankConnection), connection_rows)
+    return len(user_rows), len(connection_rows)
+
+
+async def _insert_one_by_one(db: AsyncSession, users: List[_PendingUser], report: ProvisioningReport) -> None:
+    for user in users:
+        try:
+            async with db.begin_nested():
+                created_users, created_connections = await _insert_batch(db, [user])
+        except IntegrityError:
+            report.error(user.row, user.email, "Email already registered")
+            for connection in user.connections:
+                report.error(connection.row, user.email, "Email already registered")
+            continue
+        except Exception as e:
+            report.error(user.row, user.email, f"Failed to insert: {e}")
+            continue
+        report.users_created += created_users
+        report.connections_created += created_connections
+    await db.commit()
+
+
+async def _load(users: List[_PendingUser], report: ProvisioningReport) -> None:
+    size = settings.PROVISIONING_BATCH_SIZE
+    for start in range(0, len(users), size):
+        batch = users[start:start + size]
+        async with AsyncSessionLocal() as db:
+            try:
+                created_users, created_connections = await _insert_batch(db, batch)
+                await db.commit()
+            except Exception as e:
+                await db.rollback()
+                # Текст ошибки SQLAlchemy содержит параметры запроса (хеши паролей) — в лог только тип
+                logger.warning(f"Provisioning batch at row {batch[0].row} failed ({type(e).__name__}), retrying row by row")
+                await _insert_one_by_one(db, batch, report)
+            else:
+                report.users_created += created_users
+                report.connections_created += created_connections
+
+
+async def provision(rows: Iterable[Tuple[int, Dict[str, Any] | str]]) -> ProvisioningReport:
+    """Загрузить пользователей и подключения из разобранных строк (см. parse_rows)"""
+    report = ProvisioningReport()
+    users = _collect(rows, report)
+    await _drop_registered(users, report)
+    pending = sorted(users.values(), key=lambda user: user.row)
+    # Хеширование (процессы) и запросы токенов (сеть) не мешают друг другу
+    await asyncio.gather(_hash_all(pending), _fetch_tokens(pending, report))
+    await _load(pending, report)
+    logger.info(
+        f"Provisioned {report.users_created} users and {report.connections_created} connections "
+        f"from {report.rows} rows, {len(report.errors)} errors"
+    )
+    return report
+
+
+async def _main(path: str, fmt: str, report_path: str | None) -> int:
+    await init_db()
+    try:
+        with open(path, "rb") as f:
+            report = (await provision(parse_rows(f.read(), fmt))).to_dict()
+    finally:
+        await close_http_clients()
+        await engine.dispose()
+
+    summary = {key: value for key, value in report.items() if key != "errors"}
+    print(json.dumps(summary, ensure_ascii=False))
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+    else:
+        for item in report["errors"][:20]:
+            print(f"row {item['row']}: {item['email'] or ''} {item['error']}")
+    return 1 if report["errors"] else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Массовая загрузка пользователей и подключений к банкам")
+    parser.add_argument("path", help="CSV с заголовком или JSON Lines")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="по умолчанию — по расширению файла")
+    parser.add_argument("--report", help="куда записать полный отчёт (JSON)")
+    args = parser.parse_args()
+    fmt = args.format or ("jsonl" if args.path.endswith((".jsonl", ".ndjson")) else "csv")
+    logging.basicConfig(level=logging.INFO)
+    raise SystemExit(asyncio.run(_main(args.path, fmt, args.report)))
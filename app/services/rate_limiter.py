@@ -0,0 +1,165 @@
+"""
+Ограничение частоты запросов к банкам
+
+Банки песочницы считают квоты по client_id команды, поэтому у каждой пары
+(bank_code, team_client_id) свой token bucket. Запросы сверх квоты не
+отклоняются сразу, а ждут в очереди не дольше max_wait; интерактивные
+запросы пользователей обслуживаются раньше фоновых синхронизаций.
+
+Квота считается на воркер: при N воркерах задавайте BANK_RATE_LIMIT_PER_SECOND
+как квоту банка, делённую на N.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Tuple
+
+from app.core.config import settings
+from app.core.metrics import registry
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+PRIORITY_NAMES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "background": PRIORITY_BACKGROUND,
+}
+
+QUEUE_DEPTH = registry.gauge(
+    "bank_rate_limit_queue_depth", "Запросы к банку, ожидающие квоты", ("bank", "client")
+)
+WAIT_SECONDS = registry.histogram(
+    "bank_rate_limit_wait_seconds", "Время ожидания квоты банка", ("bank", "priority")
+)
+TIMEOUTS_TOTAL = registry.counter(
+    "bank_rate_limit_timeouts_total", "Запросы, не дождавшиеся квоты банка", ("bank", "priority")
+)
+
+
+class BankRateLimitExceeded(Exception):
+    """Квота банка исчерпана и не освободилась за допустимое время"""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket с приоритетной очередью ожидающих"""
+
+    def __init__(self, rate: float, burst: int, bank: str, client: str):
+        self.rate = rate
+        self.burst = burst
+        self.bank = bank
+        self.client = client
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._drainer: asyncio.Task | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _try_take(self) -> bool:
+        if time.monotonic() < self._paused_until:
+            return False
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (банк ответил 429)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    def _publish_depth(self) -> None:
+        QUEUE_DEPTH.set(self.queue_depth, bank=self.bank, client=self.client)
+
+    async def _drain(self) -> None:
+        while self._waiters:
+            while self._waiters and self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+            if not self._waiters:
+                break
+            if self._try_take():
+                _, _, future = heapq.heappop(self._waiters)
+                future.set_result(None)
+                self._publish_depth()
+                continue
+            delay = max(self._paused_until - time.monotonic(), (1 - self._tokens) / self.rate)
+            await asyncio.sleep(max(delay, 0.001))
+        self._publish_depth()
+
+    async def acquire(self, priority: int, max_wait: float) -> None:
+        if not self._waiters and self._try_take():
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._publish_depth()
+        if self._drainer is None or self._drainer.done():
+            self._drainer = asyncio.create_task(self._drain())
+
+        try:
+            await asyncio.wait_for(future, timeout=max_wait)
+        finally:
+            self._publish_depth()
+
+
+class BankRateLimiter:
+    """Набор token bucket по (bank_code, team_client_id)"""
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+
+    def bucket(self, bank_code: str, client_id: str | None) -> TokenBucket:
+        key = (bank_code, client_id or "")
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(
+                settings.BANK_RATE_LIMIT_PER_SECOND,
+                settings.BANK_RATE_LIMIT_BURST,
+                bank=bank_code,
+                client=client_id or ""
+            )
+            self._buckets[key] = bucket
+        return bucket
+
+    async def acquire(self, bank_code: str, client_id: str | None, priority: int = PRIORITY_INTERACTIVE) -> None:
+        """Дождаться квоты банка или поднять BankRateLimitExceeded"""
+        if settings.BANK_RATE_LIMIT_PER_SECOND <= 0:
+            return
+        if priority == PRIORITY_INTERACTIVE:
+            max_wait = settings.BANK_RATE_LIMIT_MAX_WAIT
+        else:
+            max_wait = settings.BANK_RATE_LIMIT_BACKGROUND_MAX_WAIT
+
+        priority_name = "interactive" if priority == PRIORITY_INTERACTIVE else "background"
+        started = time.monotonic()
+        try:
+            await self.bucket(bank_code, client_id).acquire(priority, max_wait)
+        except asyncio.TimeoutError:
+            TIMEOUTS_TOTAL.inc(bank=bank_code, priority=priority_name)
+            raise BankRateLimitExceeded(
+                f"Rate limit for bank '{bank_code}' exceeded, waited {max_wait:.0f}s",
+                retry_after=1.0 / settings.BANK_RATE_LIMIT_PER_SECOND
+            )
+        WAIT_SECONDS.observe(time.monotonic() - started, bank=bank_code, priority=priority_name)
+
+    def penalize(self, bank_code: str, client_id: str | None, retry_after: float) -> None:
+        """Приостановить выдачу квоты после ответа 429 от банка"""
+        self.bucket(bank_code, client_id).pause(retry_after)
+
+
+rate_limiter = BankRateLimiter()
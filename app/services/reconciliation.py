@@ -0,0 +1,178 @@
+"""
+Сверка переводов между счетами пользователя
+
+Перевод между своими счетами (например, из vbank в abank) виден как списание
+в одном банке и зачисление в другом и удваивает суммы в общих итогах. Сверка
+находит такие пары и помечает обе транзакции как внутренний перевод.
+
+Вместо попарного сравнения зачисления раскладываются по хеш-корзинам
+(валюта, сумма, интервал времени шириной в окно сверки). Для каждого списания
+просматриваются только его корзина и две соседние, поэтому время работы
+линейно по размеру истории.
+"""
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.models.transaction import Transaction
+from app.services.normalization import item_transaction_id, replace_transaction_items, transaction_items
+
+# Слова в описании, подсказывающие, что это перевод
+TRANSFER_HINTS = ("перевод", "transfer", "пополнение", "между счетами", "собственных")
+
+BucketKey = Tuple[str, Decimal, int]
+
+CENT = Decimal("0.01")
+
+
+def _window() -> timedelta:
+    return timedelta(hours=settings.RECONCILE_WINDOW_HOURS)
+
+
+def _bucket_key(tx: Transaction, window_seconds: float) -> BucketKey:
+    amount = Decimal(tx.amount).quantize(CENT)
+    return (tx.currency or "", amount, int(tx.booking_date.timestamp() // window_seconds))
+
+
+def _hint_score(debit: Transaction, credit: Transaction) -> int:
+    """Насколько описания похожи на перевод между этими банками"""
+    score = 0
+    for tx, other in ((debit, credit), (credit, debit)):
+        text = (tx.description or "").lower()
+        if any(hint in text for hint in TRANSFER_HINTS):
+            score += 1
+        if other.bank_code and other.bank_code.lower() in text:
+            score += 2
+    return score
+
+
+def match_transfers(transactions: Iterable[Transaction]) -> List[Tuple[Transaction, Transaction]]:
+    """Найти пары (списание, зачисление) одной суммы и валюты на разных счетах в пределах окна"""
+    window = _window()
+    window_seconds = window.total_seconds()
+
+    credits: Dict[BucketKey, List[Transaction]] = defaultdict(list)
+    debits: List[Transaction] = []
+    for tx in transactions:
+        if tx.booking_date is None or tx.transfer_group:
+            continue
+        if tx.credit_debit == "Credit":
+            credits[_bucket_key(tx, window_seconds)].append(tx)
+        elif tx.credit_debit == "Debit":
+            debits.append(tx)
+
+    used: set[int] = set()
+    pairs = []
+    for debit in sorted(debits, key=lambda tx: tx.booking_date):
+        currency, amount, slot = _bucket_key(debit, window_seconds)
+        best = None
+        best_rank = None
+        for neighbour in (slot - 1, slot, slot + 1):
+            for credit in credits.get((currency, amount, neighbour), ()):
+                if id(credit) in used:
+                    continue
+                if (credit.bank_code, credit.account_id) == (debit.bank_code, debit.account_id):
+                    continue
+                delta = abs(credit.booking_date - debit.booking_date)
+                if delta > window:
+                    continue
+                rank = (-_hint_score(debit, credit), delta)
+                if best_rank is None or rank < best_rank:
+                    best, best_rank = credit, rank
+        if best is not None:
+            used.add(id(best))
+            pairs.append((debit, best))
+    return pairs
+
+
+async def reconcile_transfers(
+    db: AsyncSession,
+    user_id: int,
+    around: Iterable[Transaction] | None = None
+) -> int:
+    """
+    Пометить внутренние переводы пользователя (commit делает вызывающий).
+
+    around — новые транзакции: тогда сверяются только транзакции в их окне
+    времени, иначе вся история. Возвращает количество найденных пар.
+    """
+    query = select(Transaction).where(
+        Transaction.user_id == user_id,
+        Transaction.transfer_group.is_(None),
+        Transaction.booking_date.is_not(None)
+    )
+    if around is not None:
+        dates = [tx.booking_date for tx in around if tx.booking_date is not None]
+        if not dates:
+            return 0
+        query = query.where(
+            Transaction.booking_date >= min(dates) - _window(),
+            Transaction.booking_date <= max(dates) + _window()
+        )
+
+    result = await db.execute(query)
+    pairs = match_transfers(result.scalars().all())
+    for debit, credit in pairs:
+        group = uuid.uuid4().hex
+        for tx in (debit, credit):
+            tx.transfer_group = group
+            tx.is_internal_transfer = True
+    return len(pairs)
+
+
+async def annotate_transfers(
+    db: AsyncSession,
+    user_id: int,
+    bank_code: str,
+    payload: Any
+) -> Any:
+    """
+    Добавить к транзакциям ответа банка пометку internalTransfer.
+
+    Ответ банка может быть общим для нескольких запросов, поэтому изменённые
+    элементы копируются, а не правятся на месте.
+    """
+    items = transaction_items(payload)
+    ids = [transaction_id for transaction_id in map(item_transaction_id, items) if transaction_id]
+    if not ids:
+        return payload
+
+    result = await db.execute(
+        select(Transaction.transaction_id, Transaction.transfer_group).where(
+            Transaction.user_id == user_id,
+            Transaction.bank_code == bank_code,
+            Transaction.transaction_id.in_(ids),
+            Transaction.is_internal_transfer == True
+        )
+    )
+    groups = dict(result.all())
+    if not groups:
+        return payload
+
+    result = await db.execute(
+        select(Transaction.transfer_group, Transaction.bank_code, Transaction.account_id, Transaction.transaction_id)
+        .where(Transaction.user_id == user_id, Transaction.transfer_group.in_(list(groups.values())))
+    )
+    counterparts: Dict[str, List[Dict[str, str]]] = defaultdict(list)
+    for group, other_bank, other_account, other_tx in result.all():
+        counterparts[group].append({"bank_code": other_bank, "account_id": other_account, "transaction_id": other_tx})
+
+    def annotate(item: Dict[str, Any]) -> Dict[str, Any]:
+        transaction_id = item_transaction_id(item)
+        group = groups.get(transaction_id)
+        if group is None:
+            return item
+        counterpart = [
+            other for other in counterparts[group]
+            if (other["bank_code"], other["transaction_id"]) != (bank_code, transaction_id)
+        ]
+        return {**item, "internalTransfer": {"group": group, "counterpart": counterpart[0] if counterpart else None}}
+
+    # Ответ сохраняет форму исходного: схемы ответов API ждут тот же конверт
+    return replace_transaction_items(payload, [annotate(item) for item in items])
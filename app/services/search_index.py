@@ -0,0 +1,214 @@
+"""
+Поиск по транзакциям пользователя
+
+Для каждого пользователя в памяти воркера строится инвертированный индекс по
+словам описаний: слово -> id транзакций. Поддерживаются точные совпадения,
+префиксы (бинарный поиск по отсортированному словарю) и нечёткие совпадения
+(триграммы слов словаря). Фильтры по сумме, дате и банку применяются к уже
+найденным документам.
+
+Индекс догоняет БД инкрементально: перед поиском подгружаются строки с
+created_at не раньше последнего проиндексированного за вычетом окна
+SEARCH_INDEX_CATCH_UP_OVERLAP, а уже известные отбрасываются по id. Поэтому
+новые транзакции видны сразу, даже если их сохранил другой воркер. По id
+догонять нельзя: id выдаётся при вставке, а видна строка после commit, и
+транзакция с меньшим id может появиться позже уже прочитанной с бо́льшим.
+Окно перекрытия покрывает то же для created_at и расхождение часов воркеров.
+"""
+import asyncio
+import bisect
+import re
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.models.transaction import Transaction
+from app.services.normalization import intern_code
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+# Веса совпадений при ранжировании
+EXACT_WEIGHT = 1.0
+PREFIX_WEIGHT = 0.7
+FUZZY_WEIGHT = 0.5
+FUZZY_MIN_SIMILARITY = 0.4
+
+
+def tokenize(text: str | None) -> List[str]:
+    return [token.replace("ё", "е") for token in _TOKEN_RE.findall((text or "").lower())]
+
+
+def _trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SearchDocument:
+    """Транзакция в индексе"""
+
+    __slots__ = (
+        "id", "bank_code", "account_id", "transaction_id", "amount", "currency",
+        "credit_debit", "booking_date", "description",
+    )
+
+    def __init__(self, tx: Transaction):
+        self.id = tx.id
+        # Коды банков, счета и валюты повторяются в тысячах документов
+        self.bank_code = intern_code(tx.bank_code)
+        self.account_id = intern_code(tx.account_id)
+        self.transaction_id = tx.transaction_id
+        self.amount = Decimal(tx.amount)
+        self.currency = intern_code(tx.currency)
+        self.credit_debit = intern_code(tx.credit_debit)
+        self.booking_date = tx.booking_date
+        self.description = tx.description
+
+
+class UserSearchIndex:
+    """Инвертированный индекс транзакций одного пользователя"""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        # Наибольший проиндексированный created_at
+        self.watermark: datetime | None = None
+        self.documents: Dict[int, SearchDocument] = {}
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        self.term_trigrams: Dict[str, Set[str]] = defaultdict(set)
+        self._sorted_terms: List[str] = []
+        self._terms_dirty = False
+        self.lock = asyncio.Lock()
+
+    def add(self, tx: Transaction) -> None:
+        document = SearchDocument(tx)
+        self.documents[document.id] = document
+        for term in set(tokenize(tx.description)):
+            if term not in self.postings:
+                self._terms_dirty = True
+                for trigram in _trigrams(term):
+                    self.term_trigrams[trigram].add(term)
+            self.postings[term].add(document.id)
+
+    async def catch_up(self, db: AsyncSession) -> None:
+        """Догрузить транзакции, появившиеся в БД после последнего обновления"""
+        async with self.lock:
+            query = select(Transaction).where(Transaction.user_id == self.user_id)
+            if self.watermark is not None:
+                overlap = timedelta(seconds=settings.SEARCH_INDEX_CATCH_UP_OVERLAP)
+                query = query.where(Transaction.created_at >= self.watermark - overlap)
+            result = await db.stream_scalars(
+                query.order_by(Transaction.created_at).execution_options(yield_per=5000)
+            )
+            async for tx in result:
+                if tx.id not in self.documents:
+                    self.add(tx)
+                if tx.created_at is not None and (self.watermark is None or tx.created_at > self.watermark):
+                    self.watermark = tx.created_at
+
+    def _terms(self) -> List[str]:
+        if self._terms_dirty:
+            self._sorted_terms = sorted(self.postings)
+            self._terms_dirty = False
+        return self._sorted_terms
+
+    def _match_token(self, token: str) -> Dict[int, float]:
+        """Документы, подходящие под слово запроса, с весом лучшего совпадения"""
+        scores: Dict[int, float] = {}
+
+        def credit(doc_ids: Set[int], weight: float) -> None:
+            for doc_id in doc_ids:
+                if weight > scores.get(doc_id, 0.0):
+                    scores[doc_id] = weight
+
+        if token in self.postings:
+            credit(self.postings[token], EXACT_WEIGHT)
+
+        terms = self._terms()
+        start = bisect.bisect_left(terms, token)
+        for term in terms[start:]:
+            if not term.startswith(token):
+                break
+            if term != token:
+                credit(self.postings[term], PREFIX_WEIGHT)
+
+        if len(token) >= 3:
+            query_trigrams = _trigrams(token)
+            shared: Dict[str, int] = defaultdict(int)
+            for trigram in query_trigrams:
+                for term in self.term_trigrams.get(trigram, ()):
+                    shared[term] += 1
+            for term, common in shared.items():
+                similarity = common / (len(query_trigrams) + len(_trigrams(term)) - common)
+                if similarity >= FUZZY_MIN_SIMILARITY and term != token:
+                    credit(self.postings[term], FUZZY_WEIGHT * similarity)
+        return scores
+
+    def search(
+        self,
+        query: str,
+        min_amount: Decimal | None = None,
+        max_amount: Decimal | None = None,
+        date_from: datetime | None = None,
+        date_to: datetime | None = None,
+        bank_codes: List[str] | None = None,
+        limit: int = 50
+    ) -> List[Tuple[SearchDocument, float]]:
+        tokens = tokenize(query)
+        if tokens:
+            # Все слова запроса должны найтись (AND), очки суммируются
+            scores: Dict[int, float] | None = None
+            for token in dict.fromkeys(tokens):
+                matches = self._match_token(token)
+                if scores is None:
+                    scores = matches
+                else:
+                    scores = {doc_id: score + matches[doc_id] for doc_id, score in scores.items() if doc_id in matches}
+                if not scores:
+                    return []
+        else:
+            scores = {doc_id: 0.0 for doc_id in self.documents}
+
+        results = []
+        for doc_id, score in scores.items():
+            document = self.documents[doc_id]
+            if min_amount is not None and document.amount < min_amount:
+                continue
+            if max_amount is not None and document.amount > max_amount:
+                continue
+            if date_from is not None and (document.booking_date is None or document.booking_date < date_from):
+                continue
+            if date_to is not None and (document.booking_date is None or document.booking_date > date_to):
+                continue
+            if bank_codes and document.bank_code not in bank_codes:
+                continue
+            results.append((document, score))
+
+        results.sort(key=lambda item: (item[1], item[0].booking_date or datetime.min), reverse=True)
+        return results[:limit]
+
+
+class SearchIndexRegistry:
+    """Индексы пользователей с вытеснением давно не использованных"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._indexes: "OrderedDict[int, UserSearchIndex]" = OrderedDict()
+
+    async def get(self, db: AsyncSession, user_id: int) -> UserSearchIndex:
+        index = self._indexes.get(user_id)
+        if index is None:
+            index = UserSearchIndex(user_id)
+            self._indexes[user_id] = index
+            while len(self._indexes) > self.max_users:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(user_id)
+        await index.catch_up(db)
+        return index
+
+
+search_indexes = SearchIndexRegistry(settings.SEARCH_INDEX_MAX_USERS)
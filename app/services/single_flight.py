@@ -0,0 +1,68 @@
+"""
+Объединение одинаковых одновременных запросов к банкам (single-flight)
+
+Если такой же запрос (банк, эндпоинт, параметры, токен, согласие) уже
+выполняется, новый вызов не идёт в банк, а ждёт тот же результат. Ошибку
+получают все ожидающие; если последний ожидающий отменился, запрос к банку
+тоже отменяется.
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+from app.core.metrics import registry
+
+COALESCED_TOTAL = registry.counter(
+    "bank_coalesced_requests_total", "Запросы, присоединившиеся к уже идущему запросу в банк", ("bank",)
+)
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Реестр выполняющихся запросов по ключу"""
+
+    def __init__(self):
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def _forget(self, key: Hashable, flight: _Flight) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]], label: str = "") -> Any:
+        """
+        Выполнить factory() один раз для всех одновременных вызовов с этим ключом.
+
+        Результат общий для всех ожидающих — его нельзя изменять на месте.
+        """
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+        else:
+            COALESCED_TOTAL.inc(bank=label)
+
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # Ушёл последний ожидающий — запрос к банку больше никому не нужен
+                flight.task.cancel()
+                self._forget(key, flight)
+            raise
+        finally:
+            flight.waiters -= 1
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,453 @@
+"""
+Фоновая синхронизация пользователя с банками
+
+POST /api/banks/sync только записывает задачу в таблицу sync_jobs — она и
+служит очередью, поэтому задачи переживают перезапуск. Пул в каждом воркере
+забирает задачи атомарным UPDATE ... WHERE status = 'pending', выполняет не
+больше SYNC_WORKERS одновременно и ограничивает число одновременных запросов
+в каждый банк (SYNC_PER_BANK_CONCURRENCY) на все задачи сразу. Запросы в банки
+идут с фоновым приоритетом и не отнимают квоту у интерактивных.
+
+Выполняющаяся задача обновляет heartbeat_at; задачи, чей heartbeat устарел
+(воркер упал), возвращаются в очередь. Незавершённая задача с тем же
+пользователем и банком не создаётся повторно — возвращается существующая.
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Tuple
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.core.config import settings
+from app.core.database import AsyncSessionLocal, USER_ID
+from app.core.metrics import registry
+from app.core.startup import startup_state
+from app.models.account_directory import AccountDirectoryEntry
+from app.models.bank_connection import BankConnection
+from app.models.sync_job import (
+    SyncJob,
+    SYNC_ACTIVE_STATUSES,
+    SYNC_FAILED,
+    SYNC_PARTIAL,
+    SYNC_PENDING,
+    SYNC_RUNNING,
+    SYNC_SUCCEEDED,
+)
+from app.services.account_directory import record_accounts, record_balance
+from app.services.bank_service import BankService, connection_bank_config
+from app.services.bank_tokens import ensure_fresh_token
+from app.services.consents import ConsentChange, refresh_consent_status
+from app.services.events import (
+    notify_balance_changed,
+    notify_consent_status,
+    notify_new_transactions,
+    notify_sync_job,
+)
+from app.services.reconciliation import reconcile_transfers
+from app.services.transaction_store import has_transactions, ingest_transactions
+
+logger = logging.getLogger(__name__)
+
+SYNC_JOBS_FINISHED_TOTAL = registry.counter("sync_jobs_finished_total", "Завершённые задачи синхронизации", ("status",))
+SYNC_JOBS_RUNNING = registry.gauge("sync_jobs_running", "Задачи синхронизации, выполняющиеся в воркере")
+
+
+def _dedupe_key(user_id: int, bank_code: str | None) -> str:
+    return f"{user_id}:{bank_code or '*'}"
+
+
+async def _active_job(db: AsyncSession, dedupe_key: str) -> SyncJob | None:
+    result = await db.execute(
+        select(SyncJob).where(SyncJob.dedupe_key == dedupe_key, SyncJob.status.in_(SYNC_ACTIVE_STATUSES))
+    )
+    return result.scalar_one_or_none()
+
+
+async def enqueue_sync_job(db: AsyncSession, user_id: int, bank_code: str | None = None) -> Tuple[SyncJob, bool]:
+    """Поставить задачу в очередь; вернуть (задача, создана ли новая)"""
+    dedupe_key = _dedupe_key(user_id, bank_code)
+    existing = await _active_job(db, dedupe_key)
+    if existing is not None:
+        return existing, False
+
+    job = SyncJob(user_id=user_id, bank_code=bank_code, dedupe_key=dedupe_key, status=SYNC_PENDING)
+    db.add(job)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Такую же задачу только что создал параллельный запрос
+        await db.rollback()
+        existing = await _active_job(db, dedupe_key)
+        if existing is None:
+            raise
+        return existing, False
+
+    sync_pool.wake()
+    return job, True
+
+
+def _raise_first(results: List[Any]) -> None:
+    """Поднять первую ошибку из gather(..., return_exceptions=True)"""
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+
+async def _publish(job: SyncJob) -> None:
+    await notify_sync_job(
+        job.user_id, job.id, job.bank_code, job.status,
+        job.done_accounts, job.failed_accounts, job.total_accounts, job.new_transactions
+    )
+
+
+class SyncWorkerPool:
+    """Ограниченный пул выполнения задач синхронизации"""
+
+    def __init__(self):
+        self._running: Dict[int, asyncio.Task] = {}
+        self._bank_limits: Dict[str, asyncio.Semaphore] = {}
+        self._wakeup = asyncio.Event()
+
+    def wake(self) -> None:
+        self._wakeup.set()
+
+    def _bank_limit(self, bank_code: str) -> asyncio.Semaphore:
+        limit = self._bank_limits.get(bank_code)
+        if limit is None:
+            limit = asyncio.Semaphore(settings.SYNC_PER_BANK_CONCURRENCY)
+            self._bank_limits[bank_code] = limit
+        return limit
+
+    async def run(self) -> None:
+        """Цикл раздачи задач; запускается задачей в lifespan"""
+        while not startup_state.db_ready:
+            await asyncio.sleep(0.5)
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    await self._requeue_stale()
+                    free = settings.SYNC_WORKERS - len(self._running)
+                    if free > 0:
+                        for job_id in await self._claim(free):
+                            self._start(job_id)
+                except Exception as e:
+                    logger.error(f"Sync dispatcher failed: {e}")
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=settings.SYNC_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            await self._release_running()
+
+    def _start(self, job_id: int) -> None:
+        task = asyncio.create_task(self._execute(job_id))
+        self._running[job_id] = task
+        SYNC_JOBS_RUNNING.set(len(self._running))
+
+        def done(_):
+            self._running.pop(job_id, None)
+            SYNC_JOBS_RUNNING.set(len(self._running))
+            self.wake()
+
+        task.add_done_callback(done)
+
+    async def _claim(self, limit: int) -> List[int]:
+        """Забрать до limit ожидающих задач (другие воркеры могут забирать их же)"""
+        now = datetime.utcnow()
+        claimed = []
+        async with AsyncSessionLocal() as session:
+            result = await session.execute(
+                select(SyncJob.id)
+                .where(SyncJob.status == SYNC_PENDING)
+                .order_by(SyncJob.created_at, SyncJob.id)
+                .limit(limit * 2)
+            )
+            for job_id in result.scalars().all():
+                if len(claimed) >= limit:
+                    break
+                updated = await session.execute(
+                    update(SyncJob)
+                    .where(SyncJob.id == job_id, SyncJob.status == SYNC_PENDING)
+                    .values(status=SYNC_RUNNING, started_at=now, heartbeat_at=now, attempts=SyncJob.attempts + 1)
+                )
+                if updated.rowcount == 1:
+                    claimed.append(job_id)
+            await session.commit()
+        return claimed
+
+    async def _requeue_stale(self) -> None:
+        """Продлить heartbeat своих задач и вернуть в очередь задачи упавших воркеров"""
+        now = datetime.utcnow()
+        stale_before = now - timedelta(seconds=settings.SYNC_STALE_AFTER_SECONDS)
+        own = list(self._running)
+        stale = (
+            SyncJob.status == SYNC_RUNNING,
+            SyncJob.heartbeat_at < stale_before,
+            SyncJob.id.not_in(own or [0]),
+        )
+        async with AsyncSessionLocal() as session:
+            # Задача может долго ждать лимита банка, но воркер жив
+            if own:
+                await session.execute(
+                    update(SyncJob)
+                    .where(SyncJob.id.in_(own), SyncJob.status == SYNC_RUNNING)
+                    .values(heartbeat_at=now)
+                )
+            await session.execute(
+                update(SyncJob)
+                .where(*stale, SyncJob.attempts >= settings.SYNC_MAX_ATTEMPTS)
+                .values(status=SYNC_FAILED, finished_at=now, error="Worker stopped responding")
+            )
+            result = await session.execute(
+                update(SyncJob).where(*stale).values(status=SYNC_PENDING)
+            )
+            await session.commit()
+        if result.rowcount:
+            logger.warning(f"Requeued {result.rowcount} stale sync job(s)")
+
+    async def _release_running(self) -> None:
+        """При остановке вернуть незавершённые задачи в очередь"""
+        tasks = list(self._running.items())
+        for _, task in tasks:
+            task.cancel()
+        await asyncio.gather(*(task for _, task in tasks), return_exceptions=True)
+        if not tasks:
+            return
+        try:
+            async with AsyncSessionLocal() as session:
+                await session.execute(
+                    update(SyncJob)
+                    .where(SyncJob.id.in_([job_id for job_id, _ in tasks]), SyncJob.status == SYNC_RUNNING)
+                    .values(status=SYNC_PENDING)
+                )
+                await session.commit()
+        except Exception as e:
+            logger.warning(f"Failed to requeue sync jobs on shutdown: {e}")
+
+    async def _execute(self, job_id: int) -> None:
+        try:
+            await self._sync(job_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Sync job {job_id} failed: {e}")
+            async with AsyncSessionLocal() as session:
+                job = await session.get(SyncJob, job_id)
+                if job is not None:
+                    job.status = SYNC_FAILED
+                    job.error = str(e)
+                    job.finished_at = datetime.utcnow()
+                    await session.commit()
+                    SYNC_JOBS_FINISHED_TOTAL.inc(status=SYNC_FAILED)
+                    await _publish(job)
+
+    async def _sync(self, job_id: int) -> None:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(SyncJob, job_id)
+            if job is None:
+                return
+            # Запись синхронизации закрепляет чтения пользователя за основной БД
+            db.info[USER_ID] = job.user_id
+            # Задачу могли вернуть в очередь после частичного выполнения
+            job.done_accounts = job.failed_accounts = job.new_transactions = 0
+            job.error = None
+
+            query = select(BankConnection).where(
+                BankConnection.user_id == job.user_id,
+                BankConnection.is_active == True
+            )
+            if job.bank_code:
+                query = query.where(BankConnection.bank_code == job.bank_code)
+            connections = {conn.bank_code: conn for conn in (await db.execute(query)).scalars().all()}
+
+            # Сессия БД не допускает параллельного использования: запросы в банки
+            # идут параллельно, а всё, что касается объектов сессии (записи и
+            # события), — по очереди под db_lock. Откат сессии делает её объекты
+            # устаревшими, поэтому вне db_lock задачи берут параметры запросов
+            # из копий (access), а после отката объекты сразу перечитываются
+            db_lock = asyncio.Lock()
+            errors: List[str] = []
+            entries: List[AccountDirectoryEntry] = []
+
+            async def rollback() -> None:
+                """Откатить сессию после ошибки записи (под db_lock)"""
+                await db.rollback()
+                for instance in (job, *connections.values(), *entries):
+                    try:
+                        await db.refresh(instance)
+                    except InvalidRequestError:
+                        # Строку успели удалить (например, банк отключили)
+                        pass
+
+            async def fail(where: str, error: Exception, account: bool) -> None:
+                async with db_lock:
+                    errors.append(f"{where}: {error}")
+                    if account:
+                        job.failed_accounts += 1
+                    job.error = "; ".join(errors[-5:])
+                    job.heartbeat_at = datetime.utcnow()
+                    try:
+                        await db.commit()
+                    except Exception as e:
+                        logger.warning(f"Sync job {job_id}: failed to record error: {e}")
+                        await rollback()
+                        return
+                    await _publish(job)
+
+            # Истёкшие токены обновляются заранее; банк без действующего токена пропускается
+            services: Dict[str, BankService] = {}
+            access: Dict[str, Dict[str, str | None]] = {}
+            consent_changes: List[Tuple[str, ConsentChange]] = []
+            for bank_code, connection in list(connections.items()):
+                try:
+                    await ensure_fresh_token(connection)
+                    services[bank_code] = self._service(connection)
+                except Exception as e:
+                    del connections[bank_code]
+                    await fail(f"{bank_code} token", e, account=False)
+                    continue
+                access[bank_code] = {
+                    "access_token": connection.access_token,
+                    "requesting_bank": connection.team_client_id,
+                    "consent_id": connection.consent_id,
+                }
+                # Ожидавшее согласие могли одобрить в банке после прошлой синхронизации
+                try:
+                    change = await refresh_consent_status(db, connection)
+                except Exception as e:
+                    logger.warning(f"Sync job {job_id}: failed to check {bank_code} consent: {e}")
+                else:
+                    if change is not None:
+                        consent_changes.append((bank_code, change))
+            # Обновлённые токены и статусы согласий сохраняются до запросов в банки:
+            # откат сессии из-за ошибки записи счёта не должен их потерять
+            await db.commit()
+            for bank_code, (old_status, new_status) in consent_changes:
+                await notify_consent_status(job.user_id, bank_code, old_status, new_status)
+
+            # 1. Обновить списки счетов по известным клиентам
+            clients = {
+                (entry.bank_code, entry.client_id)
+                for entry in await self._directory(db, job.user_id, list(connections))
+                if entry.client_id
+            }
+
+            async def refresh_accounts(bank_code: str, client_id: str) -> None:
+                try:
+                    async with self._bank_limit(bank_code):
+                        accounts = await services[bank_code].get_accounts(client_id=client_id, **access[bank_code])
+                except Exception as e:
+                    await fail(f"{bank_code} accounts", e, account=False)
+                    return
+                async with db_lock:
+                    try:
+                        await record_accounts(db, connections[bank_code], client_id, accounts)
+                        await db.commit()
+                        return
+                    except Exception as e:
+                        await rollback()
+                        error = e
+                await fail(f"{bank_code} accounts", error, account=False)
+
+            _raise_first(await asyncio.gather(
+                *(refresh_accounts(bank_code, client_id) for bank_code, client_id in clients),
+                return_exceptions=True
+            ))
+
+            # 2. Транзакции и балансы каждого счёта
+            entries[:] = [
+                entry for entry in await self._directory(db, job.user_id, list(connections))
+                if entry.client_id
+            ]
+            job.total_accounts = len(entries)
+            job.heartbeat_at = datetime.utcnow()
+            await db.commit()
+            await _publish(job)
+
+            async def sync_account(entry: AccountDirectoryEntry, bank_code: str, account_id: str, client_id: str) -> None:
+                try:
+                    service = services[bank_code]
+                    async with self._bank_limit(bank_code):
+                        transactions = await service.get_transactions(
+                            account_id=account_id, client_id=client_id, **access[bank_code]
+                        )
+                        balances = await service.get_balances(
+                            account_id=account_id, client_id=client_id, **access[bank_code]
+                        )
+                except Exception as e:
+                    await fail(f"{bank_code}/{account_id}", e, account=True)
+                    return
+
+                async with db_lock:
+                    try:
+                        seen_before = await has_transactions(db, job.user_id, bank_code, account_id)
+                        new_transactions = await ingest_transactions(
+                            db, job.user_id, bank_code, account_id, transactions
+                        )
+                        if new_transactions:
+                            await reconcile_transfers(db, job.user_id, around=new_transactions)
+                        change = await record_balance(db, entry, balances)
+                        connections[bank_code].last_sync_at = datetime.utcnow()
+                        job.done_accounts += 1
+                        job.new_transactions += len(new_transactions)
+                        job.heartbeat_at = datetime.utcnow()
+                        await db.commit()
+                    except Exception as e:
+                        # Счёт не записан; сессию нужно откатить, иначе остальные задачи получат PendingRollbackError
+                        await rollback()
+                        error = e
+                    else:
+                        if seen_before:
+                            await notify_new_transactions(job.user_id, bank_code, account_id, new_transactions)
+                        if change is not None and change[0] is not None:
+                            await notify_balance_changed(
+                                job.user_id, bank_code, account_id, change[0], change[1], entry.currency
+                            )
+                        await _publish(job)
+                        return
+                await fail(f"{bank_code}/{account_id}", error, account=True)
+
+            _raise_first(await asyncio.gather(
+                *(
+                    sync_account(entry, entry.bank_code, entry.account_id, entry.client_id)
+                    for entry in list(entries)
+                ),
+                return_exceptions=True
+            ))
+
+            # Любая ошибка — и пропущенный целиком банк, и отдельный счёт — делает
+            # синхронизацию неполной
+            if not errors and job.failed_accounts == 0:
+                job.status = SYNC_SUCCEEDED
+            else:
+                job.status = SYNC_PARTIAL if job.done_accounts else SYNC_FAILED
+            job.finished_at = datetime.utcnow()
+            await db.commit()
+            SYNC_JOBS_FINISHED_TOTAL.inc(status=job.status)
+            await _publish(job)
+
+    @staticmethod
+    async def _directory(db: AsyncSession, user_id: int, bank_codes: List[str]) -> List[AccountDirectoryEntry]:
+        if not bank_codes:
+            return []
+        result = await db.execute(
+            select(AccountDirectoryEntry).where(
+                AccountDirectoryEntry.user_id == user_id,
+                AccountDirectoryEntry.bank_code.in_(bank_codes)
+            )
+        )
+        return list(result.scalars().all())
+
+    @staticmethod
+    def _service(connection: BankConnection) -> BankService:
+        bank_config = connection_bank_config(connection.bank_code, connection)
+        if bank_config is None:
+            raise ValueError(f"Bank '{connection.bank_code}' is not configured")
+        return BankService(bank_config, bank_code=connection.bank_code, priority="background")
+
+
+sync_pool = SyncWorkerPool()
@@ -0,0 +1,85 @@
+"""
+Локальное хранилище транзакций
+
+Каждый ответ банка с транзакциями сохраняется в таблицу transactions; по ней
+определяется, какие транзакции появились с прошлой синхронизации.
+"""
+from typing import Any, Dict, List
+from datetime import datetime
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.core.database import dialect_insert
+from app.models.transaction import Transaction
+from app.services.normalization import TransactionRecord, intern_code, normalize_transactions
+
+
+def _to_row(user_id: int, bank_code: str, record: TransactionRecord, now: datetime) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "bank_code": bank_code,
+        "account_id": record.account_id,
+        "transaction_id": record.transaction_id,
+        "amount": record.amount,
+        "currency": record.currency,
+        "credit_debit": record.credit_debit,
+        "status": record.status,
+        "booking_date": record.booking_date,
+        "description": record.description,
+        "is_internal_transfer": False,
+        "created_at": now,
+    }
+
+
+async def ingest_transactions(
+    db: AsyncSession,
+    user_id: int,
+    bank_code: str,
+    account_id: str,
+    payload: Any
+) -> List[Transaction]:
+    """
+    Сохранить транзакции из ответа банка и вернуть новые (commit делает вызывающий).
+
+    Уже сохранённые пропускает сама БД (ON CONFLICT DO NOTHING): параллельная
+    запись того же счёта (вторая вкладка, фоновая синхронизация) не падает на
+    уникальном индексе, а новыми считаются только действительно вставленные строки.
+    """
+    bank_code = intern_code(bank_code)
+    now = datetime.utcnow()
+    incoming: Dict[str, Dict[str, Any]] = {
+        record.transaction_id: _to_row(user_id, bank_code, record, now)
+        for record in normalize_transactions(payload, account_id)
+    }
+    if not incoming:
+        return []
+
+    # Большинство транзакций обычно уже сохранены — их не отправляем вовсе
+    result = await db.execute(
+        select(Transaction.transaction_id).where(
+            Transaction.user_id == user_id,
+            Transaction.bank_code == bank_code,
+            Transaction.transaction_id.in_(list(incoming))
+        )
+    )
+    known = set(result.scalars().all())
+    rows = [row for transaction_id, row in incoming.items() if transaction_id not in known]
+    if not rows:
+        return []
+
+    statement = dialect_insert(db, Transaction).on_conflict_do_nothing(
+        index_elements=["user_id", "bank_code", "transaction_id"]
+    ).returning(Transaction)
+    result = await db.scalars(statement, rows)
+    return list(result.all())
+
+
+async def has_transactions(db: AsyncSession, user_id: int, bank_code: str, account_id: str) -> bool:
+    """Сохранялись ли уже транзакции этого счёта"""
+    result = await db.execute(
+        select(Transaction.id).where(
+            Transaction.user_id == user_id,
+            Transaction.bank_code == bank_code,
+            Transaction.account_id == account_id
+        ).limit(1)
+    )
+    return result.first() is not None
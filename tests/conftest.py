@@ -0,0 +1,46 @@
+"""
+Общие фикстуры тестов
+
+Тесты идут без Postgres и Redis: БД — файл SQLite (aiosqlite), общее
+хранилище состояния — в памяти процесса. Асинхронные тесты помечаются
+pytest.mark.anyio (плагин anyio ставится вместе с FastAPI).
+"""
+import os
+import tempfile
+
+# Настройки читаются при импорте app, поэтому задаются до него
+_DB_DIR = tempfile.mkdtemp(prefix="multibank-tests-")
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_DB_DIR}/test.db"
+os.environ["STATE_BACKEND"] = "memory"
+
+import pytest
+
+import app.models  # noqa: F401  (регистрирует таблицы в Base.metadata)
+from app.core import state as state_module
+from app.core.database import AsyncSessionLocal, Base, engine
+from app.core.state import MemoryStateBackend
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def state(monkeypatch):
+    """Чистое хранилище состояния в памяти вместо общего"""
+    backend = MemoryStateBackend()
+    monkeypatch.setattr(state_module, "_backend", backend)
+    return backend
+
+
+@pytest.fixture
+async def db():
+    """Сессия пустой БД; таблицы пересоздаются для каждого теста"""
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSessionLocal() as session:
+        yield session
+    # Соединения пула привязаны к циклу событий теста
+    await engine.dispose()
@@ -0,0 +1,104 @@
+import pytest
+
+from app.core import state as state_module
+from app.core.state import MemoryStateBackend, SQLiteStateBackend
+from app.services.events import EventBroker
+
+pytestmark = pytest.mark.anyio
+
+USER_ID = 7
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+async def shared_state(request, tmp_path, monkeypatch):
+    """Хранилище, общее для всех воркеров"""
+    backend = MemoryStateBackend() if request.param == "memory" else SQLiteStateBackend(str(tmp_path / "state.db"))
+    monkeypatch.setattr(state_module, "_backend", backend)
+    yield backend
+    await backend.close()
+
+
+def make_broker(history_size: int = 10, buffer_size: int = 10) -> EventBroker:
+    return EventBroker(history_size, buffer_size, poll_interval=0.05, history_ttl=60.0)
+
+
+def drain(subscription):
+    events = []
+    while not subscription.queue.empty():
+        events.append(subscription.queue.get_nowait())
+    return [(event.id, event.type, event.data) for event in events]
+
+
+async def test_event_from_other_worker_is_delivered(shared_state):
+    publisher, receiver = make_broker(), make_broker()
+    subscription = await receiver.subscribe(USER_ID)
+
+    published = await publisher.publish(USER_ID, "sync", {"status": "running"})
+    await receiver.deliver()
+
+    assert drain(subscription) == [(published.id, "sync", {"status": "running"})]
+
+
+async def test_event_ids_are_shared_between_workers(shared_state):
+    first, second = make_broker(), make_broker()
+
+    ids = [
+        (await first.publish(USER_ID, "sync", {})).id,
+        (await second.publish(USER_ID, "sync", {})).id,
+        (await first.publish(USER_ID, "sync", {})).id,
+    ]
+    assert ids == sorted(set(ids))
+
+
+async def test_resume_after_last_event_id_on_other_worker(shared_state):
+    publisher, receiver = make_broker(), make_broker()
+    ids = [(await publisher.publish(USER_ID, "balance", {"n": n})).id for n in range(3)]
+
+    subscription = await receiver.subscribe(USER_ID, last_event_id=ids[0])
+
+    assert [event_id for event_id, _, _ in drain(subscription)] == ids[1:]
+
+
+async def test_future_last_event_id_starts_from_now(shared_state):
+    broker = make_broker()
+    await broker.publish(USER_ID, "sync", {"n": 1})
+
+    subscription = await broker.subscribe(USER_ID, last_event_id=10_000)
+    assert drain(subscription) == []
+
+    # Журнал пересоздан: новые события с меньшими номерами всё равно доходят
+    published = await broker.publish(USER_ID, "sync", {"n": 2})
+    await broker.deliver()
+    assert drain(subscription) == [(published.id, "sync", {"n": 2})]
+
+
+async def test_event_is_delivered_once(shared_state):
+    broker = make_broker()
+    subscription = await broker.subscribe(USER_ID)
+
+    await broker.publish(USER_ID, "sync", {})
+    await broker.deliver()
+    await broker.deliver()
+
+    assert len(drain(subscription)) == 1
+
+
+async def test_slow_subscriber_drops_oldest_events(shared_state):
+    broker = make_broker(buffer_size=2)
+    subscription = await broker.subscribe(USER_ID)
+
+    ids = [(await broker.publish(USER_ID, "sync", {"n": n})).id for n in range(4)]
+    await broker.deliver()
+
+    assert [event_id for event_id, _, _ in drain(subscription)] == ids[-2:]
+
+
+async def test_unsubscribed_worker_stops_reading(shared_state):
+    broker = make_broker()
+    subscription = await broker.subscribe(USER_ID)
+    subscription.close()
+
+    await broker.publish(USER_ID, "sync", {})
+    await broker.deliver()
+
+    assert drain(subscription) == []
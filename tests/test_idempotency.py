@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from app.core.config import settings
+from app.services.idempotency import IdempotencyKeyInProgress, IdempotencyKeyMismatch, run_idempotent
+
+pytestmark = pytest.mark.anyio
+
+PAYLOAD = {"bank_code": "vbank", "client_id": "team1"}
+
+
+class Execute:
+    def __init__(self, delay: float = 0.0, error: Exception | None = None):
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return {"consent_id": f"cons-{self.calls}"}
+
+
+async def test_repeat_is_replayed(state):
+    execute = Execute()
+
+    body, replayed = await run_idempotent("connect", 1, "key-1", PAYLOAD, execute)
+    assert (body, replayed) == ({"consent_id": "cons-1"}, False)
+
+    body, replayed = await run_idempotent("connect", 1, "key-1", dict(PAYLOAD), execute)
+    assert (body, replayed) == ({"consent_id": "cons-1"}, True)
+    assert execute.calls == 1
+
+
+async def test_keys_are_scoped_by_user_and_operation(state):
+    execute = Execute()
+
+    await run_idempotent("connect", 1, "key-1", PAYLOAD, execute)
+    await run_idempotent("connect", 2, "key-1", PAYLOAD, execute)
+    await run_idempotent("consent", 1, "key-1", PAYLOAD, execute)
+    assert execute.calls == 3
+
+
+async def test_other_body_with_same_key_is_rejected(state):
+    await run_idempotent("connect", 1, "key-1", PAYLOAD, Execute())
+
+    with pytest.raises(IdempotencyKeyMismatch):
+        await run_idempotent("connect", 1, "key-1", {**PAYLOAD, "client_id": "team2"}, Execute())
+
+
+async def test_failed_request_is_not_stored(state):
+    with pytest.raises(RuntimeError):
+        await run_idempotent("connect", 1, "key-1", PAYLOAD, Execute(error=RuntimeError("bank is down")))
+
+    body, replayed = await run_idempotent("connect", 1, "key-1", PAYLOAD, Execute())
+    assert replayed is False
+    assert body == {"consent_id": "cons-1"}
+
+
+async def test_concurrent_repeat_waits_for_first_request(state, monkeypatch):
+    # Запрос в банк идёт в несколько раз дольше TTL блокировки: её должно держать продление
+    monkeypatch.setattr(settings, "IDEMPOTENCY_LOCK_TTL", 0.15)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 5.0)
+    execute = Execute(delay=0.6)
+
+    results = await asyncio.gather(
+        run_idempotent("connect", 1, "key-1", PAYLOAD, execute),
+        run_idempotent("connect", 1, "key-1", PAYLOAD, execute),
+    )
+
+    assert execute.calls == 1
+    assert sorted(replayed for _, replayed in results) == [False, True]
+    assert results[0][0] == results[1][0]
+
+
+async def test_repeat_gives_up_after_wait_timeout(state, monkeypatch):
+    monkeypatch.setattr(settings, "IDEMPOTENCY_LOCK_TTL", 5.0)
+    monkeypatch.setattr(settings, "IDEMPOTENCY_WAIT_TIMEOUT", 0.1)
+    execute = Execute(delay=0.5)
+
+    first = asyncio.create_task(run_idempotent("connect", 1, "key-1", PAYLOAD, execute))
+    await asyncio.sleep(0.05)
+    with pytest.raises(IdempotencyKeyInProgress):
+        await run_idempotent("connect", 1, "key-1", PAYLOAD, execute)
+
+    assert (await first)[1] is False
+    assert execute.calls == 1
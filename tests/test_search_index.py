@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from app.core.config import settings
+from app.models.transaction import Transaction
+from app.models.user import User
+from app.services.search_index import UserSearchIndex
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def user(db):
+    user = User(email="user@example.com", password_hash="x")
+    db.add(user)
+    await db.commit()
+    return user
+
+
+async def add_transaction(db, user, transaction_id, description, created_at, **values):
+    tx = Transaction(
+        user_id=user.id,
+        bank_code="vbank",
+        account_id="acc-1",
+        transaction_id=transaction_id,
+        amount=Decimal("100.00"),
+        currency="RUB",
+        credit_debit="Debit",
+        description=description,
+        created_at=created_at,
+        **values
+    )
+    db.add(tx)
+    await db.commit()
+    return tx
+
+
+def found(index, query):
+    return [document.transaction_id for document, _ in index.search(query)]
+
+
+async def test_catch_up_adds_new_transactions(db, user):
+    now = datetime.utcnow()
+    await add_transaction(db, user, "t1", "Оплата кофе", now - timedelta(minutes=5))
+    index = UserSearchIndex(user.id)
+    await index.catch_up(db)
+    assert found(index, "кофе") == ["t1"]
+
+    await add_transaction(db, user, "t2", "Кофейня у дома", now)
+    await index.catch_up(db)
+    assert sorted(found(index, "коф")) == ["t1", "t2"]
+    assert index.watermark == now
+
+
+async def test_catch_up_sees_row_committed_late_with_smaller_id(db, user, monkeypatch):
+    monkeypatch.setattr(settings, "SEARCH_INDEX_CATCH_UP_OVERLAP", 120.0)
+    now = datetime.utcnow()
+    await add_transaction(db, user, "t2", "Такси", now, id=20)
+    index = UserSearchIndex(user.id)
+    await index.catch_up(db)
+
+    # Другой воркер вставил строку раньше (меньший id и created_at), но закоммитил позже
+    await add_transaction(db, user, "t1", "Аптека", now - timedelta(seconds=30), id=10)
+    await index.catch_up(db)
+
+    assert found(index, "аптека") == ["t1"]
+    assert sorted(index.documents) == [10, 20]
+    assert index.watermark == now
+
+
+async def test_catch_up_does_not_duplicate_overlap(db, user, monkeypatch):
+    monkeypatch.setattr(settings, "SEARCH_INDEX_CATCH_UP_OVERLAP", 120.0)
+    now = datetime.utcnow()
+    await add_transaction(db, user, "t1", "Продукты", now - timedelta(seconds=10))
+    await add_transaction(db, user, "t2", "Продукты рынок", now)
+    index = UserSearchIndex(user.id)
+
+    await index.catch_up(db)
+    await index.catch_up(db)
+
+    assert len(index.documents) == 2
+    assert sorted(found(index, "продукты")) == ["t1", "t2"]
+    assert all(len(ids) == len(set(ids)) for ids in index.postings.values())
+
+
+async def test_catch_up_is_per_user(db, user):
+    other = User(email="other@example.com", password_hash="x")
+    db.add(other)
+    await db.commit()
+    now = datetime.utcnow()
+    await add_transaction(db, user, "t1", "Кино", now)
+    await add_transaction(db, other, "t2", "Кино", now)
+
+    index = UserSearchIndex(user.id)
+    await index.catch_up(db)
+    assert found(index, "кино") == ["t1"]
@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+
+from app.services.single_flight import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+
+class SlowCall:
+    """factory, который ждёт сигнала и считает вызовы и отмены"""
+
+    def __init__(self, result="ok"):
+        self.result = result
+        self.calls = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+async def test_concurrent_calls_share_one_request():
+    flights = SingleFlight()
+    call = SlowCall({"balance": 1})
+
+    tasks = [asyncio.create_task(flights.do("key", call)) for _ in range(3)]
+    await asyncio.sleep(0)
+    assert flights.in_flight == 1
+    call.release.set()
+
+    results = await asyncio.gather(*tasks)
+    assert results == [{"balance": 1}] * 3
+    assert call.calls == 1
+    assert flights.in_flight == 0
+
+
+async def test_error_is_shared_and_key_forgotten():
+    flights = SingleFlight()
+    call = SlowCall(RuntimeError("bank is down"))
+
+    tasks = [asyncio.create_task(flights.do("key", call)) for _ in range(2)]
+    await asyncio.sleep(0)
+    call.release.set()
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flights.in_flight == 0
+
+    # После ошибки следующий вызов идёт в банк заново
+    retry = SlowCall("ok")
+    retry.release.set()
+    assert await flights.do("key", retry) == "ok"
+    assert retry.calls == 1
+
+
+async def test_cancelling_one_waiter_keeps_request_for_others():
+    flights = SingleFlight()
+    call = SlowCall("ok")
+
+    first = asyncio.create_task(flights.do("key", call))
+    second = asyncio.create_task(flights.do("key", call))
+    await asyncio.sleep(0)
+
+    first.cancel()
+    await asyncio.gather(first, return_exceptions=True)
+    assert first.cancelled()
+    assert call.cancelled == 0
+
+    call.release.set()
+    assert await second == "ok"
+    assert call.calls == 1
+
+
+async def test_cancelling_last_waiter_cancels_request():
+    flights = SingleFlight()
+    call = SlowCall("ok")
+
+    waiter = asyncio.create_task(flights.do("key", call))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    await asyncio.sleep(0)
+
+    assert call.cancelled == 1
+    assert flights.in_flight == 0
+
+    # Новый вызов не присоединяется к отменённому запросу
+    retry = SlowCall("fresh")
+    retry.release.set()
+    assert await flights.do("key", retry) == "fresh"
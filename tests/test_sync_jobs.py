@@ -0,0 +1,97 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app.core.config import settings
+from app.models.sync_job import SYNC_FAILED, SYNC_PENDING, SYNC_RUNNING, SyncJob
+from app.models.user import User
+from app.services.sync_jobs import SyncWorkerPool, enqueue_sync_job
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def user(db):
+    user = User(email="user@example.com", password_hash="x")
+    db.add(user)
+    await db.commit()
+    return user
+
+
+async def add_job(db, user, bank_code, created_at, status=SYNC_PENDING, **values):
+    job = SyncJob(
+        user_id=user.id,
+        bank_code=bank_code,
+        dedupe_key=f"{user.id}:{bank_code}",
+        status=status,
+        created_at=created_at,
+        **values
+    )
+    db.add(job)
+    await db.commit()
+    return job
+
+
+async def statuses(db):
+    result = await db.execute(select(SyncJob.id, SyncJob.status, SyncJob.attempts).order_by(SyncJob.id))
+    return {job_id: (status, attempts) for job_id, status, attempts in result.all()}
+
+
+async def test_enqueue_returns_active_job(db, user):
+    job, created = await enqueue_sync_job(db, user.id, "vbank")
+    again, created_again = await enqueue_sync_job(db, user.id, "vbank")
+    other, created_other = await enqueue_sync_job(db, user.id, "abank")
+
+    assert created and not created_again and created_other
+    assert again.id == job.id
+    assert other.id != job.id
+
+
+async def test_claim_takes_oldest_pending_jobs_once(db, user):
+    now = datetime.utcnow()
+    newest = await add_job(db, user, "vbank", now)
+    oldest = await add_job(db, user, "abank", now - timedelta(minutes=2))
+    middle = await add_job(db, user, "sbank", now - timedelta(minutes=1))
+
+    first_worker, second_worker = SyncWorkerPool(), SyncWorkerPool()
+    assert await first_worker._claim(2) == [oldest.id, middle.id]
+    assert await second_worker._claim(2) == [newest.id]
+    assert await first_worker._claim(2) == []
+
+    assert await statuses(db) == {
+        newest.id: (SYNC_RUNNING, 1),
+        oldest.id: (SYNC_RUNNING, 1),
+        middle.id: (SYNC_RUNNING, 1),
+    }
+
+
+async def test_stale_jobs_are_requeued_or_failed(db, user, monkeypatch):
+    monkeypatch.setattr(settings, "SYNC_STALE_AFTER_SECONDS", 60.0)
+    monkeypatch.setattr(settings, "SYNC_MAX_ATTEMPTS", 3)
+    now = datetime.utcnow()
+    long_ago = now - timedelta(minutes=10)
+
+    crashed = await add_job(db, user, "vbank", long_ago, SYNC_RUNNING, heartbeat_at=long_ago, attempts=1)
+    exhausted = await add_job(db, user, "abank", long_ago, SYNC_RUNNING, heartbeat_at=long_ago, attempts=3)
+    alive = await add_job(db, user, "sbank", long_ago, SYNC_RUNNING, heartbeat_at=now, attempts=1)
+    own = await add_job(db, user, None, long_ago, SYNC_RUNNING, heartbeat_at=long_ago, attempts=1)
+
+    # Задача own выполняется в этом воркере и долго ждёт лимита банка
+    pool = SyncWorkerPool()
+    pool._running[own.id] = asyncio.get_running_loop().create_future()
+    await pool._requeue_stale()
+
+    assert await statuses(db) == {
+        crashed.id: (SYNC_PENDING, 1),
+        exhausted.id: (SYNC_FAILED, 3),
+        alive.id: (SYNC_RUNNING, 1),
+        own.id: (SYNC_RUNNING, 1),
+    }
+    await db.refresh(own, ["heartbeat_at"])
+    assert own.heartbeat_at > long_ago
+
+    # Возвращённую задачу забирает другой воркер, попытка засчитывается
+    assert await SyncWorkerPool()._claim(5) == [crashed.id]
+    assert (await statuses(db))[crashed.id] == (SYNC_RUNNING, 2)